@@ -1,5 +1,9 @@
 """ Handles reading and interpolation of atmopshere (grid) data """
+import json
 import logging
+import os
+import sys
+import tempfile
 
 import numpy as np
 
@@ -21,6 +25,13 @@ from ..abund import Abund
 
 logger = logging.getLogger(__name__)
 
+#:bytes: identifies the native file format of atmosphere grids
+NATIVE_MAGIC = b"PYSMEATM"
+#:int: version of the native file format, increase if the layout changes
+NATIVE_VERSION = 1
+#:int: the data starts at a multiple of this many bytes
+NATIVE_ALIGNMENT = 64
+
 
 class AtmosphereError(RuntimeError):
     """ Something went wrong with the atmosphere interpolation """
@@ -169,7 +180,7 @@ class AtmosphereGrid(np.recarray):
     ]
     # fmt: on
 
-    def __new__(cls, natmo, npoints, **kwargs):
+    def __new__(cls, natmo, npoints, buf=None, offset=0, **kwargs):
         dtype = [
             ("teff", "f4"),
             ("logg", "f4"),
@@ -192,7 +203,9 @@ class AtmosphereGrid(np.recarray):
         names = [s[0].lower() for s in dtype]
         titles = [s[0].upper() for s in dtype]
 
-        atmo_grid = np.recarray(natmo, dtype=dtype, names=names, titles=titles)
+        atmo_grid = np.recarray(
+            natmo, dtype=dtype, names=names, titles=titles, buf=buf, offset=offset
+        )
 
         data = atmo_grid.view(cls)
         data.interp = "TAU"
@@ -214,7 +227,9 @@ class AtmosphereGrid(np.recarray):
         self.citation_info = getattr(self, "citation_info", "")
         self.method = getattr(self, "method", "grid")
         self.abund_format = getattr(self, "abund_format", "sme")
-        self.wlstd = getattr(self, "wlstd", 5000)
+        # wlstd is usually a field, which may be read-only
+        if "wlstd" not in (self.dtype.names or ()):
+            self.wlstd = getattr(self, "wlstd", 5000)
 
     def __getitem__(self, key):
         """ Overwrite the getitem routine, so we keep additional
@@ -242,3 +257,119 @@ class AtmosphereGrid(np.recarray):
     @property
     def ndep(self):
         return self.shape[1]
+
+    def save_native(self, filename, **meta):
+        """
+        Save the grid in the native binary format, which can be
+        memory mapped by load_native
+
+        The file consists of a short JSON header, followed by the
+        contiguous records of the grid. The file is replaced atomically,
+        so concurrent readers never see a partial file.
+
+        Parameters
+        ----------
+        filename : str
+            name of the output file
+        **meta
+            additional information to store in the header
+        """
+        data = np.ascontiguousarray(self.view(np.recarray))
+        header = {name: getattr(self, name) for name in self._names}
+        header.update(
+            version=NATIVE_VERSION,
+            natmo=data.shape[0],
+            npoints=data.dtype["temp"].shape[0],
+            itemsize=data.dtype.itemsize,
+            byteorder=sys.byteorder,
+            meta=meta,
+        )
+        header = json.dumps(header).encode()
+        # Pad the header, so that the data is aligned
+        start = len(NATIVE_MAGIC) + 8 + len(header)
+        header += b" " * (-start % NATIVE_ALIGNMENT)
+
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(NATIVE_MAGIC)
+                f.write(len(header).to_bytes(8, "little"))
+                f.write(header)
+                f.write(data.tobytes())
+            os.replace(tmp, filename)
+        except BaseException:
+            os.remove(tmp)
+            raise
+
+    @staticmethod
+    def read_native_header(filename):
+        """
+        Read the header of a native atmosphere grid file
+
+        Parameters
+        ----------
+        filename : str
+            name of the file
+
+        Returns
+        -------
+        header : dict
+            the header information
+        offset : int
+            position of the data in the file, in bytes
+
+        Raises
+        ------
+        ValueError
+            if the file is not in the native format
+        """
+        with open(filename, "rb") as f:
+            if f.read(len(NATIVE_MAGIC)) != NATIVE_MAGIC:
+                raise ValueError(f"{filename} is not a native atmosphere grid file")
+            length = int.from_bytes(f.read(8), "little")
+            header = json.loads(f.read(length).decode())
+        offset = len(NATIVE_MAGIC) + 8 + length
+        return header, offset
+
+    @classmethod
+    def load_native(cls, filename):
+        """
+        Load an atmosphere grid from the native binary format
+
+        The data is memory mapped read-only, so loading is nearly instant
+        and all processes share the same copy in the page cache.
+
+        Parameters
+        ----------
+        filename : str
+            name of the file created by save_native
+
+        Returns
+        -------
+        atmo_grid : AtmosphereGrid
+            the read-only atmosphere grid
+
+        Raises
+        ------
+        ValueError
+            if the file is not compatible with this version of PySME
+        """
+        header, offset = cls.read_native_header(filename)
+        if header["version"] != NATIVE_VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"The native atmosphere grid {filename} is not compatible")
+
+        buf = np.memmap(filename, dtype=np.uint8, mode="r")
+        try:
+            self = AtmosphereGrid.__new__(
+                cls, header["natmo"], header["npoints"], buf=buf, offset=offset
+            )
+        except TypeError:
+            # The buffer is too small
+            raise ValueError(f"The native atmosphere grid {filename} is incomplete")
+        if self.dtype.itemsize != header["itemsize"]:
+            raise ValueError(f"The native atmosphere grid {filename} is not compatible")
+
+        for name in self._names:
+            setattr(self, name, header[name])
+        return self
@@ -1,15 +1,15 @@
 """ Handles reading and interpolation of atmopshere (grid) data """
-import itertools
 import logging
+from copy import copy
 
 import numpy as np
-from scipy.interpolate import interp1d
 from scipy.optimize import curve_fit
 
 from astropy import constants as const
 
 from .atmosphere import Atmosphere as Atmo, AtmosphereError, AtmosphereGrid
 from .savfile import SavFile
+from ..cache import LRUCache, quantize
 from ..large_file_storage import setup_atmo
 
 logger = logging.getLogger(__name__)
@@ -21,8 +21,75 @@ g_sun = (const.G * const.M_sun / const.R_sun ** 2).to_value("cm/s**2")
 logg_sun = np.log10(g_sun)
 
 
+class GridIndex:
+    """
+    Hierarchical sorted index of an atmosphere grid, i.e. monh -> logg -> teff -> row
+
+    The unique values at each level are sorted, so that the models
+    bracketing a set of parameters can be found with searchsorted.
+    """
+
+    def __init__(self, atmo_grid):
+        monh = np.asarray(atmo_grid.monh)
+        logg = np.asarray(atmo_grid.logg)
+        teff = np.asarray(atmo_grid.teff)
+        #:dtype: the comparisons are made in the type of the grid
+        self.dtype = monh.dtype
+
+        # The sort is stable, so duplicate models keep their order
+        order = np.lexsort((teff, logg, monh))
+        monh, logg, teff = monh[order], logg[order], teff[order]
+
+        #:array: sorted unique [M/H] values
+        self.monh = None
+        #:dict(float, array): sorted unique log(g) values for each [M/H]
+        self.logg = {}
+        #:dict(tuple, array): sorted unique Teff values for each ([M/H], log(g))
+        self.teff = {}
+        #:dict(tuple, array): index of the first model in the grid for each Teff
+        self.rows = {}
+        #:dict(tuple, array): number of models in the grid with each Teff
+        self.counts = {}
+
+        self.monh, mstart = np.unique(monh, return_index=True)
+        mend = np.append(mstart[1:], monh.size)
+        for m, m0, m1 in zip(self.monh, mstart, mend):
+            glist, gstart = np.unique(logg[m0:m1], return_index=True)
+            gend = np.append(gstart[1:], m1 - m0)
+            self.logg[m] = glist
+            for g, g0, g1 in zip(glist, m0 + gstart, m0 + gend):
+                tlist, tstart, tcount = np.unique(
+                    teff[g0:g1], return_index=True, return_counts=True
+                )
+                self.teff[m, g] = tlist
+                self.rows[m, g] = order[g0 + tstart]
+                self.counts[m, g] = tcount
+
+    def bracket(self, values, x):
+        """
+        Find the closest two values that bracket x, in the sorted unique values
+
+        Returns
+        -------
+        low, high : float
+            bracketing values, both equal to x if x is one of the values
+        """
+        x = self.dtype.type(x)
+        low = np.searchsorted(values, x, side="right") - 1
+        high = np.searchsorted(values, x, side="left")
+        return values[low], values[high]
+
+
 class AtmosphereInterpolator:
-    def __init__(self, depth=None, interp=None, geom=None, lfs_atmo=None, verbose=0):
+    def __init__(
+        self,
+        depth=None,
+        interp=None,
+        geom=None,
+        lfs_atmo=None,
+        verbose=0,
+        pair_cache_size=256,
+    ):
         self.depth = depth
         self.interp = interp
         self.geom = geom
@@ -33,6 +100,10 @@ class AtmosphereInterpolator:
         self.source = None
         self.atmo_grid = None
         self.verbose = verbose
+        #:dict: subsets of atmo_grid with the requested geometry
+        self._geom_grids = {}
+        #:LRUCache: depth and value shifts between pairs of models, see interp_atmo_pair
+        self.pair_cache = LRUCache(pair_cache_size)
 
     def interp_atmo_grid(self, atmo_grid, teff, logg, monh):
         """
@@ -62,22 +133,7 @@ class AtmosphereInterpolator:
         """
 
         # Internal parameters.
-        if not isinstance(atmo_grid, AtmosphereGrid):
-            if self.atmo_grid is None or self.source != atmo_grid:
-                atmo_file = self.lfs_atmo.get(atmo_grid)
-                self.source = atmo_grid
-                self.atmo_grid = SavFile(atmo_file)
-        else:
-            self.atmo_grid = atmo_grid
-            self.source = atmo_grid.source
-
-        if self.geom is not None:
-            if self.geom == "PP":
-                atmo_grid = self.atmo_grid[self.atmo_grid.radius <= 1]
-            elif self.geom == "SPH":
-                atmo_grid = self.atmo_grid[self.atmo_grid.radius > 1]
-        else:
-            atmo_grid = self.atmo_grid
+        atmo_grid = self.load_grid(atmo_grid)
 
         # Get field names in ATMO and ATMO_GRID structures.
         depth = self.determine_depth_scale(self.depth, atmo_grid)
@@ -116,7 +172,264 @@ class AtmosphereInterpolator:
 
         return atmo
 
-    def interp_atmo_pair(self, atmo1, atmo2, frac, interpvar="RHOX", itop=0):
+    def interp_atmo_grid_batch(self, atmo_grid, teff, logg, monh):
+        """
+        Interpolate many model atmospheres at once
+
+        Gives the same atmospheres as calling interp_atmo_grid for each set
+        of parameters, but targets that share the same corner models also
+        share the shifts between each pair of models, and the interpolation
+        is done for all of them at once.
+
+        Parameters
+        ----------
+        atmo_grid : str, AtmosphereGrid
+            atmosphere grid, or the name of the grid file
+        teff : float, array of shape (n,)
+            effective temperatures of the desired models (K)
+        logg : float, array of shape (n,)
+            logarithmic gravities of the desired models (log cm/s/s)
+        monh : float, array of shape (n,)
+            metallicities of the desired models
+
+        Returns
+        -------
+        atmos : AtmosphereGrid
+            the interpolated atmospheres, in the order of the input parameters
+
+        Raises
+        ------
+        AtmosphereError
+            if the models do not all have the same geometry,
+            or the same number of depth points
+        """
+        teff, logg, monh = np.broadcast_arrays(
+            np.atleast_1d(teff), np.atleast_1d(logg), np.atleast_1d(monh)
+        )
+        teff, logg, monh = teff.ravel(), logg.ravel(), monh.ravel()
+        natmo = teff.size
+
+        atmo_grid = self.load_grid(atmo_grid)
+        depth = self.determine_depth_scale(self.depth, atmo_grid)
+        interp = self.determine_interpolation_scale(self.interp, atmo_grid)
+        itop = 1
+
+        if atmo_grid.source:
+            grid_key = (atmo_grid.source, self.geom, atmo_grid.size)
+        else:
+            grid_key = None
+
+        def fraction(m0, m1, param, p):
+            p0 = getattr(m0, param)
+            p1 = getattr(m1, param)
+            return (p - p0) / (p1 - p0) if p0 != p1 else np.zeros_like(p)
+
+        # Interpolate one pair of models to all the given values of param.
+        # The shift between the pair is only determined once.
+        def interpolate(m0, m1, param, p, key, **kwargs):
+            pfrac = fraction(m0, m1, param, p)
+            if grid_key is None:
+                key = None
+            shift = self.fit_atmo_pair(m0, m1, interpvar=interp, key=key, **kwargs)
+            vects = self.shift_atmo_pair(shift, pfrac)
+            atmos = [
+                self.create_atmo_pair(m0, m1, f, shift, v) for f, v in zip(pfrac, vects)
+            ]
+            keys = [(key, quantize(f)) for f in pfrac]
+            return atmos, keys
+
+        # Group the targets by the cells of the grid they are in
+        icor = np.stack(
+            [
+                self.find_corner_models(t, g, m, atmo_grid)
+                for t, g, m in zip(teff, logg, monh)
+            ]
+        )
+        _, cell = np.unique(icor.reshape(natmo, -1), axis=0, return_inverse=True)
+        cell = cell.ravel()
+
+        atmos = [None] * natmo
+        for c in np.unique(cell):
+            targets = np.where(cell == c)[0]
+            ic = icor[targets[0]]
+
+            # Interpolate 8 corner models to create 4 models at each [M/H].
+            mlist, minv = np.unique(monh[targets], return_inverse=True)
+            atmo = [[None, None], [None, None]]
+            keys = [[None, None], [None, None]]
+            for (i, j) in np.ndindex(2, 2):
+                m0 = atmo_grid[ic[0, j, i]]
+                m1 = atmo_grid[ic[1, j, i]]
+                key = (grid_key, ic[0, j, i], ic[1, j, i])
+                atmo[i][j], keys[i][j] = interpolate(
+                    m0, m1, "monh", mlist, key, itop=itop
+                )
+
+            for k in range(mlist.size):
+                # Interpolate 4 models at this [M/H] to create 2 models at each log(g).
+                tm = targets[minv.ravel() == k]
+                glist, ginv = np.unique(logg[tm], return_inverse=True)
+                atmo2 = [None, None]
+                keys2 = [None, None]
+                for i in range(2):
+                    atmo2[i], keys2[i] = interpolate(
+                        atmo[i][0][k],
+                        atmo[i][1][k],
+                        "logg",
+                        glist,
+                        (keys[i][0][k], keys[i][1][k]),
+                    )
+
+                # Interpolate the 2 models at each [M/H] and log(g) to create
+                # the final models at all Teff.
+                for g in range(glist.size):
+                    tg = tm[ginv.ravel() == g]
+                    atmo3, _ = interpolate(
+                        atmo2[0][g],
+                        atmo2[1][g],
+                        "teff",
+                        teff[tg],
+                        (keys2[0][g], keys2[1][g]),
+                    )
+                    for t, a in zip(tg, atmo3):
+                        atmos[t] = a
+
+        # All models in the array share one geometry and one depth scale
+        geoms = []
+        for k, atmo in enumerate(atmos):
+            geom, radius = self.spherical_model_correction(atmo_grid, icor[k], logg[k])
+            geoms.append(geom)
+            if radius is not None:
+                atmo.radius = radius
+        if len(set(geoms)) > 1:
+            raise AtmosphereError(
+                "The requested models mix plane parallel and spherical geometries, "
+                "interpolate them in separate batches"
+            )
+        geom = geoms[0]
+
+        npoints = np.unique([a.temp.size for a in atmos])
+        if npoints.size > 1:
+            raise AtmosphereError(
+                "The requested models have different numbers of depth points (%s), "
+                "interpolate them in separate batches" % ", ".join(map(str, npoints))
+            )
+        npoints = npoints[0]
+
+        # Stack the models into one array
+        result = AtmosphereGrid(natmo, npoints)
+        result.source = self.source
+        result.method = "grid"
+        result.depth = depth
+        result.interp = interp
+        result.citation_info = atmo_grid.citation_info
+
+        for k, atmo in enumerate(atmos):
+            for name in ["teff", "logg", "monh", "vturb", "lonh", "radius", "wlstd"]:
+                result[name][k] = atmo[name]
+            result["opflag"][k] = atmo.opflag
+            result["abund"][k] = atmo.abund.get_pattern("sme", raw=True)
+            for name in ["height", "temp", "rhox", "tau", "rho", "xna", "xne"]:
+                if atmo[name] is None:
+                    result[name][k] = np.nan
+                else:
+                    result[name][k] = atmo[name]
+
+        if self.geom is not None and self.geom != geom:
+            if self.geom == "SPH":
+                raise AtmosphereError(
+                    "Input ATMO.GEOM='%s' was requested but the model only supports PP (at this point)."
+                    % self.geom
+                )
+            else:
+                logger.info(
+                    "Input ATMO.GEOM='%s' overrides '%s' from grid.", self.geom, geom,
+                )
+        result.geom = geom
+
+        return result
+
+    def load_grid(self, atmo_grid):
+        """
+        Load the atmosphere grid, unless it is already loaded,
+        and select the models with the requested geometry
+
+        Parameters
+        ----------
+        atmo_grid : str, AtmosphereGrid
+            atmosphere grid, or the name of the grid file
+
+        Returns
+        -------
+        atmo_grid : AtmosphereGrid
+            models of the grid with the requested geometry
+        """
+        if not isinstance(atmo_grid, AtmosphereGrid):
+            if self.atmo_grid is None or self.source != atmo_grid:
+                atmo_file = self.lfs_atmo.get(atmo_grid)
+                self.source = atmo_grid
+                self.atmo_grid = SavFile(atmo_file)
+        else:
+            self.atmo_grid = atmo_grid
+            self.source = atmo_grid.source
+
+        return self.get_geometry_grid(self.geom)
+
+    def get_geometry_grid(self, geom):
+        """
+        Get the models in the current grid with the given geometry
+
+        The subsets are cached, until the grid changes
+
+        Parameters
+        ----------
+        geom : {"PP", "SPH", None}
+            geometry of the models, or None for all models
+
+        Returns
+        -------
+        atmo_grid : AtmosphereGrid
+            models with that geometry
+        """
+        if geom not in ["PP", "SPH"]:
+            return self.atmo_grid
+
+        grids = self._geom_grids
+        if grids.get("grid") is not self.atmo_grid:
+            grids.clear()
+            grids["grid"] = self.atmo_grid
+        if geom not in grids:
+            if geom == "PP":
+                grids[geom] = self.atmo_grid[self.atmo_grid.radius <= 1]
+            else:
+                grids[geom] = self.atmo_grid[self.atmo_grid.radius > 1]
+        return grids[geom]
+
+    @staticmethod
+    def get_grid_index(atmo_grid):
+        """
+        Get the GridIndex of an atmosphere grid, which is created on first use
+        and then kept with the grid
+
+        Parameters
+        ----------
+        atmo_grid : AtmosphereGrid
+            atmosphere grid
+
+        Returns
+        -------
+        index : GridIndex
+            the index of the grid
+        """
+        index = getattr(atmo_grid, "_grid_index", None)
+        if index is None:
+            index = GridIndex(atmo_grid)
+            atmo_grid._grid_index = index
+        return index
+
+    def interp_atmo_pair(
+        self, atmo1, atmo2, frac, interpvar="RHOX", itop=0, key=None
+    ):
         """
         Interpolate between two model atmospheres, accounting for shifts in
         the mass column density or optical depth scale.
@@ -160,6 +473,10 @@ class AtmosphereInterpolator:
             after each plot. (default: 0, no plots)
         old : bool, optional
             also plot result from the old interpkrz2 algorithm. (default: False)
+        key : tuple, optional
+            identifies the pair of atmospheres. The shift parameters only depend
+            on the pair, not on frac, and are cached under this key.
+            By default they are not cached.
 
         Returns
         ------
@@ -218,6 +535,38 @@ class AtmosphereInterpolator:
             for interpvar eq 'TAU'
         """
 
+        shift = self.fit_atmo_pair(atmo1, atmo2, interpvar=interpvar, itop=itop, key=key)
+        vects = self.shift_atmo_pair(shift, frac)
+        return self.create_atmo_pair(atmo1, atmo2, frac, shift, vects)
+
+    def fit_atmo_pair(self, atmo1, atmo2, interpvar="RHOX", itop=0, key=None):
+        """
+        Find the shifts in depth and value between two model atmospheres,
+        for each atmosphere vector. This is step 1) of interp_atmo_pair.
+
+        The shifts do not depend on the interpolation fraction, so they can
+        be reused for any number of interpolations between the same pair,
+        see shift_atmo_pair.
+
+        Parameters
+        ----------
+        atmo1 : Atmosphere
+            first atmosphere to interpolate
+        atmo2 : Atmosphere
+            second atmosphere to interpolate
+        interpvar : {"RHOX", "TAU"}, optional
+            atmosphere interpolation variable (default:"RHOX").
+        itop : int, optional
+            index of top point in the atmosphere to use, see interp_atmo_pair
+        key : tuple, optional
+            identifies the pair, to cache the shift parameters, see interp_atmo_pair
+
+        Returns
+        -------
+        shift : dict
+            the depth scales, masks, atmosphere vectors (vtags), and
+            the shift parameters (pars) of each vector
+        """
         # Internal program parameters.
         min_drhox = min_dtau = 0.01  # minimum fractional step in RHOX
         # min_dtau = 0.01  # minimum fractional step in TAU
@@ -315,42 +664,91 @@ class AtmosphereInterpolator:
         ## Find best shift parameters for each atmosphere vector.
         ##
 
-        # Loop through atmosphere vectors.
-        pars = np.zeros((nvtag, npar))
-        for ivtag, vtag in enumerate(vtags):
-
-            # Find vector in each structure.
-            if vtag not in tags1:
-                raise AtmosphereError("atmo1 does not contain " + vtag)
-            if vtag not in tags2:
-                raise AtmosphereError("atmo2 does not contain " + vtag)
-
-            vect1 = np.log10(atmo1[vtag][mask1])
-            vect2 = np.log10(atmo2[vtag][mask2])
-
-            # Fit the second atmosphere onto the first by finding the best horizontal
-            # shift in depth2 and the best vertical shift in vect2.
-            pars[ivtag], _ = self.interp_atmo_constrained(
-                depth1[igd],
-                vect1[igd],
-                err1[igd],
-                ipar,
-                x2=depth2,
-                y2=vect2,
-                y1=vect1,
-                ndep=ngd,
-                constraints=constraints,
-            )
+        # The shift parameters only depend on the pair of atmospheres
+        pars = None
+        if key is not None:
+            key = (key, interpvar, itop)
+            pars = self.pair_cache.get(key)
+
+        if pars is None:
+            # Loop through atmosphere vectors.
+            pars = np.zeros((nvtag, npar))
+            for ivtag, vtag in enumerate(vtags):
+
+                # Find vector in each structure.
+                if vtag not in tags1:
+                    raise AtmosphereError("atmo1 does not contain " + vtag)
+                if vtag not in tags2:
+                    raise AtmosphereError("atmo2 does not contain " + vtag)
+
+                vect1 = np.log10(atmo1[vtag][mask1])
+                vect2 = np.log10(atmo2[vtag][mask2])
+
+                # Fit the second atmosphere onto the first by finding the best horizontal
+                # shift in depth2 and the best vertical shift in vect2.
+                pars[ivtag], _ = self.interp_atmo_constrained(
+                    depth1[igd],
+                    vect1[igd],
+                    err1[igd],
+                    ipar,
+                    x2=depth2,
+                    y2=vect2,
+                    y1=vect1,
+                    ndep=ngd,
+                    constraints=constraints,
+                )
+
+                # After first pass ('TEMP'), adjust initial guess and restrict depth points.
+                if ivtag == 0:
+                    ipar = [pars[0, 0], 0.0, 0.0, 0.0]
+                    igd = np.where(
+                        (depth1 >= min(depth2[igd]) + ipar[0])
+                        & (depth1 <= max(depth2[igd]) + ipar[0])
+                    )[0]
+                    if igd.size < 2:
+                        raise AtmosphereError("unstable shift in temperature")
+            if key is not None:
+                self.pair_cache.put(key, pars)
+
+        return {
+            "interpvar": interpvar,
+            "vtags": vtags,
+            "tags1": tags1,
+            "tags2": tags2,
+            "mask1": mask1,
+            "mask2": mask2,
+            "depth1": depth1,
+            "depth2": depth2,
+            "vect1": [np.log10(atmo1[vtag][mask1]) for vtag in vtags],
+            "vect2": [np.log10(atmo2[vtag][mask2]) for vtag in vtags],
+            "pars": pars,
+        }
+
+    def shift_atmo_pair(self, shift, frac):
+        """
+        Interpolate the atmosphere vectors of a pair of models, after shifting
+        them according to fit_atmo_pair. These are steps 2) and 3) of interp_atmo_pair.
+
+        All fractions are interpolated at once.
+
+        Parameters
+        ----------
+        shift : dict
+            shift parameters of the pair, as returned by fit_atmo_pair
+        frac : float, array of shape (nfrac,)
+            interpolation fraction(s): 0.0 -> atmo1 and 1.0 -> atmo2
 
-            # After first pass ('TEMP'), adjust initial guess and restrict depth points.
-            if ivtag == 0:
-                ipar = [pars[0, 0], 0.0, 0.0, 0.0]
-                igd = np.where(
-                    (depth1 >= min(depth2[igd]) + ipar[0])
-                    & (depth1 <= max(depth2[igd]) + ipar[0])
-                )[0]
-                if igd.size < 2:
-                    raise AtmosphereError("unstable shift in temperature")
+        Returns
+        -------
+        vects : array of shape (nvtag, ndep) or (nfrac, nvtag, ndep)
+            log10 of the interpolated atmosphere vectors, in the order of shift["vtags"]
+        """
+        scalar = np.ndim(frac) == 0
+        frac = np.atleast_1d(np.asarray(frac, dtype=float))[:, None]
+        vtags, pars = shift["vtags"], shift["pars"]
+        depth1, depth2 = shift["depth1"], shift["depth2"]
+        ndep1, ndep2 = depth1.size, depth2.size
+        nvtag = len(vtags)
 
         ##
         ## Use mean shift to construct output depth scale.
@@ -369,44 +767,78 @@ class AtmosphereInterpolator:
             depth = depth1f * (1 - frac) + depth2f * frac
         elif ndep1 < ndep2:
             depth = depth1f
-        ndep = len(depth)
+        ndep = depth.shape[1]
 
         ##
         ## Interpolate input atmosphere vectors onto output depth scale.
         ##
 
         # Loop through atmosphere vectors.
-        vects = np.zeros((nvtag, ndep))
+        vects = np.zeros((frac.shape[0], nvtag, ndep))
         for ivtag, (vtag, par) in enumerate(zip(vtags, pars)):
 
             # Extract data
-            vect1 = np.log10(atmo1[vtag][mask1])
-            vect2 = np.log10(atmo2[vtag][mask2])
+            vect1 = shift["vect1"][ivtag]
+            vect2 = shift["vect2"][ivtag]
 
             # Identify output depth points that require extrapolation of atmosphere vector.
             depth1f = depth1 - par[0] * frac
             depth2f = depth2 + par[0] * (1 - frac)
-            x1max = np.max(depth1f)
-            x2max = np.max(depth2f)
+            x1max = np.max(depth1f, axis=1, keepdims=True)
+            x2max = np.max(depth2f, axis=1, keepdims=True)
             iup = (depth > x1max) | (depth > x2max)
-            nup = np.count_nonzero(iup)
-            checkup = (nup >= 1) and abs(frac - 0.5) <= 0.5 and ndep1 == ndep2
+            nup = np.count_nonzero(iup, axis=1)
+            checkup = (nup >= 1) & (np.abs(frac[:, 0] - 0.5) <= 0.5) & (ndep1 == ndep2)
 
             # Combine shifted vect1 and vect2 structures to get output vect.
             vect1f = self.interp_atmo_func(depth, -frac * par, x2=depth1, y2=vect1)
             vect2f = self.interp_atmo_func(depth, (1 - frac) * par, x2=depth2, y2=vect2)
             vect = (1 - frac) * vect1f + frac * vect2f
-            ends = [vect1[ndep1 - 1], vect[ndep - 1], vect2[ndep2 - 1]]
-            if (
+            ends = np.stack(
+                np.broadcast_arrays(vect1[ndep1 - 1], vect[:, ndep - 1], vect2[ndep2 - 1])
+            )
+            replace = (
                 checkup
-                and np.median(ends) != vect[ndep - 1]
-                and (
-                    abs(vect1[ndep1 - 1] - 4.2) < 0.1
-                    or abs(vect2[ndep2 - 1] - 4.2) < 0.1
+                & (np.median(ends, axis=0) != vect[:, ndep - 1])
+                & (
+                    (abs(vect1[ndep1 - 1] - 4.2) < 0.1)
+                    | (abs(vect2[ndep2 - 1] - 4.2) < 0.1)
                 )
-            ):
-                vect[iup] = vect2f[iup] if x1max < x2max else vect1f[iup]
-            vects[ivtag] = vect
+            )
+            replace = replace[:, None] & iup
+            vect = np.where(replace, np.where(x1max < x2max, vect2f, vect1f), vect)
+            vects[:, ivtag] = vect
+
+        if scalar:
+            vects = vects[0]
+        return vects
+
+    def create_atmo_pair(self, atmo1, atmo2, frac, shift, vects):
+        """
+        Create the interpolated atmosphere from the interpolated atmosphere vectors
+
+        Parameters
+        ----------
+        atmo1 : Atmosphere
+            first atmosphere to interpolate
+        atmo2 : Atmosphere
+            second atmosphere to interpolate
+        frac : float
+            interpolation fraction: 0.0 -> atmo1 and 1.0 -> atmo2
+        shift : dict
+            shift parameters of the pair, see fit_atmo_pair
+        vects : array of shape (nvtag, ndep)
+            interpolated atmosphere vectors, see shift_atmo_pair
+
+        Returns
+        -------
+        atmo : Atmosphere
+            interpolated atmosphere
+        """
+        interpvar, vtags = shift["interpvar"], shift["vtags"]
+        tags1, tags2 = shift["tags1"], shift["tags2"]
+        nvtag = len(vtags)
+        ndep = vects.shape[-1]
 
         ##
         ## Construct output structure
@@ -415,7 +847,7 @@ class AtmosphereInterpolator:
         # Construct output structure with interpolated atmosphere.
         # Might be wise to interpolate abundances, in case those ever change.
         atmo = Atmo(interp=interpvar)
-        stags = ["teff", "logg", "monh", "vturb", "lonh", "abund"]
+        stags = ["teff", "logg", "monh", "vturb", "lonh"]
         ndep_orig = len(atmo1.temp)
         for tag in tags1:
 
@@ -441,8 +873,9 @@ class AtmosphereInterpolator:
                 value = ndep
 
             # Abundances
+            # The arithmetic of Abund works in place, so use copies
             if tag == "abund":
-                value = (1 - frac) * atmo1[tag] + frac * atmo2[tag]
+                value = (1 - frac) * copy(atmo1[tag]) + frac * copy(atmo2[tag])
 
             # Create or add to output structure.
             atmo[tag] = value
@@ -574,14 +1007,15 @@ class AtmosphereInterpolator:
         """
 
         nb = 2  # number of bracket points
+        index = self.get_grid_index(atmo_grid)
 
         # *** DETERMINATION OF METALICITY BRACKET ***
         # Find unique set of [M/H] values in grid.
-        mlist = np.unique(atmo_grid.monh)  # list of unique [M/H]
+        mlist = index.monh  # list of unique [M/H]
 
         # Test whether requested metalicity is in grid.
-        mmin = np.min(mlist)  # range of [M/H] in grid
-        mmax = np.max(mlist)
+        mmin = mlist[0]  # range of [M/H] in grid
+        mmax = mlist[-1]
         if monh > mmax:  # true: [M/H] too large
             logger.info(
                 "interp_atmo_grid: requested [M/H] (%.3f) larger than max grid value (%.3f). extrapolating.",
@@ -596,11 +1030,10 @@ class AtmosphereInterpolator:
 
         # Find closest two [M/H] values in grid that bracket requested [M/H].
         if monh <= mmax:
-            mlo = np.max(mlist[mlist <= monh])
-            mup = np.min(mlist[mlist >= monh])
+            mlo, mup = index.bracket(mlist, monh)
         else:
             mup = mmax
-            mlo = np.max(mlist[mlist < mup])
+            mlo = mlist[-2]
         mb = [mlo, mup]  # bounding [M/H] values
 
         # Trace diagnostics.
@@ -609,15 +1042,14 @@ class AtmosphereInterpolator:
 
         # *** DETERMINATION OF LOG(G) BRACKETS AT [M/H] BRACKET VALUES ***
         # Set up for loop through [M/H] bounds.
-        gb = np.zeros((nb, nb))  # bounding gravities
+        gb = [[None, None], [None, None]]  # bounding gravities
         for i in range(nb):
             # Find unique set of gravities at boundary below [M/H] value.
-            im = atmo_grid.monh == mb[i]  # models on [M/H] boundary
-            glist = np.unique(atmo_grid[im].logg)  # list of unique gravities
+            glist = index.logg[mb[i]]  # list of unique gravities
 
             # Test whether requested logarithmic gravity is in grid.
-            gmin = np.min(glist)  # range of gravities in grid
-            gmax = np.max(glist)
+            gmin = glist[0]  # range of gravities in grid
+            gmax = glist[-1]
             if logg > gmax:  # true: logg too large
                 logger.info(
                     "interp_atmo_grid: requested log(g) (%.3f) larger than max grid value (%.3f). extrapolating.",
@@ -633,11 +1065,10 @@ class AtmosphereInterpolator:
 
             # Find closest two gravities in Mlo subgrid that bracket requested gravity.
             if logg <= gmax:
-                glo = np.max(glist[glist <= logg])
-                gup = np.min(glist[glist >= logg])
+                glo, gup = index.bracket(glist, logg)
             else:
                 gup = gmax
-                glo = np.max(glist[glist < gup])
+                glo = glist[-2]
             gb[i] = [glo, gup]  # store boundary values.
 
             # Trace diagnostics.
@@ -649,18 +1080,17 @@ class AtmosphereInterpolator:
         # End of loop through [M/H] bracket values.
         # *** DETERMINATION OF TEFF BRACKETS AT [M/H] and LOG(G) BRACKET VALUES ***
         # Set up for loop through [M/H] and log(g) bounds.
-        tb = np.zeros((nb, nb, nb))  # bounding temperatures
+        # Also find and save atmo_grid indices for the 8 corner models.
+        icor = np.zeros((nb, nb, nb), dtype=int)
         for ig in range(nb):
             for im in range(nb):
-                # Find unique set of gravities at boundary below [M/H] value.
-                it = (atmo_grid.monh == mb[im]) & (
-                    atmo_grid.logg == gb[im, ig]
-                )  # models on joint boundary
-                tlist = np.unique(atmo_grid[it].teff)  # list of unique temperatures
+                # Find unique set of temperatures at the joint boundary
+                key = (mb[im], gb[im][ig])
+                tlist = index.teff[key]  # list of unique temperatures
 
                 # Test whether requested temperature is in grid.
-                tmin = np.min(tlist)  # range of temperatures in grid
-                tmax = np.max(tlist)
+                tmin = tlist[0]  # range of temperatures in grid
+                tmax = tlist[-1]
                 if teff > tmax:  # true: Teff too large
                     raise AtmosphereError(
                         "interp_atmo_grid: requested Teff (%i) larger than max grid value (%i). returning."
@@ -675,44 +1105,34 @@ class AtmosphereInterpolator:
 
                 # Find closest two temperatures in subgrid that bracket requested Teff.
                 if teff > tmin:
-                    tlo = np.max(tlist[tlist <= teff])
-                    tup = np.min(tlist[tlist >= teff])
+                    tlo, tup = index.bracket(tlist, teff)
                 else:
                     tlo = tmin
-                    tup = np.min(tlist[tlist > tlo])
-                tb[im, ig, :] = [tlo, tup]  # store boundary values.
+                    tup = tlist[1]
 
                 # Trace diagnostics.
                 if self.verbose >= 5:
                     logger.info(
                         "Teff at log(g)=%.3f and [M/H]=%.3f: %i < %i < %i",
-                        gb[im, ig],
+                        gb[im][ig],
                         mb[im],
                         tlo,
                         teff,
                         tup,
                     )
 
-        # End of loop through log(g) and [M/H] bracket values.
-
-        # Find and save atmo_grid indices for the 8 corner models.
-        icor = np.zeros((nb, nb, nb), dtype=int)
-        for it, ig, im in itertools.product(range(nb), repeat=3):
-            iwhr = np.where(
-                (atmo_grid.teff == tb[im, ig, it])
-                & (atmo_grid.logg == gb[im, ig])
-                & (atmo_grid.monh == mb[im])
-            )[0]
-            nwhr = iwhr.size
-            if nwhr != 1:
-                logger.info(
-                    "interp_atmo_grid: %i models in grid with [M/H]=%.1f, log(g)=%.1f, and Teff=%i",
-                    nwhr,
-                    mb[im],
-                    gb[im, ig],
-                    tb[im, ig, it],
-                )
-            icor[im, ig, it] = iwhr[0]
+                for it, t in enumerate([tlo, tup]):
+                    i = np.searchsorted(tlist, t)
+                    nwhr = index.counts[key][i]
+                    if nwhr != 1:
+                        logger.info(
+                            "interp_atmo_grid: %i models in grid with [M/H]=%.1f, log(g)=%.1f, and Teff=%i",
+                            nwhr,
+                            mb[im],
+                            gb[im][ig],
+                            t,
+                        )
+                    icor[im, ig, it] = index.rows[key][i]
 
         # Trace diagnostics.
         if self.verbose >= 1:
@@ -778,29 +1198,48 @@ class AtmosphereInterpolator:
             Interpolated atmosphere
         """
 
+        # Models are identified by their index in the grid, or for interpolated
+        # models, by the models and fraction they were interpolated from.
+        # Then the shift parameters of each pair can be cached.
+        # Grids without a source can not be told apart, and are not cached.
+        if atmo_grid.source:
+            grid_key = (atmo_grid.source, self.geom, atmo_grid.size)
+        else:
+            grid_key = None
+
         # We do this for every pair of atmosphere models
-        def interpolate(m0, m1, p, param, **kwargs):
+        def interpolate(m0, m1, p, param, key, **kwargs):
             p0 = getattr(m0, param)
             p1 = getattr(m1, param)
             pfrac = (p - p0) / (p1 - p0) if p0 != p1 else 0
-            return self.interp_atmo_pair(m0, m1, pfrac, interpvar=interp, **kwargs)
+            if grid_key is None:
+                key = None
+            atmo = self.interp_atmo_pair(
+                m0, m1, pfrac, interpvar=interp, key=key, **kwargs
+            )
+            return atmo, (key, quantize(pfrac))
 
         # Interpolate 8 corner models to create 4 models at the desired [M/H].
         atmo = [[None, None], [None, None]]
+        keys = [[None, None], [None, None]]
         for (i, j) in np.ndindex(2, 2):
             m0 = atmo_grid[icor[0, j, i]]
             m1 = atmo_grid[icor[1, j, i]]
-            atmo[i][j] = interpolate(m0, m1, monh, "monh", itop=itop)
+            key = (grid_key, icor[0, j, i], icor[1, j, i])
+            atmo[i][j], keys[i][j] = interpolate(m0, m1, monh, "monh", key, itop=itop)
 
         # Interpolate 4 models at the desired [M/H] to create 2 models at desired
         # [M/H] and log(g).
         atmo2 = [None, None]
+        keys2 = [None, None]
         for k in range(2):
-            atmo2[k] = interpolate(atmo[k][0], atmo[k][1], logg, "logg")
+            atmo2[k], keys2[k] = interpolate(
+                atmo[k][0], atmo[k][1], logg, "logg", (keys[k][0], keys[k][1])
+            )
 
         # Interpolate the 2 models at desired [M/H] and log(g) to create final
         # model at desired [M/H], log(g), and Teff
-        atmo3 = interpolate(atmo2[0], atmo2[1], teff, "teff")
+        atmo3, _ = interpolate(atmo2[0], atmo2[1], teff, "teff", tuple(keys2))
 
         return atmo3
 
@@ -901,10 +1340,10 @@ class AtmosphereInterpolator:
 
         Parameters
         ---------
-        x1 : array[ndep1]
+        x1 : array[..., ndep1]
             independent variable for output function
-        par : array[3]
-            shift parameters
+        par : array[..., 3]
+            shift parameters, the leading dimensions are broadcast against x1
             par[0] - horizontal shift for x2
             par[1] - vertical shift for y2
             par[2] - vertical scale factor for y2
@@ -927,29 +1366,75 @@ class AtmosphereInterpolator:
         # Constrained fits may append non-atmospheric quantities to the end of
         # input vector.
         # Extract the output depth scale:
+        x1 = np.asarray(x1)
+        par = np.asarray(par)
         if ndep is None:
-            ndep = len(x1)
+            ndep = x1.shape[-1]
 
         # Shift input x-values.
         # Interpolate input y-values onto output x-values.
         # Shift output y-values.
-        x2sh = x2 + par[0]
-        y2sh = y2 + par[1]
-        y = np.zeros_like(x1)
-        y[:ndep] = interp1d(x2sh, y2sh, kind="linear", fill_value="extrapolate")(
-            x1[:ndep]
-        )  # Note, this implicitly extrapolates
+        x2sh = x2 + par[..., 0, None]
+        y2sh = y2 + par[..., 1, None]
+        # Same as np.broadcast_shapes, which needs numpy 1.20
+        shape = np.broadcast(np.empty(x1.shape), np.empty(x2sh.shape[:-1] + (1,))).shape
+        y = np.zeros(shape)
+        # Note, this implicitly extrapolates
+        y[..., :ndep] = self.interp_linear(x1[..., :ndep], x2sh, y2sh)
 
         # Scale output y-values about output y-center.
-        ymin = np.min(y[:ndep])
-        ymax = np.max(y[:ndep])
+        ymin = np.min(y[..., :ndep], axis=-1, keepdims=True)
+        ymax = np.max(y[..., :ndep], axis=-1, keepdims=True)
         ycen = 0.5 * (ymin + ymax)
-        y[:ndep] = ycen + (1.0 + par[2]) * (y[:ndep] - ycen)
+        y[..., :ndep] = ycen + (1.0 + par[..., 2, None]) * (y[..., :ndep] - ycen)
 
         # If extra.y1 was passed, then clip minimum and maximum of output y1.
         if y1 is not None:
-            y[:ndep] = np.clip(y[:ndep], np.min(y1), np.max(y1))
+            y[..., :ndep] = np.clip(y[..., :ndep], np.min(y1), np.max(y1))
 
         # Set all leftover values to zero
-        y[ndep:] = 0
+        y[..., ndep:] = 0
         return y
+
+    @staticmethod
+    def interp_linear(x, xp, fp):
+        """
+        Linear interpolation, that extrapolates beyond the ends of xp
+        like interp1d(xp, fp, fill_value="extrapolate"), but works on
+        the last axis of stacked arrays
+
+        Parameters
+        ----------
+        x : array[..., n]
+            points to interpolate at
+        xp : array[..., m]
+            tabulated independent variable
+        fp : array[..., m]
+            tabulated dependent variable
+
+        Returns
+        -------
+        y : array[..., n]
+            interpolated values
+        """
+        # Same as np.broadcast_shapes, which needs numpy 1.20
+        shape = np.broadcast(
+            np.empty(x.shape[:-1]), np.empty(xp.shape[:-1]), np.empty(fp.shape[:-1])
+        ).shape
+        x = np.broadcast_to(x, shape + x.shape[-1:])
+        xp = np.broadcast_to(xp, shape + xp.shape[-1:])
+        fp = np.broadcast_to(fp, shape + fp.shape[-1:])
+
+        order = np.argsort(xp, axis=-1, kind="mergesort")
+        xp = np.take_along_axis(xp, order, axis=-1)
+        fp = np.take_along_axis(fp, order, axis=-1)
+
+        # Same as searchsorted on each row
+        i = np.sum(xp[..., None, :] < x[..., :, None], axis=-1)
+        i = np.clip(i, 1, xp.shape[-1] - 1)
+        x_lo = np.take_along_axis(xp, i - 1, axis=-1)
+        x_hi = np.take_along_axis(xp, i, axis=-1)
+        y_lo = np.take_along_axis(fp, i - 1, axis=-1)
+        y_hi = np.take_along_axis(fp, i, axis=-1)
+        slope = (y_hi - y_lo) / (x_hi - x_lo)
+        return slope * (x - x_lo) + y_lo
@@ -1,20 +1,65 @@
+import logging
+import os
+from os.path import basename, dirname, join
+
 from scipy.io import readsav
 import numpy as np
 
-from os.path import basename
-
 from .atmosphere import AtmosphereGrid
 
+logger = logging.getLogger(__name__)
+
 
 class SavFile(AtmosphereGrid):
-    """ IDL savefile atmosphere grid """
+    """ IDL savefile atmosphere grid
+
+    Parsing the save file is slow, so the grid is converted once into
+    the native format of AtmosphereGrid, in the hidden ".native" directory
+    next to the save file. Later loads memory map that file instead.
+    """
+
+    def __new__(cls, filename, native=True):
+        if native:
+            native_file = cls.get_native_filename(filename)
+            reference = cls.get_reference(filename)
+            try:
+                header, _ = cls.read_native_header(native_file)
+                if header["meta"].get("reference") == reference:
+                    return cls.load_native(native_file)
+                logger.info("Native atmosphere grid %s is outdated", native_file)
+            except (OSError, ValueError, KeyError):
+                pass
+
+        self = cls.read_savfile(filename)
+
+        if native:
+            try:
+                os.makedirs(dirname(native_file), exist_ok=True)
+                self.save_native(native_file, reference=reference)
+                logger.info("Saved atmosphere grid in native format to %s", native_file)
+            except OSError as ex:
+                logger.warning("Could not save the native atmosphere grid: %s", ex)
+        return self
+
+    @staticmethod
+    def get_native_filename(filename):
+        """ Name of the native version of the save file """
+        return join(dirname(filename), ".native", basename(filename) + ".grid")
+
+    @staticmethod
+    def get_reference(filename):
+        """ Identifies the version of the save file, to detect changes """
+        stat = os.stat(filename)
+        return [stat.st_size, stat.st_mtime_ns]
 
-    def __new__(cls, filename):
+    @classmethod
+    def read_savfile(cls, filename):
+        """ Parse the IDL save file """
         data = readsav(filename)
 
         npoints = data["atmo_grid_maxdep"]
         ngrids = data["atmo_grid_natmo"]
-        self = super(SavFile, cls).__new__(cls, ngrids, npoints)
+        self = AtmosphereGrid.__new__(cls, ngrids, npoints)
 
         filename = basename(filename)
         self.source = filename
@@ -1,11 +1,254 @@
 import logging
+from functools import wraps
 
 import numpy as np
 from scipy.interpolate import interp1d
 from scipy.ndimage.filters import convolve
+from scipy.signal import fftconvolve
+
+from .cache import LRUCache, fingerprint, quantize
 
 logger = logging.getLogger(__name__)
 
+#:LRUCache: cache for the broadening kernels, shared by all kernel types
+kernel_cache = LRUCache(maxsize=1024)
+
+# Kernels with more points than this are convolved using FFTs,
+# smaller ones with direct convolution (which is faster for those)
+FFT_KERNEL_SIZE = 50
+
+
+def convolve_rows(y, kernels, method="auto"):
+    """
+    Convolve each row of y with its own kernel
+
+    The result is the same as scipy.ndimage.convolve(y[i], kernels[i], mode="nearest")
+    for each row, but all rows are convolved at once with a batched FFT if the kernels are large.
+
+    Parameters
+    ----------
+    y : array of size (n, npoints)
+        rows to convolve
+    kernels : list of n arrays
+        convolution kernels for each row, each with an odd number of points
+    method : {"auto", "direct", "fft"}, optional
+        convolution method. "auto" uses FFTs if the largest kernel
+        has more than FFT_KERNEL_SIZE points (default: "auto")
+
+    Returns
+    -------
+    yout : array of size (n, npoints)
+        convolved rows
+    """
+    y = np.atleast_2d(y)
+    sizes = [np.size(k) for k in kernels]
+    if len(sizes) != y.shape[0]:
+        raise ValueError(
+            f"Expected {y.shape[0]} kernels, but got {len(sizes)} instead"
+        )
+    if any(size % 2 == 0 for size in sizes):
+        raise ValueError("Convolution kernels must have an odd number of points")
+
+    nk = max(sizes)
+    if method == "auto":
+        method = "fft" if nk > FFT_KERNEL_SIZE else "direct"
+
+    if method == "direct":
+        return np.stack(
+            [convolve(row, kern, mode="nearest") for row, kern in zip(y, kernels)]
+        )
+    elif method == "fft":
+        # Kernel bank, with all kernels centered in the same number of points
+        bank = np.zeros((len(kernels), nk))
+        for i, kern in enumerate(kernels):
+            offset = (nk - sizes[i]) // 2
+            bank[i, offset : offset + sizes[i]] = kern
+        # Pad the rows like mode="nearest"
+        nhalf = nk // 2
+        ypad = np.pad(y, ((0, 0), (nhalf, nhalf)), mode="edge")
+        return fftconvolve(ypad, bank, mode="valid", axes=1)
+    else:
+        raise ValueError(
+            f"Expected method to be one of ['auto', 'direct', 'fft'], but got {method} instead"
+        )
+
+
+def cached_kernel(func):
+    """
+    Cache the kernels created by func in kernel_cache
+
+    The cache key is made from the function name and its (quantized) arguments.
+    The cached kernels are read-only, since they are shared between calls.
+    """
+
+    @wraps(func)
+    def wrapper(*args):
+        key = (func.__name__,) + tuple(
+            fingerprint(a) if isinstance(a, np.ndarray) else quantize(a) for a in args
+        )
+        kernel = kernel_cache.get(key)
+        if kernel is None:
+            kernel = func(*args)
+            kernel.flags.writeable = False
+            kernel_cache.put(key, kernel)
+        return kernel
+
+    return wrapper
+
+
+@cached_kernel
+def rotation_kernel(vsini, r1, r2, dv):
+    """
+    Rotational broadening kernel of a single annulus of the stellar disk
+
+    The distribution has been derived analytically for annuli of arbitrary
+    thickness in a rigidly rotating star. The kernel is constructed in two pieces:
+    one piece for radial velocities less than the maximum velocity along the inner
+    edge of the annulus, and one piece for velocities greater than this limit.
+
+    Parameters
+    ----------
+    vsini : float
+        maximum radial velocity, due to solid-body rotation
+    r1 : float
+        inner edge of the annulus, in units of the stellar radius
+    r2 : float
+        outer edge of the annulus, in units of the stellar radius
+    dv : float
+        velocity spacing of the kernel points
+
+    Returns
+    -------
+    kernel : array of size (nrk,)
+        normalized kernel, or a delta function if it would only have 3 points
+    """
+    maxv = vsini * r2  # maximum velocity in annulus
+    nrk = 2 * int(maxv / dv) + 3  ## oversampled kernel point
+    if nrk <= 3:
+        # delta function, kernels with only 3 points are not used
+        return np.ones(1)
+
+    # velocity scale for kernel
+    v = dv * (np.arange(nrk, dtype=float) - ((nrk - 1) / 2))
+    rkern = np.zeros(nrk)  # init rotational kernel
+    j1 = np.abs(v) < vsini * r1  # low velocity points
+    rkern[j1] = np.sqrt((vsini * r2) ** 2 - v[j1] ** 2) - np.sqrt(
+        (vsini * r1) ** 2 - v[j1] ** 2
+    )  # generate distribution
+
+    j2 = (np.abs(v) >= vsini * r1) & (np.abs(v) <= vsini * r2)
+    rkern[j2] = np.sqrt((vsini * r2) ** 2 - v[j2] ** 2)  # generate distribution
+
+    rkern = rkern / np.sum(rkern)  # normalize kernel
+    return rkern
+
+
+@cached_kernel
+def macroturbulence_kernel(sigma, mu, nmk):
+    """
+    Radial-tangential macroturbulence kernel of a single annulus of the stellar disk
+
+    Parameters
+    ----------
+    sigma : float
+        standard deviation of the turbulent velocities, in kernel points
+    mu : float
+        cosine of the angle between the outward normal and the line of sight
+    nmk : int
+        half size of the kernel, the kernel has 2 * nmk + 1 points
+
+    Returns
+    -------
+    kernel : array of size (2 * nmk + 1,)
+        normalized kernel
+    """
+    # Calculate projected sigma for radial and tangential velocity distributions.
+    sigr = sigma * mu  # reduce by current mu value
+    sigt = sigma * np.sqrt(1.0 - mu ** 2)  # reduce by np.sqrt(1-mu**2)
+
+    # Construct radial macroturbulence kernel with a sigma of mu*VRT/np.sqrt(2).
+    if sigr > 0:
+        xarg = np.linspace(-nmk, nmk, 2 * nmk + 1) / sigr
+        xarg = np.clip(-0.5 * xarg ** 2, -20, None)
+        mrkern = np.exp(xarg)  # compute the gaussian
+        mrkern = mrkern / np.sum(mrkern)  # normalize the profile
+    else:
+        mrkern = np.zeros(2 * nmk + 1)  # init with 0d0
+        mrkern[nmk] = 1.0  # delta function
+
+    # Construct tangential kernel with a sigma of np.sqrt(1-mu**2)*VRT/np.sqrt(2).
+    if sigt > 0:
+        xarg = np.linspace(-nmk, nmk, 2 * nmk + 1) / sigt
+        xarg = np.clip(-0.5 * xarg ** 2, -20, None)
+        mtkern = np.exp(xarg)  # compute the gaussian
+        mtkern = mtkern / np.sum(mtkern)  # normalize the profile
+    else:
+        mtkern = np.zeros(2 * nmk + 1)  # init with 0d0
+        mtkern[nmk] = 1.0  # delta function
+
+    # Sum the radial and tangential components, weighted by surface area.
+    area_r = 0.5  # assume equal areas
+    area_t = 0.5  # ar+at must equal 1
+    mkern = area_r * mrkern + area_t * mtkern  # add both components
+    return mkern
+
+
+@cached_kernel
+def table_kernel(xip, yip):
+    """ Instrumental profile kernel from a table, see tablebroad """
+    # Define sizes
+    dsdh = np.abs(np.min(np.diff(xip)))
+    nip = 2 * int(15 / dsdh) + 1  ## profile points
+
+    # Generate instrumental profile on model pixel scale.
+    x = (
+        np.arange(nip, dtype=float) - (nip - 1) / 2
+    ) * dsdh  # offset in Hamilton pixels
+    ip = interp1d(xip, yip, kind="cubic")(x)
+    # ip = bezier_interp(xip, yip, x)  # spline onto new scale
+    ip = ip[::-1]  # reverse for convolution
+    ip = ip / np.sum(ip)  # ensure unit area
+    return ip
+
+
+@cached_kernel
+def gauss_kernel(hwhm, dw):
+    """ Gaussian kernel with half width at half maximum hwhm, see gaussbroad """
+    # Make smoothing gaussian# extend to 4 sigma.
+    # 4.0 / sqrt(2.0*alog(2.0)) = 3.3972872 and sqrt(alog(2.0))=0.83255461
+    # sqrt(alog(2.0)/pi)=0.46971864 (*1.0000632 to correct for >4 sigma wings)
+    nhalf = int(3.3972872 * hwhm / dw)  ## points in half gaussian
+    ng = 2 * nhalf + 1  ## points in gaussian (odd!)
+    wg = dw * (
+        np.arange(ng, dtype=float) - (ng - 1) / 2
+    )  # wavelength scale of gaussian
+    xg = (0.83255461 / hwhm) * wg  # convenient absisca
+    gpro = (0.46974832 * dw / hwhm) * np.exp(-xg * xg)  # unit area gaussian w/ FWHM
+    gpro = gpro / np.sum(gpro)
+    return gpro
+
+
+@cached_kernel
+def sinc_kernel(hwhm, dw):
+    """ Sinc kernel with half width at half maximum hwhm, see sincbroad """
+    # Make sinc function out to 20th zero-crossing on either side. Error due to
+    # ignoring additional lobes is less than 0.2% of continuum. Reducing extent
+    # to 10th zero-crossing doubles maximum error.
+    fwhm = 2.0 * hwhm  # full width at half maximum
+    rperfw = 0.26525  # radians per fwhm of sinc
+    xrange = 20 * np.pi  # 20th zero of sinc (radians)
+    wrange = xrange * fwhm * rperfw  # 20th zero of sinc (wavelength)
+    nhalf = int(wrange / dw + 0.999)  ## points in half sinc
+    nsinc = 2 * nhalf + 1  ## points in sinc (odd!)
+    wsinc = (np.arange(nsinc, dtype=float) - nhalf) * dw  # absissca (wavelength)
+    xsinc = wsinc / (fwhm * rperfw)  # absissca (radians)
+    xsinc[nhalf] = 1.0  # avoid divide by zero
+    sinc = np.sin(xsinc) / xsinc  # calculate sinc
+    sinc[nhalf] = 1.0  # insert midpoint
+    xsinc[nhalf] = 0.0  # fix xsinc
+    sinc = sinc / np.sum(sinc)  # normalize sinc
+    return sinc
+
 
 def apply_broadening(ipres, x_seg, y_seg, type="gauss", sme=None):
     """
@@ -97,21 +340,10 @@ def tablebroad(w, s, xip, yip):
             Python version
     """
 
-    # Define sizes
-    dsdh = np.abs(np.min(np.diff(xip)))
-    nip = 2 * int(15 / dsdh) + 1  ## profile points
-
-    # Generate instrumental profile on model pixel scale.
-    x = (
-        np.arange(nip, dtype=float) - (nip - 1) / 2
-    ) * dsdh  # offset in Hamilton pixels
-    ip = interp1d(xip, yip, kind="cubic")(x)
-    # ip = bezier_interp(xip, yip, x)  # spline onto new scale
-    ip = ip[::-1]  # reverse for convolution
-    ip = ip / np.sum(ip)  # ensure unit area
+    ip = table_kernel(np.asarray(xip, dtype=float), np.asarray(yip, dtype=float))
 
     # Pad spectrum ends to minimize impact of Fourier ringing.
-    sout = convolve(s, ip, mode="nearest")
+    sout = convolve_rows(s, [ip])[0]
 
     return sout  # return convolved spectrum
 
@@ -162,22 +394,12 @@ def gaussbroad(w, s, hwhm):
     wrange = w[-1] - w[0]
     dw = wrange / (nw - 1)  # wavelength change per pixel
 
-    # Make smoothing gaussian# extend to 4 sigma.
-    # 4.0 / sqrt(2.0*alog(2.0)) = 3.3972872 and sqrt(alog(2.0))=0.83255461
-    # sqrt(alog(2.0)/pi)=0.46971864 (*1.0000632 to correct for >4 sigma wings)
     if hwhm >= 5 * wrange:
         return np.full(nw, np.sum(s) / nw)
-    nhalf = int(3.3972872 * hwhm / dw)  ## points in half gaussian
-    ng = 2 * nhalf + 1  ## points in gaussian (odd!)
-    wg = dw * (
-        np.arange(ng, dtype=float) - (ng - 1) / 2
-    )  # wavelength scale of gaussian
-    xg = (0.83255461 / hwhm) * wg  # convenient absisca
-    gpro = (0.46974832 * dw / hwhm) * np.exp(-xg * xg)  # unit area gaussian w/ FWHM
-    gpro = gpro / np.sum(gpro)
+    gpro = gauss_kernel(hwhm, dw)
 
     # Pad spectrum ends to minimize impact of Fourier ringing.
-    sout = convolve(s, gpro, mode="nearest")
+    sout = convolve_rows(s, [gpro])[0]
 
     return sout
 
@@ -232,24 +454,9 @@ def sincbroad(w, s, hwhm):
     nw = len(w)  ## points in spectrum
     dw = (w[-1] - w[0]) / (nw - 1)  # wavelength change per pixel
 
-    # Make sinc function out to 20th zero-crossing on either side. Error due to
-    # ignoring additional lobes is less than 0.2% of continuum. Reducing extent
-    # to 10th zero-crossing doubles maximum error.
-    fwhm = 2.0 * hwhm  # full width at half maximum
-    rperfw = 0.26525  # radians per fwhm of sinc
-    xrange = 20 * np.pi  # 20th zero of sinc (radians)
-    wrange = xrange * fwhm * rperfw  # 20th zero of sinc (wavelength)
-    nhalf = int(wrange / dw + 0.999)  ## points in half sinc
-    nsinc = 2 * nhalf + 1  ## points in sinc (odd!)
-    wsinc = (np.arange(nsinc, dtype=float) - nhalf) * dw  # absissca (wavelength)
-    xsinc = wsinc / (fwhm * rperfw)  # absissca (radians)
-    xsinc[nhalf] = 1.0  # avoid divide by zero
-    sinc = np.sin(xsinc) / xsinc  # calculate sinc
-    sinc[nhalf] = 1.0  # insert midpoint
-    xsinc[nhalf] = 0.0  # fix xsinc
-    sinc = sinc / np.sum(sinc)  # normalize sinc
+    sinc = sinc_kernel(hwhm, dw)
 
     # Pad spectrum ends to minimize impact of Fourier ringing.
-    sout = convolve(s, sinc, mode="nearest")
+    sout = convolve_rows(s, [sinc])[0]
 
     return sout
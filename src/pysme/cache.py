@@ -0,0 +1,345 @@
+"""
+Helpers for caching intermediary results of the synthesis
+"""
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+import zipfile
+from collections import OrderedDict
+from os.path import join
+
+import numpy as np
+from pandas.util import hash_pandas_object
+
+from .abund import Abund
+from .data_structure import Collection
+from .linelist.linelist import LineList
+
+logger = logging.getLogger(__name__)
+
+
+def _update_digest(digest, value):
+    """ Add the canonical byte representation of value to the digest """
+    if value is None:
+        digest.update(b"N")
+    elif isinstance(value, np.ndarray):
+        if value.dtype.hasobject:
+            value = value.astype(str)
+        digest.update(f"A{value.dtype.str}{value.shape}".encode())
+        digest.update(np.ascontiguousarray(value).tobytes())
+    elif isinstance(value, (list, tuple)):
+        digest.update(b"(")
+        for v in value:
+            _update_digest(digest, v)
+        digest.update(b")")
+    elif isinstance(value, dict):
+        digest.update(b"{")
+        for k in sorted(value.keys(), key=str):
+            _update_digest(digest, k)
+            _update_digest(digest, value[k])
+        digest.update(b"}")
+    elif isinstance(value, LineList):
+        digest.update(f"L{linelist_fingerprint(value)}".encode())
+    elif isinstance(value, Abund):
+        digest.update(f"B{value.monh!r}".encode())
+        _update_digest(digest, value.get_pattern("sme", raw=True))
+    elif isinstance(value, Collection):
+        digest.update(f"C{value.__class__.__name__}".encode())
+        for name in value._names:
+            if name == "citation_info":
+                continue
+            _update_digest(digest, name)
+            _update_digest(digest, value[name])
+    elif isinstance(value, (np.generic, float, int, str, bool)):
+        digest.update(f"S{value!r}".encode())
+    else:
+        digest.update(f"O{value!r}".encode())
+
+
+def fingerprint(*values):
+    """
+    Create a canonical fingerprint of the given values
+
+    Two sets of values have the same fingerprint if and only if
+    they are equal (up to hash collisions). Supported are numbers,
+    strings, numpy arrays, lists, dicts, as well as LineList, Abund,
+    and Collection (e.g. Atmosphere) objects.
+
+    Parameters
+    ----------
+    *values
+        the values to include in the fingerprint
+
+    Returns
+    -------
+    fingerprint : str
+        hexadecimal digest of the values
+    """
+    digest = hashlib.sha1()
+    for value in values:
+        _update_digest(digest, value)
+    return digest.hexdigest()
+
+
+def linelist_fingerprint(linelist):
+    """
+    Fingerprint of the data of a linelist
+
+    Hashing a large linelist is slow, so the fingerprint is stored in the
+    linelist, and reused until the linelist is modified (see LineList.mark_modified).
+
+    Parameters
+    ----------
+    linelist : LineList
+        the linelist
+
+    Returns
+    -------
+    fingerprint : str
+        hexadecimal digest of the linelist
+    """
+    version = getattr(linelist, "_version", 0)
+    cached = getattr(linelist, "_fingerprint", None)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    digest = hashlib.sha1()
+    digest.update(f"L{linelist.lineformat}{len(linelist)}".encode())
+    if len(linelist) > 0:
+        _update_digest(digest, hash_pandas_object(linelist._lines, index=False).values)
+    result = digest.hexdigest()
+    linelist._fingerprint = (version, result)
+    return result
+
+
+def quantize(value, digits=10):
+    """
+    Round a value to a number of significant digits, for use in cache keys
+
+    Parameters
+    ----------
+    value : float
+        value to round
+    digits : int, optional
+        number of significant digits to keep (default: 10)
+
+    Returns
+    -------
+    value : float
+        the rounded value
+    """
+    value = float(value)
+    if value == 0 or not np.isfinite(value):
+        return value
+    return round(value, digits - 1 - int(np.floor(np.log10(abs(value)))))
+
+
+class LRUCache:
+    """
+    Dictionary like cache, that only keeps the maxsize least recently used entries
+
+    It also counts the number of hits and misses.
+    Access is thread safe.
+    """
+
+    def __init__(self, maxsize=128):
+        #:int: maximum number of entries in the cache
+        self.maxsize = maxsize
+        #:int: number of successful lookups
+        self.hits = 0
+        #:int: number of failed lookups
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    @property
+    def hit_ratio(self):
+        """float: fraction of lookups that were successful """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get(self, key, default=None):
+        """ Return the entry for key, or default if there is none """
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """ Add an entry, removing the least recently used ones if necessary """
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        """ Remove all entries and reset the counters """
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        """ Return the size, hits, misses, and hit ratio of the cache """
+        return {
+            "size": len(self),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+        }
+
+
+class SpectrumCache:
+    """
+    Cache of complete synthetic spectra, in memory and optionally on disk
+
+    Each entry is a dictionary of numpy arrays, stored under a fingerprint
+    of all parameters that determine it (see Synthesizer.get_spectrum_key).
+    Recently used entries are kept in memory, while all entries are also
+    stored as one .npz file per entry in the cache directory, if one is given.
+    That way they are available for later sessions as well.
+    """
+
+    def __init__(self, maxsize=128, directory=None):
+        #:LRUCache: entries in memory
+        self.memory = LRUCache(maxsize=maxsize)
+        #:str: directory of the entries on disk, or None to only use memory
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        #:int: number of successful lookups
+        self.hits = 0
+        #:int: number of successful lookups that had to read from disk
+        self.disk_hits = 0
+        #:int: number of failed lookups
+        self.misses = 0
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.memory)
+
+    @property
+    def hit_ratio(self):
+        """float: fraction of lookups that were successful """
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def filename(self, key):
+        """ Return the filename of the entry for key on disk """
+        return join(self.directory, f"{key}.npz")
+
+    def _load(self, key):
+        if self.directory is None:
+            return None
+        fname = self.filename(key)
+        if not os.path.exists(fname):
+            return None
+        try:
+            with np.load(fname, allow_pickle=False) as data:
+                return {k: data[k] for k in data.files}
+        except (OSError, ValueError, zipfile.BadZipFile):
+            logger.warning("Ignoring corrupted spectrum cache file %s", fname)
+            return None
+
+    def _save(self, key, value):
+        if self.directory is None:
+            return
+        # Write to a temporary file first, so that other processes
+        # never see an incomplete entry
+        fd, tmpname = tempfile.mkstemp(suffix=".npz.tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **value)
+            os.replace(tmpname, self.filename(key))
+        except OSError:
+            logger.warning("Could not write to the spectrum cache in %s", self.directory)
+            if os.path.exists(tmpname):
+                os.remove(tmpname)
+
+    def get(self, key):
+        """
+        Return a copy of the entry for key, or None if there is none
+
+        Parameters
+        ----------
+        key : str
+            fingerprint of the entry
+
+        Returns
+        -------
+        value : dict or None
+            the arrays of the entry
+        """
+        with self._lock:
+            value = self.memory.get(key)
+            if value is None:
+                value = self._load(key)
+                if value is not None:
+                    self.memory.put(key, value)
+                    self.disk_hits += 1
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return {k: np.array(v) for k, v in value.items()}
+
+    def put(self, key, value):
+        """
+        Store a copy of the entry under key
+
+        Parameters
+        ----------
+        key : str
+            fingerprint of the entry
+        value : dict
+            the arrays of the entry
+        """
+        value = {k: np.array(v) for k, v in value.items()}
+        with self._lock:
+            self.memory.put(key, value)
+            self._save(key, value)
+
+    def clear(self, disk=False):
+        """
+        Remove all entries from memory and reset the counters
+
+        Parameters
+        ----------
+        disk : bool, optional
+            whether to also remove the entries on disk (default: False)
+        """
+        with self._lock:
+            self.memory.clear()
+            self.hits = 0
+            self.disk_hits = 0
+            self.misses = 0
+            if disk and self.directory is not None:
+                for fname in os.listdir(self.directory):
+                    if fname.endswith(".npz"):
+                        os.remove(join(self.directory, fname))
+
+    def stats(self):
+        """ Return the size, hits, misses, and hit ratio of the cache """
+        return {
+            "size": len(self),
+            "maxsize": self.memory.maxsize,
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "hit_ratio": self.hit_ratio,
+        }
@@ -5,27 +5,36 @@ and fit best radial velocity to observation
 
 import logging
 import warnings
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from itertools import product
 
 import emcee
 import numpy as np
 from scipy.constants import speed_of_light
+from scipy.fft import irfft, next_fast_len, rfft
 from scipy.linalg import lu_factor, lu_solve
 from scipy.ndimage.filters import median_filter
 from scipy.optimize import least_squares, minimize_scalar
-from scipy.signal import correlate, find_peaks
+from scipy.signal import find_peaks
 from tqdm import tqdm
 
 from . import util
+from .cache import fingerprint
 from .iliffe_vector import Iliffe_vector
 from .sme_synth import SME_DLL
 
 logger = logging.getLogger(__name__)
 
 c_light = speed_of_light * 1e-3  # speed of light in km/s
+# Half width in pixels of the radial velocity scan around the cross correlation
+# guess, see determine_rv_and_cont_profile
+RV_SCAN_PIXELS = 10
+# Fraction of the MCMC burn in that is still discarded,
+# when resuming from the walkers of a previous fit
+MCMC_RESUME_BURNIN = 0.1
 
 
-def determine_continuum(sme, segment):
+def determine_continuum(sme, segment, dll=None):
     """
     Fit a polynomial to the spectrum points marked as continuum
     The degree of the polynomial fit is determined by sme.cscale_flag
@@ -36,6 +45,8 @@ def determine_continuum(sme, segment):
         input sme structure with sme.sob, sme.wave, and sme.mask
     segment : int
         index of the wavelength segment to use, or -1 when dealing with the whole spectrum
+    dll : SME_DLL, optional
+        library used for the synthesis, see get_continuum_mask
 
     Returns
     -------
@@ -83,7 +94,7 @@ def determine_continuum(sme, segment):
                 "Using effective wavelength range of lines to find continuum instead",
                 segment,
             )
-            cont = get_continuum_mask(x, y, sme.linelist, mask=m)
+            cont = get_continuum_mask(x, y, sme.linelist, mask=m, dll=dll)
             # Save mask for next iteration
             m[cont == 2] = sme.mask_values["continuum"]
             logger.debug("Continuum mask points: %i", np.count_nonzero(cont == 2))
@@ -105,12 +116,16 @@ def determine_continuum(sme, segment):
     return cscale
 
 
-def get_continuum_mask(wave, synth, linelist, threshold=0.1, mask=None):
+def get_continuum_mask(wave, synth, linelist, threshold=0.1, mask=None, dll=None):
     """
     Use the effective wavelength range of the lines,
     to find wavelength points that should be unaffected by lines
     However one usually has to ignore the weak lines, as most points are affected by one line or another
-    Therefore keep increasing the threshold until enough lines have been found (>10%)
+    Therefore increase the threshold until enough points have been found (>10%)
+
+    The threshold is increased in steps of 10%, and the smallest sufficient
+    step is found by bisection. Each step counts the lines covering each point
+    with a single sweep over the sorted wavelengths.
 
     Parameters
     ----------
@@ -121,6 +136,13 @@ def get_continuum_mask(wave, synth, linelist, threshold=0.1, mask=None):
     threshold : float, optional
         starting threshold, lines with depth below this value are ignored
         the actual threshold is increased until enough points are found (default: 0.1)
+    mask : array of size (n,), optional
+        existing mask, points with value 0 are never used
+    dll : SME_DLL, optional
+        library that synthesized the spectrum, and therefore knows the line ranges.
+        It is only used if it holds the whole linelist, which is not the case
+        e.g. for linelist_mode "range" or "segment", or if the synthesis ran in
+        worker threads. Otherwise (and by default) a new SME_DLL is used.
 
     Returns
     -------
@@ -128,6 +150,11 @@ def get_continuum_mask(wave, synth, linelist, threshold=0.1, mask=None):
         True for points between lines and False for points within lines
     """
 
+    # The line ranges of the library refer to the lines in the library
+    if dll is None or dll.linelist is not linelist:
+        dll = SME_DLL()
+        dll.linelist = linelist
+
     if "depth" not in linelist.columns:
         raise ValueError(
             "No depth specified in the linelist, can't auto compute the mask"
@@ -139,23 +166,42 @@ def get_continuum_mask(wave, synth, linelist, threshold=0.1, mask=None):
     if mask is None:
         mask = np.full(len(wave), 1)
 
-    # TODO make this better
-    dll = SME_DLL()
-    dll.linelist = linelist
-
     width = dll.GetLineRange()
-
-    temp = False
-    while np.count_nonzero(temp) < len(wave) * 0.1:
-        temp = np.full(len(wave), True)
-        for i, line in enumerate(width):
-            if linelist["depth"][i] > threshold:
-                w = (wave >= line[0]) & (wave <= line[1])
-                temp[w] = False
-
-        # TODO: Good value to increase threshold by?
-        temp[mask == 0] = False
-        threshold *= 1.1
+    depth = np.asarray(linelist["depth"])
+
+    # Only lines that overlap with the wavelength range matter
+    select = (width[:, 1] >= wave[0]) & (width[:, 0] <= wave[-1])
+    width, depth = width[select], depth[select]
+    # The index range of the points covered by each line
+    start = np.searchsorted(wave, width[:, 0], side="left")
+    stop = np.searchsorted(wave, width[:, 1], side="right")
+    usable = mask != 0
+    required = len(wave) * 0.1
+
+    def continuum(threshold):
+        strong = depth > threshold
+        # Number of lines covering each point
+        coverage = np.bincount(start[strong], minlength=len(wave) + 1)
+        coverage -= np.bincount(stop[strong], minlength=len(wave) + 1)
+        coverage = np.cumsum(coverage[:-1])
+        return (coverage == 0) & usable
+
+    # Find the smallest number of steps, with enough continuum points
+    # Beyond the deepest line all usable points are continuum
+    nmax = 0
+    if depth.size > 0 and np.max(depth) > threshold:
+        nmax = int(np.ceil(np.log(np.max(depth) / threshold) / np.log(1.1)))
+    low, high = 0, nmax
+    temp = continuum(threshold)
+    if np.count_nonzero(temp) < required:
+        while high - low > 1:
+            middle = (low + high) // 2
+            if np.count_nonzero(continuum(threshold * 1.1 ** middle)) >= required:
+                high = middle
+            else:
+                low = middle
+        threshold *= 1.1 ** high
+        temp = continuum(threshold)
 
     mask[temp] = 2
 
@@ -163,6 +209,145 @@ def get_continuum_mask(wave, synth, linelist, threshold=0.1, mask=None):
     return mask
 
 
+def resample_log_wavelength(x, y, dlog, size):
+    """
+    Resample spectra onto grids with a constant step in log(wavelength)
+
+    On such a grid a radial velocity shift is a constant shift in pixels.
+    Each grid starts at the first wavelength of its spectrum.
+    The mean is subtracted, and the edges are tapered with a cosine window,
+    so the spectra can be cross correlated with FFTs.
+
+    Parameters
+    ----------
+    x : list(array)
+        wavelength of each spectrum
+    y : list(array)
+        intensity of each spectrum
+    dlog : float
+        step size in log(wavelength)
+    size : int
+        number of points of the output, longer grids are cut
+
+    Returns
+    -------
+    loglam : array of shape (nspec,)
+        log(wavelength) of the first point of each grid
+    flux : array of shape (nspec, size)
+        resampled spectra, zero padded beyond the end of each spectrum
+    """
+    nspec = len(x)
+    loglam = np.zeros(nspec)
+    flux = np.zeros((nspec, size))
+    for i in range(nspec):
+        logx = np.log(x[i])
+        loglam[i] = logx[0]
+        n = min(int((logx[-1] - logx[0]) / dlog) + 1, size)
+        grid = logx[0] + dlog * np.arange(n)
+        yi = np.interp(grid, logx, y[i])
+        yi -= np.mean(yi)
+        # Taper the outer 10 percent of the spectrum
+        taper = max(n // 10, 1)
+        window = np.ones(n)
+        window[:taper] = 0.5 - 0.5 * np.cos(np.pi * np.arange(taper) / taper)
+        window[n - taper :] = window[:taper][::-1]
+        flux[i, :n] = yi * window
+    return loglam, flux
+
+
+def cross_correlate_rv(x_obs, y_obs, x_syn, y_syn, rv_limit=None, combine=False):
+    """
+    Estimate the radial velocity of each segment by cross correlation
+
+    The observation and the model are resampled onto log(wavelength) grids
+    with a shared step size (see resample_log_wavelength), and all segments
+    are cross correlated at once with a batched FFT.
+    The position of the peak is refined to sub pixel accuracy,
+    with a parabola through the highest point and its neighbours.
+
+    Parameters
+    ----------
+    x_obs, y_obs : list(array)
+        wavelength and intensity of the observation in each segment,
+        only the good pixels
+    x_syn, y_syn : list(array)
+        wavelength and intensity of the synthetic spectrum in each segment
+    rv_limit : float, array, optional
+        maximum absolute radial velocity in km/s of each segment,
+        by default a quarter of the segment
+    combine : bool, optional
+        whether to determine one radial velocity for all segments (default: False)
+
+    Returns
+    -------
+    rvel : array of shape (nseg,)
+        radial velocity of each segment in km/s, or NaN if no peak was found
+        or the segment has less than 2 points
+    """
+    nseg = len(x_obs)
+    rvel = np.full(nseg, np.nan)
+    if rv_limit is not None:
+        rv_limit = np.broadcast_to(rv_limit, (nseg,))
+
+    # Segments with less than 2 points can not be resampled, skip them
+    usable = [i for i in range(nseg) if np.size(x_obs[i]) >= 2]
+    if len(usable) == 0:
+        return rvel
+    x_obs = [x_obs[i] for i in usable]
+    y_obs = [y_obs[i] for i in usable]
+    x_syn = [x_syn[i] for i in usable]
+    y_syn = [y_syn[i] for i in usable]
+    if rv_limit is not None:
+        rv_limit = rv_limit[usable]
+
+    # The step size is given by the (finest) sampling of the observation
+    dlog = min(np.median(np.diff(np.log(x))) for x in x_obs)
+    # The model is resampled onto the same grid as the observation
+    y_mod = [np.interp(x, xs, ys) for x, xs, ys in zip(x_obs, x_syn, y_syn)]
+
+    length = max(int((np.log(x[-1]) - np.log(x[0])) / dlog) + 1 for x in x_obs)
+    size = next_fast_len(2 * length)
+    _, fobs = resample_log_wavelength(x_obs, y_obs, dlog, size)
+    _, fmod = resample_log_wavelength(x_obs, y_mod, dlog, size)
+
+    # corr[k] is large, if obs(i) matches mod(i - k)
+    corr = irfft(rfft(fobs, axis=1) * np.conj(rfft(fmod, axis=1)), n=size, axis=1)
+    norm = np.sqrt(np.sum(fobs ** 2, axis=1) * np.sum(fmod ** 2, axis=1))
+    corr /= np.where(norm > 0, norm, 1)[:, None]
+    # Put the zero lag in the center
+    corr = np.roll(corr, size // 2, axis=1)
+    lags = np.arange(size) - size // 2
+
+    if rv_limit is None:
+        rv_limit = np.array([c_light * (x[-1] - x[0]) / x[0] / 4 for x in x_obs])
+    max_lag = np.arctanh(np.clip(rv_limit / c_light, 0, 0.5)) / dlog
+    corr[np.abs(lags)[None, :] > max_lag[:, None]] = -np.inf
+
+    if combine:
+        corr = np.sum(corr, axis=0, keepdims=True)
+
+    peaks = np.full(corr.shape[0], np.nan)
+    for i, row in enumerate(corr):
+        k = np.argmax(row)
+        if not np.isfinite(row[k]):
+            continue
+        shift = float(lags[k])
+        if 0 < k < size - 1 and np.all(np.isfinite(row[k - 1 : k + 2])):
+            # Sub pixel refinement with a parabola
+            a, b, c = row[k - 1 : k + 2]
+            denom = a - 2 * b + c
+            if denom < 0:
+                shift += 0.5 * (a - c) / denom
+        # log(x_obs / x_syn) = 0.5 * log((1 + v/c) / (1 - v/c))
+        peaks[i] = c_light * np.tanh(shift * dlog)
+
+    if combine:
+        rvel[:] = peaks[0]
+    else:
+        rvel[usable] = peaks
+    return rvel
+
+
 def determine_radial_velocity(sme, segment, cscale, x_syn, y_syn):
     """
     Calculate radial velocity by using cross correlation and
@@ -253,6 +438,15 @@ def determine_radial_velocity(sme, segment, cscale, x_syn, y_syn):
             for i in range(len(y_obs)):
                 y_obs[i] /= cont[i]
 
+            # The cross correlation works on each segment separately
+            line = [mask[i] == sme.mask_values["line"] for i in range(len(x_obs))]
+            xcorr = (
+                [x_obs[i][line[i]] for i in range(len(x_obs))],
+                [y_obs[i][line[i]] for i in range(len(y_obs))],
+                list(x_syn),
+                list(y_syn),
+            )
+
             x_obs = x_obs.ravel()
             y_obs = y_obs.ravel()
             u_obs = u_obs.ravel()
@@ -268,21 +462,15 @@ def determine_radial_velocity(sme, segment, cscale, x_syn, y_syn):
         x_obs = x_obs[mask]
         y_obs = y_obs[mask]
         u_obs = u_obs[mask]
-        y_tmp = np.interp(x_obs, x_syn, y_syn)
+        if sme.vrad_flag == "each":
+            xcorr = ([x_obs], [y_obs], [x_syn], [y_syn])
 
         rv_bounds = (-100, 100)
         if np.all(sme.vrad[segment] == 0):
             # Get a first rough estimate from cross correlation
-            # Subtract continuum level of 1, for better correlation
-            corr = correlate(
-                y_obs - np.median(y_obs), y_tmp - np.median(y_tmp), mode="same"
-            )
-            offset = np.argmax(corr)
-
-            x1 = x_obs[offset]
-            x2 = x_obs[len(x_obs) // 2]
-            rvel = c_light * (1 - x2 / x1)
-
+            rvel = cross_correlate_rv(*xcorr, rv_limit=rv_bounds[1], combine=True)[0]
+            if not np.isfinite(rvel):
+                rvel = 0
             rvel = np.clip(rvel, *rv_bounds)
         else:
             if sme.vrad_flag == "whole":
@@ -314,6 +502,35 @@ def null_result(nseg, ndeg=0):
     return vrad, vrad_unc, cscale, cscale_unc
 
 
+def get_mcmc_key(sme, segment):
+    """
+    Key of the MCMC walkers of a fit in sme.mcmc_walkers
+
+    Parameters
+    ----------
+    sme : SME_Struct
+        sme structure with the fit settings
+    segment : int, list(int)
+        the fitted segments
+
+    Returns
+    -------
+    key : str
+        the segments, the radial velocity and continuum flags,
+        and a fingerprint of the observation in these segments
+    """
+    if np.isscalar(segment):
+        segment = [segment]
+    # The walkers do not fit a different observation
+    observation = [
+        None if sme[name] is None else np.asarray(sme[name][s])
+        for name in ["spec", "uncs", "mask"]
+        for s in segment
+    ]
+    key = ",".join(str(s) for s in segment)
+    return f"{key}:{sme.vrad_flag}:{sme.cscale_flag}:{fingerprint(observation)}"
+
+
 def determine_rv_and_cont(sme, segment, x_syn, y_syn):
     """
     Fits both radial velocity and continuum level simultaneously
@@ -446,18 +663,21 @@ def determine_rv_and_cont(sme, segment, x_syn, y_syn):
         rv_limit = np.min(rv_limit)
 
     # Use Cross corellatiom as a first guess for the radial velocity
-    # This uses the median as the continuum
-    if vrad is None:
-        y_tmp = np.interp(x_obs, x_syn, y_syn, left=1, right=1)
-        corr = correlate(y_obs - np.median(y_obs), y_tmp - 1, mode="same")
-        offset = np.argmax(corr)
-        x1, x2 = x_obs[offset], x_obs[len(x_obs) // 2]
-        vrad = c_light * (1 - x2 / x1)
-        if np.abs(vrad) >= rv_limit:
+    if vflag and np.all(vrad == 0):
+        vrad = cross_correlate_rv(
+            [x_obs[i] for i in range(nseg)],
+            [y_obs[i] for i in range(nseg)],
+            list(x_syn),
+            list(y_syn),
+            combine=sme.vrad_flag == "whole",
+        )
+        if not np.all(np.isfinite(vrad)):
             logger.warning(
-                "Radial Velocity could not be estimated from cross correlation, using initial guess of 0 km/h. Please check results!"
+                "Radial Velocity could not be estimated from cross correlation, using initial guess of 0 km/s. Please check results!"
             )
-            vrad = 0
+            vrad = np.nan_to_num(vrad)
+        if sme.vrad_flag == "whole":
+            vrad = vrad[:1]
 
     def log_prior(rv, cscale, nwalkers):
         prior = np.zeros(nwalkers)
@@ -541,11 +761,22 @@ def determine_rv_and_cont(sme, segment, x_syn, y_syn):
     p0 = np.array(p0)[None, :]
     scale = np.array(scale)[None, :]
 
-    max_n = 10000
+    max_n = sme.mcmc_steps
     ncheck = 100
-    nburn = 300
+    nburn = sme.mcmc_burnin
     nwalkers = max(2 * ndim + 1, 10)
-    p0 = p0 + np.random.randn(nwalkers, ndim) * scale
+
+    # Resume from the walkers of the previous fit of these segments, if possible
+    # The spectrum usually only changes slightly between iterations of the solver
+    # so they are already close to the new posterior and need only a short burn in
+    key = get_mcmc_key(sme, segment)
+    walkers = sme.mcmc_walkers.get(key)
+    if walkers is not None and np.shape(walkers) == (nwalkers, ndim):
+        p0 = np.array(walkers, dtype=float)
+        nburn = int(nburn * MCMC_RESUME_BURNIN)
+        logger.debug("Resuming MCMC from the previous walkers")
+    else:
+        p0 = p0 + np.random.randn(nwalkers, ndim) * scale
     # If the original guess is good then DEMove is much faster, and sometimes just as good
     # However StretchMove is much more robust to the initial starting value
     moves = [(emcee.moves.DEMove(), 0.8), (emcee.moves.DESnookerMove(), 0.2)]
@@ -560,6 +791,7 @@ def determine_rv_and_cont(sme, segment, x_syn, y_syn):
     # old_tau = 0
 
     # Now we'll sample for up to max_n steps
+    converged = False
     with tqdm(leave=False, desc="RV", total=max_n) as t:
         for _ in sampler.sample(p0, iterations=max_n):
             t.update()
@@ -575,17 +807,20 @@ def determine_rv_and_cont(sme, segment, x_syn, y_syn):
             index += 1
 
             # Check convergence
-            converged = np.all(tau * 100 < sampler.iteration - nburn)
+            converged = np.all(tau * sme.mcmc_tolerance < sampler.iteration - nburn)
             # converged &= np.all(np.abs(old_tau - tau) < 0.01 * tau)
             # old_tau = tau
             if converged:
                 break
 
-    if sampler.iteration == max_n:
+    # Only walkers of a converged chain are a good start for the next fit
+    if converged:
+        sme.mcmc_walkers[key] = sampler.get_last_sample().coords
+    else:
         logger.warning(
             "The radial velocity did not converge within the limit. Check the results!"
         )
-
+        sme.mcmc_walkers.pop(key, None)
     samples = sampler.get_chain(flat=True, discard=nburn)
     _, vrad_unc, _, cscale_unc = null_result(nseg, ndeg)
     if vflag:
@@ -606,6 +841,271 @@ def determine_rv_and_cont(sme, segment, x_syn, y_syn):
     return vrad, vrad_unc, cscale, cscale_unc
 
 
+def _profile_chi2(rv, x_obs, y_obs, w_obs, x_num, offsets, x_syn, y_syn, ndeg, cont):
+    """
+    Chi square of the observation for a grid of radial velocities,
+    with the best fit continuum polynomial for each radial velocity
+
+    Parameters
+    ----------
+    rv : array of shape (nrv, nseg)
+        radial velocities of each segment
+    x_obs, y_obs, w_obs, x_num : array of shape (npix,)
+        wavelength, spectrum, weights, and wavelength relative to the start
+        of the segment, of the good pixels of all segments
+    offsets : array of shape (nseg,)
+        index of the first pixel of each segment
+    x_syn, y_syn : list(array)
+        synthetic spectrum of each segment
+    ndeg : int
+        degree of the continuum polynomial
+    cont : array of shape (npix,), None
+        fixed continuum, or None to fit the continuum
+
+    Returns
+    -------
+    chi2 : array of shape (nrv, nseg)
+        chi square of each segment, scaled to account for non-overlapping pixels
+    coef : array of shape (nrv, nseg, ndeg + 1)
+        best fit continuum coefficients, highest order first
+    ata : array of shape (nrv, nseg, ndeg + 1, ndeg + 1)
+        normal matrix of the continuum fit
+    """
+    nrv, nseg = rv.shape
+    npix = x_obs.size
+    bounds = np.append(offsets, npix)
+
+    # Apply RV shift
+    rv_factor = np.sqrt((1 - rv / c_light) / (1 + rv / c_light))
+    model = np.empty((nrv, npix))
+    for i in range(nseg):
+        sl = slice(bounds[i], bounds[i + 1])
+        x = x_obs[None, sl] * rv_factor[:, i, None]
+        model[:, sl] = np.interp(x, x_syn[i], y_syn[i], left=np.nan, right=np.nan)
+
+    # Ignore the non-overlapping parts of the spectrum
+    valid = np.isfinite(model)
+    w = np.where(valid, w_obs, 0)
+    model = np.where(valid, model, 0)
+    npoints = np.add.reduceat(valid, offsets, axis=1)
+    nvalid = np.diff(bounds)
+
+    if cont is None:
+        # The continuum is linear in its coefficients, and the entries of the
+        # normal matrix are the power sums of w * model**2 * x**k (a Hankel matrix)
+        # This avoids arrays of size (nrv, npix, ndeg + 1, ndeg + 1)
+        powers = np.arange(ndeg, -1, -1)
+        wm = w * model
+        wmm, wmy = wm * model, wm * y_obs
+        xpow = [np.ones(npix)]
+        for _ in range(2 * ndeg):
+            xpow += [xpow[-1] * x_num]
+        sums = np.stack(
+            [np.add.reduceat(wmm * xk, offsets, axis=1) for xk in xpow], axis=-1
+        )
+        ata = sums[..., powers[:, None] + powers[None, :]]
+        aty = np.stack(
+            [np.add.reduceat(wmy * xpow[k], offsets, axis=1) for k in powers], axis=-1
+        )
+        yty = np.add.reduceat(w * y_obs ** 2, offsets, axis=1)
+        coef = np.linalg.solve(ata + 1e-12 * np.eye(ndeg + 1), aty[..., None])[..., 0]
+        chi2 = yty - np.sum(coef * aty, axis=-1)
+    else:
+        resid = w * (y_obs - model * cont) ** 2
+        chi2 = np.add.reduceat(resid, offsets, axis=1)
+        coef = np.zeros((nrv, nseg, ndeg + 1))
+        ata = np.zeros((nrv, nseg, ndeg + 1, ndeg + 1))
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        chi2 = np.clip(chi2, 0, None) * nvalid / npoints
+    chi2[npoints <= ndeg + 1] = np.inf
+    return chi2, coef, ata
+
+
+def determine_rv_and_cont_profile(sme, segment, x_syn, y_syn):
+    """
+    Fits both radial velocity and continuum level deterministically
+
+    For a given radial velocity the continuum polynomial is linear, so it
+    is determined with weighted linear least squares. The radial velocity
+    is then found by a scan of the chi square around the cross correlation
+    guess (see cross_correlate_rv), followed by a parabola fit
+    around the minimum. The uncertainties are determined from the curvature
+    of the chi square and the covariance of the continuum fit, scaled by
+    the reduced chi square.
+
+    This is much faster than determine_rv_and_cont, which samples the
+    posterior distribution with MCMC.
+
+    Parameters
+    ----------
+    sme : SME_Struct
+        contains the observation
+    segment : int, list(int)
+        wavelength segments to fit
+    x_syn : array of size (nseg, ngrid)
+        wavelength of the synthetic spectrum
+    y_syn : array of size (nseg, ngrid)
+        intensity of the synthetic spectrum
+
+    Returns
+    -------
+    vrad : array of size (nseg,)
+        radial velocity in km/s
+    vrad_unc : array of size (nseg, 2)
+        radial velocity uncertainty in km/s
+    cscale : array of size (nseg, ndeg+1)
+        polynomial coefficients of the continuum
+    cscale_unc : array if size (nseg, ndeg + 1, 2)
+        uncertainties of the continuum coefficients
+    """
+    if np.isscalar(segment):
+        segment = [segment]
+    segment = list(segment)
+    nseg = len(segment)
+
+    if sme.cscale_flag in ["none", "fix"] and sme.vrad_flag in ["none", "fix"]:
+        vrad, vunc, cscale, cunc = null_result(nseg, sme.cscale_degree)
+        if sme.vrad_flag == "fix":
+            vrad = sme.vrad[segment]
+        if sme.cscale_flag == "fix":
+            cscale = sme.cscale[segment]
+        return vrad, vunc, cscale, cunc
+
+    if "spec" not in sme or "wave" not in sme:
+        # No observation no radial velocity
+        logger.warning("Missing data for radial velocity/continuum determination")
+        return null_result(nseg, sme.cscale_degree)
+
+    if "mask" not in sme:
+        sme.mask = np.full(sme.spec.size, sme.mask_values["line"])
+    if "uncs" not in sme:
+        sme.uncs = np.full(sme.spec.size, 1.0)
+
+    ndeg = sme.cscale_degree
+    mask = [sme.mask_good[s] & (sme.uncs[s] > 0) for s in segment]
+    if not all(np.count_nonzero(m) > ndeg + 1 for m in mask):
+        warnings.warn(
+            "Not enough good pixels to determine radial velocity/continuum",
+            UserWarning,
+        )
+        return null_result(nseg, ndeg)
+
+    if len(x_syn) != nseg or len(y_syn) != nseg:
+        raise ValueError(
+            "Size of synthetic spectrum, does not match the number of requested segments"
+        )
+
+    # All good pixels of all segments, so we can vectorize over the segments
+    x_obs = np.concatenate([sme.wave[s][m] for s, m in zip(segment, mask)])
+    y_obs = np.concatenate([sme.spec[s][m] for s, m in zip(segment, mask)])
+    w_obs = np.concatenate([1 / sme.uncs[s][m] ** 2 for s, m in zip(segment, mask)])
+    x_num = np.concatenate(
+        [sme.wave[s][m] - sme.wave[s][0] for s, m in zip(segment, mask)]
+    )
+    npix = np.array([np.count_nonzero(m) for m in mask])
+    offsets = np.concatenate(([0], np.cumsum(npix)[:-1]))
+
+    cflag = sme.cscale_flag not in ["none", "fix"]
+    cont = None
+    if not cflag:
+        if sme.cscale_flag == "fix":
+            cscale = np.atleast_2d(sme.cscale[segment])
+        else:
+            cscale = np.ones((nseg, 1))
+        cont = np.concatenate(
+            [np.polyval(c, x) for c, x in zip(cscale, np.split(x_num, offsets[1:]))]
+        )
+
+    args = (x_obs, y_obs, w_obs, x_num, offsets, x_syn, y_syn, ndeg, cont)
+    vflag = sme.vrad_flag in ["each", "whole"]
+    whole = sme.vrad_flag == "whole"
+
+    if vflag:
+        # Coarse scan in steps of one pixel,
+        # limited to a quarter of each segment
+        wmin = np.minimum.reduceat(x_obs, offsets)
+        wmax = np.maximum.reduceat(x_obs, offsets)
+        rv_limit = c_light * (wmax - wmin) / wmin / 4
+        step = c_light * np.median(np.diff(x_obs) / x_obs[1:])
+        step = step if step > 0 else 1
+        if whole:
+            rv_limit[:] = np.min(rv_limit)
+
+        # Only scan around the cross correlation guess, if there is one
+        bounds = np.append(offsets, x_obs.size)
+        guess = cross_correlate_rv(
+            [x_obs[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+            [y_obs[a:b] for a, b in zip(bounds[:-1], bounds[1:])],
+            x_syn,
+            y_syn,
+            rv_limit=rv_limit,
+            combine=whole,
+        )
+        if np.all(np.isfinite(guess)):
+            width = RV_SCAN_PIXELS * step
+            rv_grid = np.arange(-width, width + step, step)
+            rv_grid = guess[None, :] + rv_grid[:, None]
+        else:
+            rv_grid = np.arange(-np.max(rv_limit), np.max(rv_limit) + step, step)
+            rv_grid = np.tile(rv_grid[:, None], (1, nseg))
+        chi2 = np.empty(rv_grid.shape)
+        # Evaluate in chunks, to limit the memory use
+        for i in range(0, rv_grid.shape[0], 64):
+            chi2[i : i + 64] = _profile_chi2(rv_grid[i : i + 64], *args)[0]
+        chi2[np.abs(rv_grid) > rv_limit[None, :]] = np.inf
+        if whole:
+            chi2 = np.tile(np.sum(chi2, axis=1, keepdims=True), (1, nseg))
+        vrad = rv_grid[np.argmin(chi2, axis=0), np.arange(nseg)]
+
+        # Fine scan around the minimum, with a parabola fit
+        offset = np.linspace(-step, step, 21)
+        rv = vrad[None, :] + offset[:, None]
+        chi2 = _profile_chi2(rv, *args)[0]
+        if whole:
+            chi2 = np.tile(np.sum(chi2, axis=1, keepdims=True), (1, nseg))
+        vrad_unc = np.zeros((nseg, 2))
+        for i in range(nseg):
+            finite = np.isfinite(chi2[:, i])
+            a = b = 0
+            if np.count_nonzero(finite) >= 3:
+                a, b, _ = np.polyfit(offset[finite], chi2[finite, i], 2)
+            if a > 0 and np.abs(b / (2 * a)) <= step:
+                vrad[i] += -b / (2 * a)
+                vrad_unc[i] = 1 / np.sqrt(a)
+            else:
+                vrad[i] += offset[np.argmin(chi2[:, i])]
+                vrad_unc[i] = step
+    else:
+        if sme.vrad_flag == "fix":
+            vrad = np.asarray(sme.vrad[segment], dtype=float)
+        else:
+            vrad = np.zeros(nseg)
+        vrad_unc = np.zeros((nseg, 2))
+
+    chi2, coef, ata = _profile_chi2(vrad[None, :], *args)
+    chi2, coef, ata = chi2[0], coef[0], ata[0]
+
+    # Scale the uncertainties with the reduced chi square
+    nfree = ndeg + 1 if cflag else 0
+    nfree += 1 if vflag else 0
+    if whole:
+        redchi2 = np.sum(chi2) / max(np.sum(npix) - nfree, 1)
+    else:
+        redchi2 = chi2 / np.clip(npix - nfree, 1, None)
+    vrad_unc *= np.sqrt(redchi2)[..., None] if not whole else np.sqrt(redchi2)
+
+    _, _, _, cscale_unc = null_result(nseg, ndeg)
+    if cflag:
+        cscale = coef
+        covar = np.linalg.pinv(ata)
+        sigma = np.sqrt(np.clip(np.diagonal(covar, axis1=-2, axis2=-1), 0, None))
+        sigma *= np.sqrt(redchi2)[..., None] if not whole else np.sqrt(redchi2)
+        cscale_unc[..., 0] = cscale_unc[..., 1] = sigma
+
+    return vrad, vrad_unc, cscale, cscale_unc
+
+
 def cont_fit(sme, segment, x_syn, y_syn, rvel=0):
     """
     Fit a continuum when no continuum points exist
@@ -712,7 +1212,96 @@ def cont_fit(sme, segment, x_syn, y_syn, rvel=0):
     return coef
 
 
-def match_rv_continuum(sme, segments, x_syn, y_syn):
+def _fit_segment_whole(sme, segment, x_syn, y_syn):
+    """
+    Fit continuum and radial velocity of one segment, for cscale_type "whole"
+
+    Returns
+    -------
+    result : tuple
+        vrad, vrad_unc, cscale, cscale_unc, see determine_rv_and_cont
+    walkers : array, None
+        the final coordinates of the MCMC walkers, as stored by determine_rv_and_cont
+    """
+    result = determine_rv_and_cont(sme, segment, x_syn, y_syn)
+    walkers = sme.mcmc_walkers.get(get_mcmc_key(sme, segment))
+    return result, walkers
+
+
+def _fit_segment_mask(sme, segment, x_syn, y_syn, dll=None):
+    """
+    Fit continuum and radial velocity of one segment, for cscale_type "mask"
+
+    Returns
+    -------
+    cscale : array of size (ndeg + 1,)
+        continuum coefficients
+    vrad : float
+        radial velocity
+    mask : array, None
+        the mask of the segment, as updated by determine_continuum
+    """
+    cscale = determine_continuum(sme, segment, dll=dll)
+    vrad = determine_radial_velocity(sme, segment, cscale, x_syn, y_syn)
+    mask = sme.mask[segment] if "mask" in sme else None
+    return cscale, vrad, mask
+
+
+def map_segments(func, args, n_jobs=1, executor=None, desc=None):
+    """
+    Apply func to each set of arguments, possibly in parallel
+
+    Parameters
+    ----------
+    func : callable
+        function to call, must be picklable for a process pool
+    args : list(tuple)
+        arguments of each call
+    n_jobs : int, optional
+        number of parallel workers, by default 1, i.e. serial
+    executor : str, Executor, optional
+        "thread" or "process" to start a new pool of workers,
+        or an existing Executor to use. By default a thread pool is used
+        if n_jobs > 1.
+    desc : str, optional
+        description of the progress bar
+
+    Returns
+    -------
+    results : list
+        the return values in the same order as args
+    """
+    args = list(args)
+    disable = desc is None
+    if len(args) <= 1 or (n_jobs <= 1 and not isinstance(executor, Executor)):
+        return [func(*a) for a in tqdm(args, desc=desc, leave=False, disable=disable)]
+
+    if isinstance(executor, Executor):
+        pool, owner = executor, False
+    elif executor in [None, "thread"]:
+        pool, owner = ThreadPoolExecutor(max_workers=n_jobs), True
+    elif executor == "process":
+        pool, owner = ProcessPoolExecutor(max_workers=n_jobs), True
+    else:
+        raise ValueError(
+            f"Expected executor to be one of ['process', 'thread'], but got {executor} instead"
+        )
+
+    try:
+        # map returns the results in the order of the arguments
+        results = pool.map(func, *zip(*args))
+        results = list(
+            tqdm(results, total=len(args), desc=desc, leave=False, disable=disable)
+        )
+    finally:
+        if owner:
+            pool.shutdown()
+    return results
+
+
+def match_rv_continuum(
+    sme, segments, x_syn, y_syn, n_jobs=1, executor=None, dll=None
+):
     """
     Match both the continuum and the radial velocity of observed/synthetic spectrum
 
@@ -728,6 +1317,13 @@ def match_rv_continuum(sme, segments, x_syn, y_syn):
         wavelength of the synthetic spectrum
     y_syn : array of size (n,)
         intensitz of the synthetic spectrum
+    n_jobs : int, optional
+        number of segments to fit in parallel, by default 1
+    executor : str, Executor, optional
+        "thread" or "process" pool, or an existing Executor
+        for the independent fits of each segment, see map_segments
+    dll : SME_DLL, optional
+        library that synthesized the spectrum, used to find continuum points
 
     Returns
     -------
@@ -746,10 +1342,20 @@ def match_rv_continuum(sme, segments, x_syn, y_syn):
 
     if sme.cscale_type == "whole":
         if sme.vrad_flag in ["each", "none", "fix"]:
-            for s in tqdm(segments, desc="RV/Cont", leave=False):
-                vrad[s], vrad_unc[s], cscale[s], cscale_unc[s] = determine_rv_and_cont(
-                    sme, s, x_syn[s], y_syn[s]
-                )
+            results = map_segments(
+                _fit_segment_whole,
+                [(sme, s, x_syn[s], y_syn[s]) for s in segments],
+                n_jobs=n_jobs,
+                executor=executor,
+                desc="RV/Cont",
+            )
+            for s, (res, walkers) in zip(segments, results):
+                vrad[s], vrad_unc[s], cscale[s], cscale_unc[s] = res
+                # The walkers are stored in the copy of sme in worker processes
+                if walkers is not None:
+                    sme.mcmc_walkers[get_mcmc_key(sme, s)] = walkers
+                else:
+                    sme.mcmc_walkers.pop(get_mcmc_key(sme, s), None)
         elif sme.vrad_flag == "whole":
             wave = Iliffe_vector(values=[x_syn[s] for s in segments])
             smod = Iliffe_vector(values=[y_syn[s] for s in segments])
@@ -759,10 +1365,27 @@ def match_rv_continuum(sme, segments, x_syn, y_syn):
             )
         else:
             raise ValueError(f"Radial velocity flag {sme.vrad_flag} not understood")
+    elif sme.cscale_type == "profile":
+        # All segments at once, see determine_rv_and_cont_profile
+        s = list(segments)
+        vrad[s], vrad_unc[s], cscale[s], cscale_unc[s] = determine_rv_and_cont_profile(
+            sme, s, [x_syn[i] for i in s], [y_syn[i] for i in s]
+        )
     elif sme.cscale_type == "mask":
-        for s in segments:
-            cscale[s] = determine_continuum(sme, s)
-            vrad[s] = determine_radial_velocity(sme, s, cscale[s], x_syn[s], y_syn[s])
+        # The library can not be passed to other processes
+        if executor == "process" or isinstance(executor, ProcessPoolExecutor):
+            dll = None
+        results = map_segments(
+            _fit_segment_mask,
+            [(sme, s, x_syn[s], y_syn[s], dll) for s in segments],
+            n_jobs=n_jobs,
+            executor=executor,
+        )
+        for s, (cs, vr, mask) in zip(segments, results):
+            cscale[s], vrad[s] = cs, vr
+            # The continuum mask is updated in the workers
+            if mask is not None:
+                sme.mask[s] = mask
 
         if sme.vrad_flag == "whole":
             s = segments
@@ -771,7 +1394,7 @@ def match_rv_continuum(sme, segments, x_syn, y_syn):
             )
     else:
         raise ValueError(
-            f"Did not understand cscale_type, expected one of ('whole', 'mask'), but got {sme.cscale_type}."
+            f"Did not understand cscale_type, expected one of ('profile', 'whole', 'mask'), but got {sme.cscale_type}."
         )
 
     # Keep values from unused segments
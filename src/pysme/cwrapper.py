@@ -5,6 +5,7 @@ Wrapper for IDL style C libary code
 with argv = number of parameters
 and argc = list of pointers to those parameters
 """
+import atexit
 import logging
 import ctypes as ct
 from ctypes.util import find_library
@@ -14,6 +15,8 @@ from pathlib import Path
 import warnings
 from os.path import join, dirname, basename
 import os
+import shutil
+import tempfile
 import wget
 import tarfile
 import zipfile
@@ -142,7 +145,47 @@ def get_full_libfile():
     return libfile
 
 
-def load_library(libfile):
+def copy_library(libfile):
+    """
+    Copy the library file into a new temporary directory
+
+    The dynamic loader only loads each file once per process, so loading
+    the copy results in a new instance of the library, with its own
+    global variables. The copy is removed when Python exits.
+
+    Parameters
+    ----------
+    libfile : str
+        location of the library file
+
+    Returns
+    -------
+    libfile : str
+        location of the copied library file
+    """
+    tmpdir = tempfile.mkdtemp(prefix="pysme_")
+    atexit.register(shutil.rmtree, tmpdir, ignore_errors=True)
+    return shutil.copy2(libfile, join(tmpdir, basename(libfile)))
+
+
+def load_library(libfile, private=False):
+    """
+    Load the library
+
+    Parameters
+    ----------
+    libfile : str
+        location of the library file
+    private : bool, optional
+        if True, load a private copy of the library, that does not
+        share its state with other instances (default: False)
+
+    Returns
+    -------
+    lib : CDLL
+        the loaded library
+    """
+    # Dependencies are always found in the original directory
     try:
         os.add_dll_directory(dirname(libfile))
     except AttributeError:
@@ -150,6 +193,8 @@ def load_library(libfile):
         if "PATH" in os.environ:
             newpath += os.pathsep + os.environ["PATH"]
         os.environ["PATH"] = newpath
+    if private:
+        libfile = copy_library(libfile)
     return ct.CDLL(str(libfile))
 
 
@@ -298,11 +343,12 @@ def idl_call_external(funcname, *args, restype="str", type=None, lib=None):
 
 
 class IDL_DLL:
-    def __init__(self, libfile=None):
+    def __init__(self, libfile=None, private=False):
         if libfile is None:
             libfile = get_full_libfile()
         self.libfile = libfile
-        self.lib = load_library(libfile)
+        self.private = private
+        self.lib = load_library(libfile, private=private)
 
     def __getattr__(self, name):
         return lambda *args, **kwargs: self.call(name, *args, **kwargs)
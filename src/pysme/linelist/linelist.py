@@ -230,6 +230,11 @@ class LineList(IPersist):
         if "citation_info" in kwargs.keys():
             self.citation_info = kwargs["citation_info"]
 
+        #:int: Number of modifications of the data, see mark_modified
+        self._version = 0
+        #:tuple: version and fingerprint of the data, see pysme.cache.linelist_fingerprint
+        self._fingerprint = None
+
     def __len__(self):
         return len(self._lines)
 
@@ -251,7 +256,7 @@ class LineList(IPersist):
             values = self._lines[index].values
             if index in self.string_columns:
                 values = values.astype(str)
-            return values
+            return self._readonly(values)
         else:
             if isinstance(index, int):
                 index = slice(index, index + 1)
@@ -260,11 +265,28 @@ class LineList(IPersist):
                 self._lines.iloc[index], self.lineformat, medium=self.medium
             )
 
+    def __setitem__(self, index, value):
+        """Set the values of a column, or of a single line with linelist[field, line]"""
+        if isinstance(index, tuple):
+            field, line = index
+            self._lines.iloc[line, self._lines.columns.get_loc(field)] = value
+        else:
+            self._lines[index] = value
+        self.mark_modified()
+
     def __getattribute__(self, name):
         if name[0] != "_" and name not in dir(self):
-            return self._lines[name].values
+            return self._readonly(self._lines[name].values)
         return super().__getattribute__(name)
 
+    @staticmethod
+    def _readonly(values):
+        # The columns are views of the data, changes have to go through
+        # __setitem__, so that the fingerprint of the data is updated
+        values = values.view()
+        values.flags.writeable = False
+        return values
+
     @property
     def columns(self):
         return self._lines.columns
@@ -287,9 +309,11 @@ class LineList(IPersist):
             if self._medium == "air" and value == "vac":
                 self._lines["wlcent"] = air2vac(self._lines["wlcent"])
                 self._medium = "vac"
+                self.mark_modified()
             elif self._medium == "vac" and value == "air":
                 self._lines["wlcent"] = vac2air(self._lines["wlcent"])
                 self._medium = "air"
+                self.mark_modified()
             else:
                 raise ValueError(
                     f"Type of medium not undertstood. Expected one of [vac, air], but got {value} instead"
@@ -336,6 +360,18 @@ class LineList(IPersist):
         # Select fields
         return self._lines.reindex(columns=names).values
 
+    def mark_modified(self):
+        """Mark the data of the linelist as modified
+
+        This is necessary after changing the underlying DataFrame directly,
+        so that the cached fingerprint of the linelist
+        (see pysme.cache.linelist_fingerprint) is not reused.
+        The methods of LineList, e.g. linelist["gflog", 0] = -1, do this automatically,
+        while the columns it returns are read only.
+        """
+        self._version = getattr(self, "_version", 0) + 1
+        self._fingerprint = None
+
     def sort(self, field="wlcent", ascending=True):
         """Sort the linelist
 
@@ -356,6 +392,7 @@ class LineList(IPersist):
         """
 
         self._lines = self._lines.sort_values(by=field, ascending=ascending)
+        self.mark_modified()
         return self
 
     def add(self, species, wlcent, excit, gflog, gamrad, gamqst, gamvw):
@@ -392,6 +429,7 @@ class LineList(IPersist):
             "gamvw": gamvw,
         }
         self._lines = self._lines.append([linedata])
+        self.mark_modified()
 
     def _save(self):
         header = {
@@ -878,6 +878,14 @@ class NLTE(Collection):
         # But maybe should be ?
         self.grid_data = {}
 
+    def __getstate__(self):
+        # The cached grid data holds memory mapped files, which should
+        # not be pickled (e.g. when sent to worker processes).
+        # It is simply reloaded on demand by get_grid
+        state = self.__dict__.copy()
+        state["grid_data"] = {}
+        return state
+
     def set_nlte(self, element, grid=None):
         """
         Add an element to the NLTE calculations
@@ -939,8 +947,21 @@ class NLTE(Collection):
     def _citation_info(self, value):
         pass
 
-    def update_coefficients(self, sme, dll, lfs_nlte):
-        """ pass departure coefficients to C library """
+    def update_coefficients(self, sme, dll, lfs_nlte, lines=None):
+        """ pass departure coefficients to C library
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure with the model parameters
+        dll : SME_DLL
+            the library to pass the coefficients to
+        lfs_nlte : LargeFileStorage
+            storage of the NLTE grids
+        lines : array(int), optional
+            sorted indices of the lines in sme.linelist that were passed to the library,
+            if only a subset was passed. By default all lines were passed.
+        """
 
         # Only print "Running in NLTE" message on the first run each time
         if np.all(self.grids == "") or np.size(self.elements) == 0:
@@ -967,6 +988,11 @@ class NLTE(Collection):
             self.first = False
             logger.info("Running in NLTE: %s", ", ".join(self.elements))
 
+        # Map the line indices of the whole linelist to those in the library
+        if lines is not None:
+            lineindex = np.full(len(sme.linelist), -1)
+            lineindex[lines] = np.arange(len(lines))
+
         # Call each element to update and return its set of departure coefficients
         for elem in self.elements:
             # Call function to retrieve interpolated NLTE departure coefficients
@@ -983,6 +1009,11 @@ class NLTE(Collection):
                     # loop through the list of relevant _lines_, substitute both their levels into the main b matrix
                     # Make sure both levels have corrections available
                     if lr[0] != -1 and lr[1] != -1:
+                        if lines is not None:
+                            li = lineindex[li]
+                            if li == -1:
+                                # This line was not passed to the library
+                                continue
                         dll.InputNLTE(bmat[:, lr], li)
 
         # flags = sme_synth.GetNLTEflags(sme.linelist)
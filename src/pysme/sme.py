@@ -150,15 +150,30 @@ class SME_Structure(Parameters):
                 * "linear": First order polynomial, i.e. approximate continuum by a straight line
                 * "quadratic": Second order polynomial, i.e. approximate continuum by a quadratic polynomial
             """),
-        ("cscale_type", "whole", lowercase(oneof("whole", "mask")), this,
+        ("cscale_type", "profile", lowercase(oneof("profile", "whole", "mask")), this,
             """str: Flag that determines the algorithm to determine the continuum
 
             This is used in combination with cscale_flag, which determines the degree of the fit, if any.
 
             allowed values are:
-              * "whole": Fit the whole synthetic spectrum to the observation to determine the best fit
+              * "profile": Fit the whole synthetic spectrum to the observation, with a scan of the
+                radial velocity and a linear least squares fit of the continuum
+              * "whole": Fit the whole synthetic spectrum to the observation, by sampling the posterior
+                distribution with MCMC. This is much slower, but gives more reliable uncertainties
               * "mask": Fit a polynomial to the pixels marked as continuum in the mask
             """),
+        ("mcmc_steps", 10000, asint, this,
+            "int: maximum number of steps of the MCMC sampler, used by cscale_type 'whole'"),
+        ("mcmc_burnin", 300, asint, this, "int: number of burn in steps of the MCMC sampler"),
+        ("mcmc_tolerance", 100, asfloat, this,
+            "float: the MCMC chain is converged, once it is this many autocorrelation times longer than the burn in"),
+        ("mcmc_walkers", {}, this, this,
+            """dict: final walker ensemble of the last MCMC fit for each set of segments
+
+            Only the walkers of converged fits are kept. The next fit of the same segments
+            and observation starts from these walkers, with a shorter burn in.
+            Set to an empty dict, to start from scratch.
+            """),
         ("cscale", 1, array(None, float), this,
             """array of size (nseg, ndegree): Continumm polynomial coefficients for each wavelength segment
             The x coordinates of each polynomial are chosen so that x = 0, at the first wavelength point,
@@ -329,7 +344,7 @@ class SME_Structure(Parameters):
         elif key.startswith("linelist "):
             _, idx, field = key[8:].split(" ", 2)
             idx = int(idx)
-            self.linelist[field][idx] = value
+            self.linelist[field, idx] = value
         else:
             super().__setitem__(key, value)
 
@@ -9,11 +9,28 @@ from .cwrapper import get_lib_name, IDL_DLL
 
 logger = logging.getLogger(__name__)
 
+# Maximum number of wavelength points in Transf
+TRANSF_NWMAX = 400000
+# Minimum size of the Transf buffers
+TRANSF_NWMIN = 4096
+
 
 class SME_DLL:
     """ Object Oriented interface for the SME C library """
 
-    def __init__(self, libfile=None, datadir=None):
+    def __init__(self, libfile=None, datadir=None, private_instance=False):
+        """
+        Parameters
+        ----------
+        libfile : str, optional
+            location of the library file, by default the one in the package
+        datadir : str, optional
+            location of the library data files, by default the one in the package
+        private_instance : bool, optional
+            if True, load a private copy of the library, so that its global
+            state is not shared with other instances in this process. This
+            allows running multiple instances in parallel threads (default: False)
+        """
         #:LineList: Linelist passed to the library
         self.linelist = None
         #:int: Number of mu points passed to the library
@@ -39,8 +56,15 @@ class SME_DLL:
         #:dict: NLTE subgrids for nlte coefficient interpolation
         self._nlte_grids = {}
         self.ion = None
-
-        self.lib = IDL_DLL(libfile)
+        #:dict: fingerprints of the data passed to the library for each input stage,
+        #: see Synthesizer.prepare_library. The input functions remove the stages they change.
+        self.input_state = {}
+        #:dict: reusable output buffers of Transf, for the current number of mu points
+        self._transf_buffers = {}
+
+        #:bool: Whether this instance uses a private copy of the library
+        self.private_instance = private_instance
+        self.lib = IDL_DLL(libfile, private=private_instance)
         self.SetLibraryPath(datadir)
 
         self.check_data_files_exist()
@@ -93,6 +117,11 @@ class SME_DLL:
                     f"Could not find required data file {name} in library directory {directory}"
                 )
 
+    def _invalidate(self, *stages):
+        """ Forget the input state of the given stages, since their data changes """
+        for stage in stages:
+            self.input_state.pop(stage, None)
+
     def SMELibraryVersion(self):
         """
         Return SME library version
@@ -161,12 +190,14 @@ class SME_DLL:
             van der Waals scaling factor
         """
         logger.debug("Setting Van der Waals scale in smelib")
+        self._invalidate("vw_scale")
         self.lib.SetVWscale(gamma6, type="double")
         self.vw_scale = gamma6
 
     def SetH2broad(self, h2_flag=True):
         """ Set flag for H2 molecule """
         logger.debug("Setting H2 broadening in smelib")
+        self._invalidate("h2broad")
 
         if h2_flag:
             self.lib.SetH2broad()
@@ -176,6 +207,7 @@ class SME_DLL:
 
     def ClearH2broad(self):
         """ Clear flag for H2 molecule """
+        self._invalidate("h2broad")
         self.lib.ClearH2broad()
         self.h2broad = False
 
@@ -208,6 +240,8 @@ class SME_DLL:
         ), f"Got wrong Linelist shape, expected ({nlines}, 8) but got {atomic.shape}"
 
         logger.debug("Passing linelist to smelib")
+        # Everything else depends on the linelist
+        self.input_state.clear()
         self.lib.InputLineList(
             nlines, species, atomic, type=("int", "string", "double")
         )
@@ -258,6 +292,7 @@ class SME_DLL:
         atomic = atomic.T
 
         logger.debug("Updating linelist in smelib")
+        self._invalidate("linelist", "ionization", "nlte")
         self.lib.UpdateLineList(
             nlines, species, atomic, index, type=("int", "str", "double", "short")
         )
@@ -332,6 +367,7 @@ class SME_DLL:
             raise TypeError(f"atmo has to be an Atmo type, {ae}")
 
         logger.debug("Inputing atmosphere model to smelib")
+        self._invalidate("model", "ionization", "nlte")
         self.lib.InputModel(*args, type=type)
 
         self.teff = teff
@@ -360,6 +396,7 @@ class SME_DLL:
         abund[np.isnan(abund)] = -99
 
         logger.debug("Inputing abundances to smelib")
+        self._invalidate("abund", "ionization", "nlte")
         self.lib.InputAbund(abund, type="double")
 
         self.abund = abund
@@ -470,6 +507,7 @@ class SME_DLL:
             flag that determines the behaviour of the C function
         """
         logger.debug("Calculating ionization in smelib")
+        self._invalidate("ionization")
         self.lib.Ionization(ion, type="short", raise_error=False, raise_warning=True)
         self.ion = ion
 
@@ -522,7 +560,7 @@ class SME_DLL:
         accwi,
         keep_lineop=False,
         long_continuum=True,
-        nwmax=400000,
+        nwmax=TRANSF_NWMAX,
         wave=None,
     ):
         """
@@ -544,7 +582,8 @@ class SME_DLL:
         long_continuum : bool, optional
             if True the continuum is calculated at every wavelength (default: True)
         nwmax : int, optional
-            maximum number of wavelength points if wavelength grid is not set with wave (default: 400000)
+            maximum number of wavelength points if wavelength grid is not set with wave
+            (default: TRANSF_NWMAX)
         wave : array, optional
             wavelength grid to use for the calculation,
             if not set will use an adaptive wavelength grid with no constant step size (default: None)
@@ -564,45 +603,24 @@ class SME_DLL:
         keep_lineop = 1 if keep_lineop else 0
         long_continuum = 1 if long_continuum else 0
 
-        if wave is None:
-            nw = 0
-            wint_seg = np.zeros(nwmax)
-        else:
-            nwmax = nw = len(wave)
-            wint_seg = np.asarray(wave)
-
         mu = np.asarray(mu)
         nmu = np.size(mu)
 
-        # Prepare data:
-        sint_seg = np.zeros((nwmax, nmu))  # line+continuum intensities
-        cint_seg = np.zeros((nwmax, nmu))  # all continuum intensities
-        cintr_seg = np.zeros((nmu))  # red continuum intensity
-        nw = np.array([nw])
-
-        type = "sdddiiddddss"  # s: short, d:double, i:int, u:unicode (string)
+        if wave is not None:
+            wave = np.asarray(wave)
+            nwmax = len(wave)
 
-        logger.debug("Starting radiative Transfer calculations in smelib")
-        self.lib.Transf(
-            nmu,
-            mu,
-            cint_seg,
-            cintr_seg,
-            nwmax,
-            nw,
-            wint_seg,
-            sint_seg,
-            accrt,
-            accwi,
-            keep_lineop,
-            long_continuum,
-            type=type,
+        nw, wint_seg, sint_seg, cint_seg = self._transf(
+            nmu, mu, nwmax, wave, accrt, accwi, keep_lineop, long_continuum
         )
-        nw = nw[0]
 
-        wint_seg = wint_seg[:nw]
-        sint_seg = sint_seg[:nw, :].T
-        cint_seg = cint_seg[:nw, :].T
+        # Only return copies of the used part of the buffers, since those are reused
+        if wave is None:
+            wint_seg = wint_seg[:nw].copy()
+        else:
+            wint_seg = wave[:nw]
+        sint_seg = np.ascontiguousarray(sint_seg[:nw, :].T)
+        cint_seg = np.ascontiguousarray(cint_seg[:nw, :].T)
 
         sint_seg = np.nan_to_num(sint_seg, copy=False)
         cint_seg = np.nan_to_num(cint_seg, copy=False)
@@ -611,6 +629,69 @@ class SME_DLL:
 
         return nw, wint_seg, sint_seg, cint_seg
 
+    def _get_transf_buffers(self, nwmax, nmu):
+        """
+        Get zeroed output buffers for Transf, with at least nwmax points
+
+        The buffers of previous calls are reused if they are large enough.
+        Since the wavelength points are the first axis, larger buffers can
+        be passed to the library in place of smaller ones.
+        """
+        buffers = self._transf_buffers.get(nmu)
+        if buffers is not None and len(buffers[0]) >= nwmax:
+            wint_seg, sint_seg, cint_seg, used = buffers
+            # Only the part that was used in the last call needs to be reset
+            wint_seg[:used] = 0
+            sint_seg[:used] = 0
+            cint_seg[:used] = 0
+        else:
+            # Round up, so that the buffers can be reused for similar sizes
+            size = 2 ** int(np.ceil(np.log2(max(nwmax, TRANSF_NWMIN))))
+            size = max(min(size, TRANSF_NWMAX), nwmax)
+            # Only keep one set of buffers
+            self._transf_buffers.clear()
+            wint_seg = np.zeros(size)
+            sint_seg = np.zeros((size, nmu))  # line+continuum intensities
+            cint_seg = np.zeros((size, nmu))  # all continuum intensities
+        return wint_seg, sint_seg, cint_seg
+
+    def _transf(self, nmu, mu, nwmax, wave, accrt, accwi, keep_lineop, long_continuum):
+        """ Call Transf in the library, see Transf for details """
+        wint_buffer, sint_seg, cint_seg = self._get_transf_buffers(nwmax, nmu)
+        if wave is None:
+            nw = 0
+            wint_seg = wint_buffer
+        else:
+            nw = len(wave)
+            wint_seg = wave
+        cintr_seg = np.zeros((nmu))  # red continuum intensity
+        nw = np.array([nw])
+
+        type = "sdddiiddddss"  # s: short, d:double, i:int, u:unicode (string)
+
+        logger.debug("Starting radiative Transfer calculations in smelib")
+        try:
+            self.lib.Transf(
+                nmu,
+                mu,
+                cint_seg,
+                cintr_seg,
+                nwmax,
+                nw,
+                wint_seg,
+                sint_seg,
+                accrt,
+                accwi,
+                keep_lineop,
+                long_continuum,
+                type=type,
+            )
+        finally:
+            # If the call failed, the whole buffer needs to be reset next time
+            used = min(nw[0], nwmax) if nw[0] > 0 else len(wint_buffer)
+            self._transf_buffers[nmu] = (wint_buffer, sint_seg, cint_seg, used)
+        return nw[0], wint_seg, sint_seg, cint_seg
+
     def CentralDepth(self, mu, accrt):
         """
         This subroutine explicitly solves the transfer equation
@@ -727,6 +808,7 @@ class SME_DLL:
                 f"Lineindex out of range, expected value between 0 and {nlines}, but got {lineindex} instead"
             )
 
+        self._invalidate("nlte")
         self.lib.InputDepartureCoefficients(bmat, lineindex, type=("double", "int"))
 
     def GetNLTE(self, line):
@@ -752,6 +834,7 @@ class SME_DLL:
 
     def ResetNLTE(self):
         """ Reset departure coefficients from any previous call, to ensure LTE as default """
+        self._invalidate("nlte")
         self.lib.ResetDepartureCoefficients()
 
     def GetNLTEflags(self):
@@ -9,6 +9,8 @@ from os.path import splitext
 import contextlib
 import sys
 import builtins
+from copy import copy
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 import numpy as np
 from tqdm import tqdm
@@ -23,6 +25,7 @@ from .abund import Abund
 from .atmosphere.atmosphere import AtmosphereError
 from .atmosphere.savfile import SavFile
 from .atmosphere.krzfile import KrzFile
+from .cache import fingerprint
 from .config import Config
 from .continuum_and_radial_velocity import match_rv_continuum
 from .large_file_storage import setup_lfs
@@ -38,9 +41,54 @@ logger = logging.getLogger(__name__)
 clight = speed_of_light * 1e-3  # km/s
 warnings.filterwarnings("ignore", category=OptimizeWarning)
 
+# Absolute step sizes of the numerical jacobian, for jacobian_step="default"
+# Abundances use the value of "abund", all others the relative steps of scipy
+DEFAULT_JACOBIAN_STEP = {
+    "teff": 10,
+    "logg": 0.01,
+    "monh": 0.01,
+    "vmic": 0.05,
+    "vmac": 0.1,
+    "vsini": 0.1,
+    "abund": 0.01,
+}
+
+# These parameters do not change the radiative transfer, only the broadening
+# of the specific intensities. So their jacobian is cheap, see get_broadening_parameters
+BROADENING_PARAMETERS = ["vsini", "vmac", "ipres"]
+
+# The solver of the current worker process, see _init_worker
+_worker_solver = None
+
+
+def _init_worker(data, key):
+    """
+    Create the solver (and thereby the library instance) of a worker process,
+    with the data that stays the same during the fit, see SME_Solver.get_worker_data
+    """
+    global _worker_solver
+    _worker_solver = SME_Solver()
+    _worker_solver._worker_data = data
+    _worker_solver._worker_key = key
+
+
+def _jacobian_worker(*args):
+    """ Calculate the residuals of a chunk of parameter vectors in a worker process """
+    return _worker_solver.jacobian_chunk(*args)
+
 
 class SME_Solver:
-    def __init__(self, filename=None):
+    def __init__(
+        self,
+        filename=None,
+        n_jobs=1,
+        jacobian_method="3-point",
+        jacobian_step=None,
+        jacobian_refresh=5,
+        jacobian_hybrid=True,
+        abundance_segments=False,
+        mask_windows=False,
+    ):
         self.dll = SME_DLL()
         self.config, self.lfs_atmo, self.lfs_nlte = setup_lfs()
         self.synthesizer = Synthesizer(
@@ -48,6 +96,7 @@ class SME_Solver:
             lfs_atmo=self.lfs_atmo,
             lfs_nlte=self.lfs_nlte,
             dll=self.dll,
+            mask_windows=mask_windows,
         )
 
         # Various parameters to keep track of during solving
@@ -56,6 +105,55 @@ class SME_Solver:
         self.parameter_names = []
         self.update_linelist = False
         self._latest_residual = None
+        self._latest_param = None
+
+        # int: number of worker processes for the calculation of the jacobian
+        self.n_jobs = max(int(n_jobs), 1)
+        # ProcessPoolExecutor: the workers, created on first use and kept
+        # running (with the linelist loaded) between iterations
+        self._executor = None
+        # str: fingerprint of the data the workers were started with, see get_worker_data
+        self._executor_key = None
+        # dict: the data of a worker process that stays the same during the fit
+        self._worker_data = None
+        # str: fingerprint of that data
+        self._worker_key = None
+        # str: fingerprint of the linelist in the library of a worker process
+        self._linelist = None
+        # dict: NLTE grid data of a worker process
+        self._nlte_grid_data = {}
+
+        # str: how to determine the jacobian
+        # "3-point": central differences, "2-point": forward differences
+        # "broyden": rank-1 updates, with a new 3-point jacobian every jacobian_refresh iterations
+        if jacobian_method not in ["3-point", "2-point", "broyden"]:
+            raise ValueError(
+                f"Expected jacobian_method to be one of ['3-point', '2-point', 'broyden'], but got {jacobian_method} instead"
+            )
+        self.jacobian_method = jacobian_method
+        # dict, str: absolute step sizes of the numerical jacobian for each parameter,
+        # "default" for DEFAULT_JACOBIAN_STEP, or None for the relative steps of scipy
+        self.jacobian_step = jacobian_step
+        # int: maximum number of consecutive Broyden updates
+        self.jacobian_refresh = jacobian_refresh
+        # bool: whether to calculate the jacobian of the broadening parameters
+        # from the cached specific intensities, see get_broadening_parameters
+        self.jacobian_hybrid = jacobian_hybrid
+        # bool: whether the jacobian columns of abundances only synthesize
+        # the segments with lines of that element, see get_changed_segments
+        self.abundance_segments = abundance_segments
+        # dict: the segments affected by each abundance parameter
+        self._parameter_segments = {}
+        # int: number of syntheses for the jacobians
+        self.jacobian_syntheses = 0
+        # int: number of those syntheses that reused the specific intensities
+        self.jacobian_syntheses_broadening = 0
+        # int: number of syntheses saved, compared to a 3-point jacobian in each iteration
+        self.jacobian_syntheses_saved = 0
+        self._last_jac = None
+        self._last_param = None
+        self._last_f0 = None
+        self._broyden_updates = 0
 
         # For displaying the progressbars
         self.fig = None
@@ -66,6 +164,52 @@ class SME_Solver:
     def nparam(self):
         return len(self.parameter_names)
 
+    def __del__(self):
+        self.close()
+
+    def get_executor(self, sme, spec, uncs, mask):
+        """
+        Return the pool of workers, starting it if necessary
+
+        The workers receive the data that stays the same during the fit
+        (see get_worker_data) once, when they are started. If that data
+        changed, e.g. in a new fit, new workers are started.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure of the fit
+        spec, uncs, mask : array
+            observation, see __residuals
+
+        Returns
+        -------
+        executor : ProcessPoolExecutor
+            the pool of workers
+        key : str
+            fingerprint of the data of the workers
+        """
+        data = self.get_worker_data(sme, spec, uncs, mask)
+        # The observation is hashed as flat arrays, see cache.fingerprint
+        key = fingerprint(
+            {k: v if k == "linelist" or v is None else v.ravel() for k, v in data.items()}
+        )
+        if self._executor is not None and key != self._executor_key:
+            self.close()
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.n_jobs, initializer=_init_worker, initargs=(data, key)
+            )
+            self._executor_key = key
+        return self._executor, key
+
+    def close(self):
+        """ Shut down the workers, if any are running """
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            executor.shutdown()
+            self._executor = None
+
     def __residuals(
         self, param, sme, spec, uncs, mask, segments="all", isJacobian=False, **_
     ):
@@ -108,20 +252,28 @@ class SME_Solver:
         reuse_wavelength_grid = isJacobian
         radial_velocity_mode = "robust" if not isJacobian else "fast"
 
+        # Within the jacobian, only the segments affected by the changed parameters
+        # need to be synthesized again, see get_changed_segments
+        synth_segments = segments
+        if isJacobian:
+            synth_segments = self.get_changed_segments(param, segments)
+
         # change parameters
         for name, value in zip(self.parameter_names, param):
             sme[name] = value
         # run spectral synthesis
         try:
-            result = self.synthesizer.synthesize_spectrum(
-                sme,
-                updateStructure=update,
-                reuse_wavelength_grid=reuse_wavelength_grid,
-                segments=segments,
-                passLineList=False,
-                updateLineList=self.update_linelist,
-                radial_velocity_mode=radial_velocity_mode,
-            )
+            result = None
+            if len(synth_segments) > 0:
+                result = self.synthesizer.synthesize_spectrum(
+                    sme,
+                    updateStructure=update,
+                    reuse_wavelength_grid=reuse_wavelength_grid,
+                    segments=synth_segments,
+                    passLineList=False,
+                    updateLineList=self.update_linelist,
+                    radial_velocity_mode=radial_velocity_mode,
+                )
         except AtmosphereError as ae:
             # Something went wrong (left the grid? Don't go there)
             # If returned value is not finite, the fit algorithm will not go there
@@ -140,7 +292,15 @@ class SME_Solver:
         segments = Synthesizer.check_segments(sme, segments)
 
         # Get the correct results for the comparison
-        synth = sme.synth if update else result[1]
+        synth = sme.synth if update else result[1] if result is not None else None
+        if synth_segments is not segments:
+            # The other segments are the same as for the current parameters
+            synth = Iliffe_vector(
+                values=[
+                    synth[il] if il in synth_segments else sme.synth[il]
+                    for il in range(sme.nseg)
+                ]
+            )
         synth = synth[segments]
         synth = synth[mask] if mask is not None else synth
 
@@ -158,7 +318,8 @@ class SME_Solver:
 
         # Update progress bars
         if isJacobian:
-            self.progressbar_jacobian.update(1)
+            if self.progressbar_jacobian is not None:
+                self.progressbar_jacobian.update(1)
         else:
             self.progressbar.total += 1
             self.progressbar.update(1)
@@ -166,6 +327,7 @@ class SME_Solver:
         if not isJacobian:
             # Save result for jacobian
             self._latest_residual = resid
+            self._latest_param = np.copy(param)
             self.iteration += 1
             logger.debug("%s", {n: v for n, v in zip(self.parameter_names, param)})
             # Plot
@@ -180,24 +342,35 @@ class SME_Solver:
 
         return resid
 
-    def __jacobian(self, param, *args, bounds=None, segments="all", **_):
+    def __jacobian(
+        self, param, *args, bounds=None, segments="all", refresh=False, **_
+    ):
         """
         Approximate the jacobian numerically
-        The calculation is the same as "3-point"
+        The calculation is the same as in approx_derivative,
         but we can tell residuals that we are within a jacobian
+
+        Depending on jacobian_method the jacobian is
+        calculated with central or forward differences, or
+        updated from the previous jacobian with Broyden's method
         """
-        self.progressbar_jacobian.reset()
-        g = approx_derivative(
-            self.__residuals,
-            param,
-            method="3-point",
-            # This feels pretty bad, passing the latest synthetic spectrum
-            # by reference as a parameter of the residuals function object
-            f0=self._latest_residual,
-            bounds=bounds,
-            args=args,
-            kwargs={"isJacobian": True, "segments": segments},
-        )
+        # The latest residuals are only those of param, if it was the last point
+        f0 = self._latest_residual if self.__is_latest(param) else None
+        update = self.jacobian_method == "broyden" and not refresh
+        if update and self.__can_update(param, f0):
+            # Broyden's rank-1 update: J += (df - J dx) dx^T / (dx^T dx)
+            dx = param - self._last_param
+            df = f0 - self._last_f0
+            jac = self._last_jac
+            g = jac + np.outer(df - jac.dot(dx), dx) / dx.dot(dx)
+            self._broyden_updates += 1
+            self.jacobian_syntheses_saved += 2 * self.nparam
+        else:
+            method = "2-point" if self.jacobian_method == "2-point" else "3-point"
+            g = self.__approx_jacobian(
+                param, *args, f0=f0, bounds=bounds, segments=segments, method=method
+            )
+            self._broyden_updates = 0
 
         if not np.all(np.isfinite(g)):
             g[~np.isfinite(g)] = 0
@@ -208,9 +381,405 @@ class SME_Solver:
             )
 
         self._last_jac = np.copy(g)
+        self._last_param = np.copy(param)
+        self._last_f0 = f0
+
+        return g
+
+    def __is_latest(self, param):
+        """ Whether the latest residuals were calculated for param """
+        return self._latest_residual is not None and np.array_equal(
+            self._latest_param, param
+        )
 
+    def __can_update(self, param, f0):
+        """ Whether the last jacobian can be updated with Broyden's method """
+        if self._last_jac is None or self._broyden_updates >= self.jacobian_refresh:
+            return False
+        if f0 is None or self._last_f0 is None:
+            return False
+        if np.shape(f0) != np.shape(self._last_f0) or not np.all(np.isfinite(f0)):
+            return False
+        return np.any(param != self._last_param)
+
+    def __approx_jacobian(
+        self, param, *args, f0=None, bounds=None, segments="all", method="3-point"
+    ):
+        """
+        Calculate the jacobian with finite differences
+
+        f0 are the residuals at param, if they are known.
+        Otherwise they are calculated as well.
+        """
+        self.progressbar_jacobian.reset(total=self.nparam * (2 if method == "3-point" else 1))
+        abs_step = self.get_jacobian_step()
+        if self.n_jobs > 1 or len(self.get_broadening_parameters()) > 0:
+            func = self.__precompute_residuals(
+                param,
+                *args,
+                f0=f0,
+                bounds=bounds,
+                segments=segments,
+                method=method,
+                abs_step=abs_step,
+            )
+        else:
+            func = self.__residuals
+        g = approx_derivative(
+            func,
+            param,
+            method=method,
+            abs_step=abs_step,
+            f0=f0,
+            bounds=bounds,
+            args=args,
+            kwargs={"isJacobian": True, "segments": segments},
+        )
+        # Forward differences reuse the residuals of the current parameters
+        if method == "2-point":
+            self.jacobian_syntheses += self.nparam
+            self.jacobian_syntheses_saved += self.nparam
+        else:
+            self.jacobian_syntheses += 2 * self.nparam
+        # Unless they are not known yet
+        if f0 is None:
+            self.jacobian_syntheses += 1
         return g
 
+    def get_parameter_segments(self, sme, segments="all"):
+        """
+        Determine the segments affected by each abundance fit parameter
+
+        These are the segments with lines of the element, see
+        Synthesizer.get_element_segments. All other parameters affect all segments.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the linelist
+        segments : list(int), optional
+            the fitted segments (default: "all")
+
+        Returns
+        -------
+        parameter_segments : dict
+            the affected segments for the index of each abundance parameter
+        """
+        parameter_segments = {}
+        for i, name in enumerate(self.parameter_names):
+            name = name.casefold()
+            if name.startswith("abund "):
+                element = name[5:].strip().capitalize()
+                parameter_segments[i] = self.synthesizer.get_element_segments(
+                    sme, element, segments
+                )
+        return parameter_segments
+
+    def get_changed_segments(self, param, segments):
+        """
+        Segments that need to be synthesized again, for a change of
+        the parameters since the last (non jacobian) residuals
+
+        If abundance_segments is set and only abundances changed, this is
+        only the segments with lines of those elements.
+        Otherwise it is all segments.
+
+        Parameters
+        ----------
+        param : array of size (nparam,)
+            the new parameters
+        segments : list(int)
+            the fitted segments
+
+        Returns
+        -------
+        segments : list(int)
+            the segments to synthesize
+        """
+        if not self.abundance_segments or self._latest_param is None:
+            return segments
+        changed = np.flatnonzero(param != self._latest_param)
+        if not all(i in self._parameter_segments for i in changed):
+            return segments
+        affected = set()
+        for i in changed:
+            affected.update(self._parameter_segments[i])
+        return [il for il in segments if il in affected]
+
+    def get_broadening_parameters(self):
+        """
+        Indices of the fit parameters, whose jacobian columns are calculated
+        from the cached specific intensities, if jacobian_hybrid is set
+
+        Returns
+        -------
+        index : array(int)
+            indices of the broadening parameters in parameter_names
+        """
+        if not self.jacobian_hybrid:
+            return np.zeros(0, dtype=int)
+        index = [
+            i
+            for i, name in enumerate(self.parameter_names)
+            if name in BROADENING_PARAMETERS
+        ]
+        return np.asarray(index, dtype=int)
+
+    def get_jacobian_step(self):
+        """
+        Absolute step sizes of the numerical jacobian for each fit parameter
+
+        Returns
+        -------
+        abs_step : array of size (nparam,), None
+            step size of each parameter, zero for the relative default step of scipy.
+            None if no absolute steps are used.
+        """
+        steps = self.jacobian_step
+        if steps is None:
+            return None
+        if isinstance(steps, str) and steps == "default":
+            steps = DEFAULT_JACOBIAN_STEP
+        abs_step = np.zeros(self.nparam)
+        for i, name in enumerate(self.parameter_names):
+            if name in steps:
+                abs_step[i] = steps[name]
+            elif name[:5].lower() == "abund" and "abund" in steps:
+                abs_step[i] = steps["abund"]
+        return abs_step
+
+    def __precompute_residuals(
+        self,
+        param,
+        sme,
+        spec,
+        uncs,
+        mask,
+        f0=None,
+        bounds=None,
+        segments="all",
+        method="3-point",
+        abs_step=None,
+    ):
+        """
+        Calculate the residuals of all parameter vectors of the jacobian in advance
+
+        The parameter vectors are determined by a first (dry) run of approx_derivative.
+        This way the steps and the handling of the bounds are exactly the same.
+
+        In the hybrid jacobian, the columns of the broadening parameters are
+        calculated first, in this process. They only change the steps after the
+        radiative transfer, so the specific intensities of the current parameters
+        are reused from the intensity cache of the synthesizer. If the cache
+        is too small to hold all segments, they are calculated like all others.
+        All other columns are calculated in the workers, if n_jobs > 1.
+
+        Returns
+        -------
+        func : callable
+            function that returns the precalculated residuals of each parameter vector,
+            to be used in approx_derivative instead of __residuals
+        """
+        points = []
+
+        def record(x, *_, **__):
+            points.append(np.copy(x))
+            return np.zeros(1)
+
+        approx_derivative(
+            record,
+            param,
+            method=method,
+            abs_step=abs_step,
+            f0=np.zeros(1),
+            bounds=bounds,
+        )
+        # Without the residuals at param, approx_derivative needs those as well
+        if f0 is None:
+            points.append(np.copy(param))
+
+        cheap = self.get_broadening_parameters()
+        # The specific intensities of all segments need to be in the cache,
+        # otherwise the broadening columns synthesize everything again anyway
+        if cheap.size > 0:
+            nentries = self.synthesizer.get_intensity_entries(
+                sme, Synthesizer.check_segments(sme, segments)
+            )
+            self.synthesizer.reserve_intensity_cache(nentries)
+            maxsize = self.synthesizer.intensity_cache.maxsize
+            if maxsize < nentries:
+                logger.info(
+                    "The intensity cache (%i entries) can not hold all %i segments, "
+                    "calculating the jacobian of the broadening parameters in full",
+                    maxsize,
+                    nentries,
+                )
+                cheap = np.zeros(0, dtype=int)
+        local, remote = [], []
+        for i, x in enumerate(points):
+            changed = np.flatnonzero(x != param)
+            if changed.size > 0 and np.all(np.isin(changed, cheap)):
+                local += [i]
+            else:
+                remote += [i]
+
+        residuals = {}
+        for i in local:
+            residuals[points[i].tobytes()] = self.__residuals(
+                points[i], sme, spec, uncs, mask, segments=segments, isJacobian=True
+            )
+        self.jacobian_syntheses_broadening += len(local)
+
+        if self.n_jobs == 1 or len(remote) == 0:
+            for i in remote:
+                residuals[points[i].tobytes()] = self.__residuals(
+                    points[i], sme, spec, uncs, mask, segments=segments, isJacobian=True
+                )
+            remote = []
+
+        # Each worker gets a chunk of the parameter vectors,
+        # the linelist and observation are passed when it starts
+        futures = {}
+        if len(remote) > 0:
+            executor, key = self.get_executor(sme, spec, uncs, mask)
+            nchunks = min(self.n_jobs, len(remote))
+            chunks = np.array_split(np.asarray(remote), nchunks)
+            state = self.get_worker_state(sme)
+            settings = self.get_worker_settings()
+        else:
+            chunks = []
+        for chunk in chunks:
+            future = executor.submit(
+                _jacobian_worker,
+                state,
+                settings,
+                [points[i] for i in chunk],
+                segments,
+                self.synthesizer.wint,
+                key,
+            )
+            futures[future] = chunk
+
+        for future in as_completed(futures):
+            chunk = futures[future]
+            for i, resid in zip(chunk, future.result()):
+                residuals[points[i].tobytes()] = resid
+            self.progressbar_jacobian.update(len(chunk))
+
+        def func(x, *_, **__):
+            return residuals[np.asarray(x, dtype=float).tobytes()]
+
+        return func
+
+    @staticmethod
+    def get_worker_data(sme, spec, uncs, mask):
+        """
+        The data of the workers that stays the same during the fit
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure of the fit
+        spec, uncs, mask : array
+            observation, see __residuals
+
+        Returns
+        -------
+        data : dict
+            the linelist and the observation in sme, as well as spec, uncs, and mask
+        """
+        return {
+            "linelist": sme.linelist,
+            "sme_spec": sme.spec,
+            "sme_uncs": sme.uncs,
+            "sme_mask": sme.mask,
+            "spec": spec,
+            "uncs": uncs,
+            "mask": mask,
+        }
+
+    @staticmethod
+    def get_worker_state(sme):
+        """
+        The sme structure for the workers, without the data of get_worker_data
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure at the current parameter values
+
+        Returns
+        -------
+        state : SME_Struct
+            shallow copy of sme, without the linelist and the observation
+        """
+        state = copy(sme)
+        state.linelist = None
+        state.spec = state.uncs = state.mask = None
+        return state
+
+    def get_worker_settings(self):
+        """ The attributes of the solver needed for the residuals in the workers """
+        return {
+            "parameter_names": self.parameter_names,
+            "update_linelist": self.update_linelist,
+            "abundance_segments": self.abundance_segments,
+            "_parameter_segments": self._parameter_segments,
+            "_latest_param": self._latest_param,
+            "mask_windows": self.synthesizer.mask_windows,
+        }
+
+    def jacobian_chunk(self, sme, settings, params, segments, wint, key):
+        """
+        Calculate the residuals of a chunk of parameter vectors, as part of the parallel jacobian
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure at the current parameter values, see get_worker_state
+        settings : dict
+            attributes of the main solver, see get_worker_settings
+        params : list(array)
+            the parameter vectors to calculate
+        segments : list(int)
+            the segments to synthesize
+        wint : dict
+            adaptive wavelength grids of the segments, from the main synthesizer
+        key : str
+            fingerprint of the data of the worker, see get_worker_data
+
+        Returns
+        -------
+        residuals : list(array)
+            residuals of each parameter vector
+        """
+        if key != self._worker_key:
+            raise RuntimeError("The worker was started with the data of another fit")
+        data = self._worker_data
+        sme.linelist = data["linelist"]
+        sme.spec, sme.uncs, sme.mask = data["sme_spec"], data["sme_uncs"], data["sme_mask"]
+
+        # The linelist stays in the library between iterations
+        if key != self._linelist:
+            self.dll.SetLibraryPath()
+            self.dll.InputLineList(sme.linelist)
+            self._linelist = key
+            self._nlte_grid_data = {}
+        # The NLTE grid data is not pickled with the sme structure
+        sme.nlte.grid_data = self._nlte_grid_data
+        settings = dict(settings)
+        self.synthesizer.mask_windows = settings.pop("mask_windows")
+        for key, value in settings.items():
+            setattr(self, key, value)
+        self.synthesizer.wint.update(wint)
+        spec, uncs, mask = data["spec"], data["uncs"], data["mask"]
+        return [
+            self.__residuals(
+                p, sme, spec, uncs, mask, segments=segments, isJacobian=True
+            )
+            for p in params
+        ]
+
     def get_bounds(self, sme):
         """
         Create Bounds based on atmosphere grid and general rules
@@ -537,6 +1106,11 @@ class SME_Solver:
                 self.update_linelist = True
                 break
 
+        self._latest_param = None
+        self._parameter_segments = {}
+        if self.abundance_segments:
+            self._parameter_segments = self.get_parameter_segments(sme, segments)
+
         # Create appropiate bounds
         bounds = self.get_bounds(sme)
         scales = self.get_scale()
@@ -581,6 +1155,11 @@ class SME_Solver:
 
         # Do the heavy lifting
         if self.nparam > 0:
+            self._last_jac = self._last_param = self._last_f0 = None
+            self._broyden_updates = 0
+            self.jacobian_syntheses = 0
+            self.jacobian_syntheses_saved = 0
+            self.jacobian_syntheses_broadening = 0
             self.progressbar = tqdm(desc="Iteration", total=0)
             self.progressbar_jacobian = tqdm(desc="Jacobian", total=len(p0) * 2)
             with print_to_log():
@@ -597,8 +1176,27 @@ class SME_Solver:
                     args=(sme, spec, uncs, mask),
                     kwargs={"bounds": bounds, "segments": segments},
                 )
+                # The uncertainties need the actual jacobian at the best fit
+                if self._broyden_updates > 0:
+                    self.__residuals(res.x, sme, spec, uncs, mask, segments=segments)
+                    self.__jacobian(
+                        res.x,
+                        sme,
+                        spec,
+                        uncs,
+                        mask,
+                        bounds=bounds,
+                        segments=segments,
+                        refresh=True,
+                    )
             self.progressbar.close()
             self.progressbar_jacobian.close()
+            logger.info(
+                "Jacobian: %i syntheses (%i without radiative transfer), %i saved compared to central differences",
+                self.jacobian_syntheses,
+                self.jacobian_syntheses_broadening,
+                self.jacobian_syntheses_saved,
+            )
             # The returned jacobian is "scaled for robust loss function"
             res.jac = self._last_jac
             for i, name in enumerate(self.parameter_names):
@@ -625,6 +1223,9 @@ class SME_Solver:
         return sme
 
 
-def solve(sme, param_names=None, segments="all", filename=None):
-    solver = SME_Solver(filename=filename)
-    return solver.solve(sme, param_names, segments)
+def solve(sme, param_names=None, segments="all", filename=None, n_jobs=1, **kwargs):
+    solver = SME_Solver(filename=filename, n_jobs=n_jobs, **kwargs)
+    try:
+        return solver.solve(sme, param_names, segments)
+    finally:
+        solver.close()
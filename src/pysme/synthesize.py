@@ -2,17 +2,24 @@
 Spectral Synthesis Module of SME
 """
 import logging
+import re
 import warnings
+import threading
+from copy import deepcopy
+from contextlib import nullcontext
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 from scipy.constants import speed_of_light
-from scipy.ndimage.filters import convolve
 from scipy.interpolate import interp1d
 
 
 from . import broadening
 from .atmosphere.interpolation import AtmosphereInterpolator
+from . import __version__
+from .cache import LRUCache, SpectrumCache, fingerprint, quantize
 from .continuum_and_radial_velocity import match_rv_continuum
 from .large_file_storage import setup_lfs
 from .iliffe_vector import Iliffe_vector
@@ -23,9 +30,82 @@ logger = logging.getLogger(__name__)
 
 clight = speed_of_light * 1e-3  # km/s
 
+# Cached specific intensities are reused, if their wavelength range covers
+# the requested range, up to this tolerance in km/s. The requested range
+# already includes 30 km/s padding, so this does not affect the result.
+INTENSITY_RANGE_TOLERANCE = 2
+# Additional padding of the wavelength range in km/s, when selecting the lines
+# of the linelist for each segment. Hydrogen lines are always included.
+LINELIST_PADDING = 100
+# Additional padding of the mask windows in km/s, see get_mask_windows
+MASK_WINDOW_PADDING = 5
+# Number of parameter sets, for which the intensity cache keeps the specific
+# intensities of all segments, if its size is determined automatically
+INTENSITY_CACHE_SETS = 2
+# Minimum size of the intensity cache, if its size is determined automatically
+INTENSITY_CACHE_MINSIZE = 32
+
+# The synthesizer of the current worker process, see _init_worker
+_worker_synthesizer = None
+
+
+def _init_worker(config, lfs_atmo, lfs_nlte, linelist_mode, mask_windows):
+    """ Create the synthesizer (and thereby the library instance) of a worker process """
+    global _worker_synthesizer
+    _worker_synthesizer = Synthesizer(
+        config,
+        lfs_atmo,
+        lfs_nlte,
+        linelist_mode=linelist_mode,
+        mask_windows=mask_windows,
+    )
+
+
+def _synthesize_segments_worker(sme, segments, reuse_wavelength_grid, wint, linelist):
+    """
+    Synthesize a chunk of segments in a worker process,
+    see Synthesizer.synthesize_chunk for details
+    """
+    synthesizer = _worker_synthesizer
+    # The NLTE grid data is not pickled with the sme structure,
+    # so we keep our own for as long as the linelist stays the same
+    if linelist != synthesizer._library_linelist:
+        synthesizer._nlte_grid_data = {}
+    sme.nlte.grid_data = synthesizer._nlte_grid_data
+    return synthesizer.synthesize_chunk(
+        sme, segments, reuse_wavelength_grid, wint, linelist
+    )
+
+
+def _synthesize_grid_worker(sme, names, values, indices, segments, linelist):
+    """
+    Synthesize a chunk of grid points in a worker process,
+    see Synthesizer.synthesize_grid_points for details
+    """
+    synthesizer = _worker_synthesizer
+    if linelist != synthesizer._library_linelist:
+        synthesizer._nlte_grid_data = {}
+        synthesizer._library_linelist = linelist
+    sme.nlte.grid_data = synthesizer._nlte_grid_data
+    return list(synthesizer.synthesize_grid_points(sme, names, values, indices, segments))
+
 
 class Synthesizer:
-    def __init__(self, config=None, lfs_atmo=None, lfs_nlte=None, dll=None):
+    def __init__(
+        self,
+        config=None,
+        lfs_atmo=None,
+        lfs_nlte=None,
+        dll=None,
+        n_jobs=1,
+        executor="process",
+        intensity_cache_size=None,
+        linelist_mode="all",
+        spectrum_cache=None,
+        mask_windows=False,
+        atmosphere_cache_size=16,
+        atmosphere_digits=None,
+    ):
         self.config, self.lfs_atmo, self.lfs_nlte = setup_lfs(
             config, lfs_atmo, lfs_nlte
         )
@@ -36,8 +116,98 @@ class Synthesizer:
         self.atmosphere_interpolator = None
         # This stores a reference to the currently used sme structure, so we only log it once
         self.known_sme = None
+        # int: number of workers for the synthesis of the segments
+        # Each worker has its own instance of the library, since it uses global variables
+        self.n_jobs = max(int(n_jobs), 1)
+        # str: whether the workers are processes or threads with private library instances
+        if executor not in ["process", "thread"]:
+            raise ValueError(
+                f"Expected executor to be one of ['process', 'thread'], but got {executor} instead"
+            )
+        self.executor = executor
+        # str: which lines of the linelist to pass to the library
+        # "all": all lines, "range": only the lines within the range of the
+        # synthesized segments, "segment": only the lines of each segment
+        if linelist_mode not in ["all", "range", "segment"]:
+            raise ValueError(
+                f"Expected linelist_mode to be one of ['all', 'range', 'segment'], but got {linelist_mode} instead"
+            )
+        self.linelist_mode = linelist_mode
+        # Executor: the pool of workers, created on first use
+        self._executor = None
+        # The synthesizers of the worker threads, each with a private library instance
+        self._thread_local = threading.local()
+        # Only one thread passes the model data at a time, as this is
+        # mostly python code that also modifies the (shared) sme structure
+        self._prepare_lock = threading.Lock()
+        # str: fingerprint of the linelist passed to the library by synthesize_chunk
+        self._library_linelist = None
+        # dict: NLTE grid data of a worker process
+        self._nlte_grid_data = {}
+        # int: maximum number of entries in the intensity cache, or None to
+        # grow it with the number of segments and windows, see reserve_intensity_cache
+        self.intensity_cache_size = intensity_cache_size
+        # LRUCache: specific intensities of each segment, see synthesize_segment
+        # These only depend on the data passed to the library, and not on
+        # e.g. vsini, vmac, or the instrumental broadening
+        if intensity_cache_size is None:
+            intensity_cache_size = INTENSITY_CACHE_MINSIZE
+        self.intensity_cache = LRUCache(maxsize=intensity_cache_size)
+        # str: fingerprint of the model data passed to the library, see prepare_library
+        self._library_key = None
+        # bool: whether the line opacities in the library belong to the current model
+        self._lineop_ready = False
+        # LRUCache: interpolated atmospheres, see get_atmosphere
+        # These only depend on the grid and teff, logg, and monh, and not on
+        # e.g. the abundances, or the broadening parameters
+        self.atmosphere_cache = LRUCache(maxsize=atmosphere_cache_size)
+        # int: number of significant digits of teff, logg, and monh used for the
+        # atmosphere interpolation, or None to use the exact values.
+        # Rounding lets nearby parameters share the same atmosphere.
+        self.atmosphere_digits = atmosphere_digits
+        # SpectrumCache: complete synthetic spectra of each segment, see get_spectrum_key
+        # This can also be the directory of the cache on disk, or True for a memory only cache
+        if spectrum_cache is True:
+            spectrum_cache = SpectrumCache()
+        elif isinstance(spectrum_cache, str):
+            spectrum_cache = SpectrumCache(directory=spectrum_cache)
+        self.spectrum_cache = spectrum_cache
+        # bool: whether to only synthesize the wavelength windows around
+        # the good pixels of the mask, see get_mask_windows
+        self.mask_windows = mask_windows
         logger.critical("Don't forget to cite your sources. Use sme.citation()")
 
+    def __del__(self):
+        self.close()
+
+    def get_executor(self):
+        """ Return the pool of workers, starting it if necessary """
+        if self._executor is None:
+            if self.executor == "thread":
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.n_jobs, thread_name_prefix="pysme"
+                )
+            else:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.n_jobs,
+                    initializer=_init_worker,
+                    initargs=(
+                        self.config,
+                        self.lfs_atmo,
+                        self.lfs_nlte,
+                        self.linelist_mode,
+                        self.mask_windows,
+                    ),
+                )
+        return self._executor
+
+    def close(self):
+        """ Shut down the workers, if any are running """
+        executor = getattr(self, "_executor", None)
+        if executor is not None:
+            executor.shutdown()
+            self._executor = None
+
     def get_atmosphere(self, sme):
         """
         Return an atmosphere based on specification in an SME structure
@@ -65,6 +235,24 @@ class Synthesizer:
         atmo = sme.atmo
 
         if atmo.method == "grid":
+            # Only interpolate the atmosphere, if it is not in the cache
+            teff, logg, monh = sme.teff, sme.logg, sme.monh
+            if self.atmosphere_digits is not None:
+                digits = self.atmosphere_digits
+                teff = quantize(teff, digits)
+                logg = quantize(logg, digits)
+                monh = quantize(monh, digits)
+            # The key uses the requested settings, the interpolated atmosphere
+            # then sets them to the values it used (e.g. geom None -> "PP")
+            key = fingerprint(
+                atmo.source, atmo.depth, atmo.interp, atmo.geom, teff, logg, monh,
+            )
+            cached = self.atmosphere_cache.get(key)
+            if cached is not None:
+                # The cached atmosphere must not be changed by the caller
+                sme.atmo = deepcopy(cached)
+                return sme
+
             if self.atmosphere_interpolator is None:
                 self.atmosphere_interpolator = AtmosphereInterpolator(
                     depth=atmo.depth,
@@ -78,8 +266,16 @@ class Synthesizer:
                 self.atmosphere_interpolator.geom = atmo.geom
 
             atmo = self.atmosphere_interpolator.interp_atmo_grid(
-                atmo.source, sme.teff, sme.logg, sme.monh
+                atmo.source, teff, logg, monh
+            )
+            self.atmosphere_cache.put(key, deepcopy(atmo))
+            # Also store it under its own settings, since that is
+            # what the next call with this sme structure requests
+            result_key = fingerprint(
+                atmo.source, atmo.depth, atmo.interp, atmo.geom, teff, logg, monh,
             )
+            if result_key != key:
+                self.atmosphere_cache.put(result_key, deepcopy(atmo))
         elif atmo.method == "routine":
             atmo = atmo.source(sme, atmo)
         elif atmo.method == "embedded":
@@ -324,101 +520,57 @@ class Synthesizer:
             2 * np.arange(nfine, dtype=float) - os + 1
         )  # oversampled points indices
 
-        # Loop through annuli, constructing and convolving with rotation kernels.
-
-        yfine = np.empty(nfine)  # init oversampled intensities
-        flux = np.zeros(nfine)  # init flux vector
+        # Use external cubic spline routine (adapted from Numerical Recipes) to make
+        # an oversampled version of the intensity profiles for all annuli.
+        if os == 1:
+            # just copy (use) original profiles
+            yfine = inten[isort]
+        else:
+            # spline onto fine wavelength scale
+            yfine = interp1d(xpix, inten[isort], kind="cubic", axis=1)(xfine)
+
+        # Loop through annuli, constructing the rotation and macroturbulence kernels.
+        # The kernels of all annuli are then applied at once, see broadening.convolve_rows.
+        # The kernels are cached, as they are the same for most calls.
+        rkernels = []
+        mkernels = []
         for imu in range(nmu):  # loop thru integration annuli
 
-            #  Use external cubic spline routine (adapted from Numerical Recipes) to make
-            #  an oversampled version of the intensity profile for the current annulus.
-            ypix = inten[isort[imu]]  # extract intensity profile
-            if os == 1:
-                # just copy (use) original profile
-                yfine = ypix
-            else:
-                # spline onto fine wavelength scale
-                yfine = interp1d(xpix, ypix, kind="cubic")(xfine)
-
             # Construct the convolution kernel which describes the distribution of
-            # rotational velocities present in the current annulus. The distribution has
-            # been derived analytically for annuli of arbitrary thickness in a rigidly
-            # rotating star. The kernel is constructed in two pieces: o!= piece for
-            # radial velocities less than the maximum velocity along the inner edge of
-            # the annulus, and one piece for velocities greater than this limit.
+            # rotational velocities present in the current annulus.
             if vsini > 0:
                 # nontrivial case
                 r1 = r[imu]  # inner edge of annulus
                 r2 = r[imu + 1]  # outer edge of annulus
                 dv = deltav / os  # oversampled velocity spacing
-                maxv = vsini * r2  # maximum velocity in annulus
-                nrk = 2 * int(maxv / dv) + 3  ## oversampled kernel point
-                # velocity scale for kernel
-                v = dv * (np.arange(nrk, dtype=float) - ((nrk - 1) / 2))
-                rkern = np.zeros(nrk)  # init rotational kernel
-                j1 = np.abs(v) < vsini * r1  # low velocity points
-                rkern[j1] = np.sqrt((vsini * r2) ** 2 - v[j1] ** 2) - np.sqrt(
-                    (vsini * r1) ** 2 - v[j1] ** 2
-                )  # generate distribution
-
-                j2 = (np.abs(v) >= vsini * r1) & (np.abs(v) <= vsini * r2)
-                rkern[j2] = np.sqrt(
-                    (vsini * r2) ** 2 - v[j2] ** 2
-                )  # generate distribution
-
-                rkern = rkern / np.sum(rkern)  # normalize kernel
-
-                # Convolve the intensity profile with the rotational velocity kernel for this
-                # annulus. Pad each end of the profile with as many points as are in the
-                # convolution kernel. This reduces Fourier ringing. The convolution may also
-                # be do!= with a routi!= called "externally" from IDL, which efficiently
-                # shifts and adds.
-                if nrk > 3:
-                    yfine = convolve(yfine, rkern, mode="nearest")
-
-            # Calculate projected sigma for radial and tangential velocity distributions.
+                rkern = broadening.rotation_kernel(vsini, r1, r2, dv)
+            else:
+                rkern = np.ones(1)  # delta function, i.e. no rotation
+            rkernels.append(rkern)
+
+            # Calculate sigma for the radial and tangential velocity distributions.
             muval = mu[isort[imu]]  # current value of mu
             sigma = os * vrt / np.sqrt(2) / deltav  # standard deviation in points
-            sigr = sigma * muval  # reduce by current mu value
-            sigt = sigma * np.sqrt(1.0 - muval ** 2)  # reduce by np.sqrt(1-mu**2)
 
             # Figure out how many points to use in macroturbulence kernel.
             nmk = int(10 * sigma)
             nmk = np.clip(nmk, 3, (nfine - 3) // 2)
 
-            # Construct radial macroturbulence kernel with a sigma of mu*VRT/np.sqrt(2).
-            if sigr > 0:
-                xarg = np.linspace(-nmk, nmk, 2 * nmk + 1) / sigr
-                xarg = np.clip(-0.5 * xarg ** 2, -20, None)
-                mrkern = np.exp(xarg)  # compute the gaussian
-                mrkern = mrkern / np.sum(mrkern)  # normalize the profile
-            else:
-                mrkern = np.zeros(2 * nmk + 1)  # init with 0d0
-                mrkern[nmk] = 1.0  # delta function
-
-            # Construct tangential kernel with a sigma of np.sqrt(1-mu**2)*VRT/np.sqrt(2).
-            if sigt > 0:
-                xarg = np.linspace(-nmk, nmk, 2 * nmk + 1) / sigt
-                xarg = np.clip(-0.5 * xarg ** 2, -20, None)
-                mtkern = np.exp(xarg)  # compute the gaussian
-                mtkern = mtkern / np.sum(mtkern)  # normalize the profile
-            else:
-                mtkern = np.zeros(2 * nmk + 1)  # init with 0d0
-                mtkern[nmk] = 1.0  # delta function
-
-            # Sum the radial and tangential components, weighted by surface area.
-            area_r = 0.5  # assume equal areas
-            area_t = 0.5  # ar+at must equal 1
-            mkern = area_r * mrkern + area_t * mtkern  # add both components
+            # Construct the macroturbulence kernel, with the radial and tangential
+            # components weighted by surface area.
+            mkern = broadening.macroturbulence_kernel(sigma, muval, nmk)
+            mkernels.append(mkern)
 
-            # Convolve the total flux profiles, again padding the spectrum on both ends to
-            # protect against Fourier ringing.
-            yfine = convolve(
-                yfine, mkern, mode="nearest"
-            )  # add the padding and convolve
+        # Convolve the intensity profiles with the rotational velocity kernels of their
+        # annulus. Then convolve the total flux profiles with the macroturbulence kernels.
+        # Each end of the profiles is padded with the edge values, to protect against
+        # Fourier ringing. Large kernels are convolved using FFTs for all annuli at once.
+        if vsini > 0:
+            yfine = broadening.convolve_rows(yfine, rkernels)
+        yfine = broadening.convolve_rows(yfine, mkernels)
 
-            # Add contribution from current annulus to the running total.
-            flux = flux + wt[imu] * yfine  # add profile to running total
+        # Add the contributions from all annuli
+        flux = np.dot(wt, yfine)
 
         flux = np.reshape(flux, (npts, os))  # convert to an array
         flux = np.pi * np.sum(flux, axis=1) / os  # sum, normalize
@@ -505,24 +657,27 @@ class Synthesizer:
         if "wave" in sme:
             wave = [w for w in sme.wave]
 
-        # Input Model data to C library
-        self.dll.SetLibraryPath()
-        if passLineList:
-            self.dll.InputLineList(sme.linelist)
-        if updateLineList:
-            # TODO Currently Updates the whole linelist, could be improved to only change affected lines
-            self.dll.UpdateLineList(
-                sme.atomic, sme.species, np.arange(len(sme.linelist))
-            )
+        # Reuse the spectra of segments we synthesized before
+        # This avoids the library entirely
+        cached = {}
+        keys = {}
+        if self.spectrum_cache is not None and not sme.specific_intensities_only:
+            # Most parameters are the same for all segments
+            base = self.get_spectrum_base_key(sme)
+            for il in segments:
+                keys[il] = self.get_spectrum_key(
+                    sme, il, reuse_wavelength_grid, base=base
+                )
+                entry = self.spectrum_cache.get(keys[il])
+                if entry is not None:
+                    cached[il] = entry
+            logger.debug("Spectrum cache: %s", self.spectrum_cache.stats())
+        missing = [il for il in segments if il not in cached]
+
+        # Even if all segments are cached, sme.atmo has to match the parameters.
+        # This is cheap, since the atmospheres are cached as well
         if passAtmosphere:
             sme = self.get_atmosphere(sme)
-            self.dll.InputModel(sme.teff, sme.logg, sme.vmic, sme.atmo)
-            self.dll.InputAbund(sme.abund)
-            self.dll.Ionization(0)
-            self.dll.SetVWscale(sme.gam6)
-            self.dll.SetH2broad(sme.h2broad)
-        if passNLTE:
-            sme.nlte.update_coefficients(sme, self.dll, self.lfs_nlte)
 
         # Loop over segments
         #   Input Wavelength range and Opacity
@@ -530,14 +685,48 @@ class Synthesizer:
         #   Interpolate onto geomspaced wavelength grid
         #   Apply instrumental and turbulence broadening
 
-        # TODO Parallelization
-        # This requires changes in the C code however, since SME uses global parameters
-        # for the wavelength range (and opacities) which change within each segment
-        for il in tqdm(segments, desc="Segment", leave=False):
-            wmod[il], smod[il], cmod[il] = self.synthesize_segment(
-                sme, il, reuse_wavelength_grid, il != segments[0]
+        # SME uses global parameters for the wavelength range (and opacities)
+        # which change within each segment. Therefore parallelization uses
+        # worker processes, each with their own instance of the library
+        nlte_flags = None
+        if len(missing) == 0:
+            pass
+        elif self.n_jobs > 1 and len(missing) > 1:
+            result, nlte_flags = self.synthesize_segments_parallel(
+                sme, missing, reuse_wavelength_grid
             )
+            for il in missing:
+                wmod[il], smod[il], cmod[il] = result[il]
+        else:
+            result, nlte_flags = self.synthesize_segments(
+                sme,
+                missing,
+                reuse_wavelength_grid,
+                passLineList=passLineList,
+                passAtmosphere=passAtmosphere,
+                passNLTE=passNLTE,
+                updateLineList=updateLineList,
+            )
+            for il in missing:
+                wmod[il], smod[il], cmod[il] = result[il]
+
+        for il in missing:
+            if il in keys:
+                entry = {
+                    "wave": wmod[il],
+                    "synth": smod[il],
+                    "cont": cmod[il],
+                    "wint": self.wint[il],
+                    "nlte_flags": nlte_flags,
+                }
+                self.spectrum_cache.put(keys[il], entry)
+        for il, entry in cached.items():
+            wmod[il], smod[il], cmod[il] = entry["wave"], entry["synth"], entry["cont"]
+            self.wint[il] = entry["wint"]
+            flags = entry["nlte_flags"]
+            nlte_flags = flags if nlte_flags is None else nlte_flags | flags
 
+        for il in segments:
             if "wave" not in sme or len(sme.wave[il]) == 0:
                 # trim padding
                 wbeg, wend = sme.wran[il]
@@ -551,8 +740,16 @@ class Synthesizer:
         # Fit continuum and radial velocity
         # And interpolate the flux onto the wavelength grid
         if radial_velocity_mode == "robust":
+            # The segments are fit independently, reuse the pool of workers
+            executor = self.get_executor() if self.n_jobs > 1 else None
             cscale, cscale_unc, vrad, vrad_unc = match_rv_continuum(
-                sme, segments, wmod, smod
+                sme,
+                segments,
+                wmod,
+                smod,
+                n_jobs=self.n_jobs,
+                executor=executor,
+                dll=self.dll,
             )
             logger.debug("Radial velocity: %s", str(vrad))
             logger.debug("Continuum coefficients: %s", str(cscale))
@@ -588,7 +785,7 @@ class Synthesizer:
 
             sme.vrad = np.asarray(vrad)
             sme.vrad_unc = np.asarray(vrad_unc)
-            sme.nlte.flags = self.dll.GetNLTEflags()
+            sme.nlte.flags = nlte_flags
             return sme
         else:
             wave = Iliffe_vector(values=wave)
@@ -596,6 +793,853 @@ class Synthesizer:
             cmod = Iliffe_vector(values=cmod)
             return wave, smod, cmod
 
+    @staticmethod
+    def sort_grid(table):
+        """
+        Order of the grid points, that maximizes the reuse of intermediary results
+
+        The points are sorted by the atmosphere parameters first, then by
+        the parameters that affect the radiative transfer, and finally by
+        the parameters that only affect the broadening and continuum.
+        That way the interpolated atmospheres, NLTE coefficients,
+        and specific intensities can be reused for consecutive points.
+
+        Parameters
+        ----------
+        table : DataFrame
+            parameter values of each grid point
+
+        Returns
+        -------
+        order : array(int)
+            indices of the grid points in the order they should be synthesized
+        """
+        first = ["teff", "logg", "monh"]
+        last = ["vmac", "vsini", "ipres", "vrad", "cscale"]
+        names = [n for n in first if n in table.columns]
+        names += [n for n in table.columns if n not in first and n not in last]
+        names += [n for n in last if n in table.columns]
+        # lexsort uses the last key as the primary key
+        keys = [table[n].to_numpy() for n in names[::-1]]
+        if len(keys) == 0:
+            return np.arange(len(table))
+        return np.lexsort(keys)
+
+    def synthesize_grid_points(self, sme, names, values, indices, segments="all"):
+        """
+        Synthesize the given points of a parameter grid one after the other
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure with the fixed parameters, it is modified in place
+        names : list(str)
+            names of the parameters, as in sme[name]
+        values : array of shape (npoints, nparam)
+            parameter values of each point
+        indices : array(int)
+            indices of the points in the parameter table
+        segments : str, list(int), optional
+            the segments to synthesize (default: "all")
+
+        Yields
+        ------
+        index : int
+            index of the point in the parameter table
+        wave, synth, cont : Iliffe_vector
+            wavelength, synthetic spectrum, and continuum of the point
+        """
+        for index, row in zip(indices, values):
+            for name, value in zip(names, row):
+                sme[name] = value
+            # The radial velocity and continuum are not fitted,
+            # but the values in sme are applied
+            wave, synth, cont = self.synthesize_spectrum(
+                sme, segments, updateStructure=False, radial_velocity_mode="fast"
+            )
+            yield index, wave, synth, cont
+
+    def iter_grid(self, sme, parameter_table, segments="all"):
+        """
+        Synthesize the spectra of a grid of parameters, one at a time
+
+        The points are synthesized in the order given by sort_grid,
+        so that e.g. the linelist is only passed to the library once, and the
+        atmospheres and specific intensities are reused where possible.
+        All spectra use the same wavelength grid, which is sme.wave, or the
+        adaptive wavelength grid of the first point if sme.wave is not set.
+        If n_jobs > 1 the points are split between the workers, in chunks
+        of consecutive points, and yielded as they become available.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure with the fixed parameters, it is not modified
+        parameter_table : DataFrame, dict, structured array
+            values of the parameters of each point. The column names
+            are the names of the parameters as in sme[name], e.g. "teff" or "abund Fe"
+        segments : str, list(int), optional
+            the segments to synthesize (default: "all")
+
+        Yields
+        ------
+        index : int
+            index of the point in the parameter table
+        wave, synth, cont : Iliffe_vector
+            wavelength, synthetic spectrum, and continuum of the point
+        """
+        table = pd.DataFrame(parameter_table)
+        if len(table) == 0:
+            return
+        names = list(table.columns)
+        values = table.to_numpy()
+        order = self.sort_grid(table)
+        segments = self.check_segments(sme, segments)
+
+        # Keep the original structure as it is
+        sme = deepcopy(sme)
+
+        # Use the wavelength grid of the first point for all others
+        if "wave" not in sme or any(len(sme.wave[s]) == 0 for s in segments):
+            first = order[:1]
+            for index, wave, synth, cont in self.synthesize_grid_points(
+                sme, names, values[first], first, segments
+            ):
+                sme.wave = wave
+                yield index, wave, synth, cont
+            order = order[1:]
+
+        if self.n_jobs == 1 or len(order) <= 1:
+            yield from self.synthesize_grid_points(
+                sme, names, values[order], order, segments
+            )
+            return
+
+        # Several chunks per worker, to balance the load
+        executor = self.get_executor()
+        nchunks = min(4 * self.n_jobs, len(order))
+        chunks = np.array_split(order, nchunks)
+        linelist = fingerprint(sme.linelist)
+        futures = []
+        for chunk in chunks:
+            if self.executor == "thread":
+                # Each thread modifies its own structure
+                future = executor.submit(
+                    self._synthesize_grid_thread,
+                    deepcopy(sme),
+                    names,
+                    values[chunk],
+                    chunk,
+                    segments,
+                )
+            else:
+                future = executor.submit(
+                    _synthesize_grid_worker,
+                    sme,
+                    names,
+                    values[chunk],
+                    chunk,
+                    segments,
+                    linelist,
+                )
+            futures += [future]
+
+        for future in as_completed(futures):
+            yield from future.result()
+
+    def synthesize_grid(self, sme, parameter_table, segments="all", out=None):
+        """
+        Synthesize the spectra of a grid of parameters into an array
+
+        See iter_grid for details.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure with the fixed parameters, it is not modified
+        parameter_table : DataFrame, dict, structured array
+            values of the parameters of each point, see iter_grid
+        segments : str, list(int), optional
+            the segments to synthesize (default: "all")
+        out : array of shape (npoints, npixels), optional
+            preallocated array (e.g. a memory mapped file) for the spectra.
+            npixels is the total number of wavelength points in the segments.
+            If None, a new array is created.
+
+        Returns
+        -------
+        wave : array of shape (npixels,)
+            the wavelength grid of the spectra
+        out : array of shape (npoints, npixels)
+            the synthetic spectra, in the order of the parameter table
+        """
+        npoints = len(pd.DataFrame(parameter_table))
+        segments = self.check_segments(sme, segments)
+        wave = None
+        for index, wseg, synth, _ in self.iter_grid(sme, parameter_table, segments):
+            synth = np.concatenate([synth[s] for s in segments])
+            if wave is None:
+                wave = np.concatenate([wseg[s] for s in segments])
+                if out is None:
+                    out = np.zeros((npoints, wave.size))
+                elif out.shape != (npoints, wave.size):
+                    raise ValueError(
+                        f"Expected out to have shape {(npoints, wave.size)}, but got {out.shape} instead"
+                    )
+            out[index] = synth
+        return wave, out
+
+    def prepare_library(
+        self,
+        sme,
+        passLineList=True,
+        passAtmosphere=True,
+        passNLTE=True,
+        updateLineList=False,
+        lines=None,
+        state=None,
+    ):
+        """
+        Pass the model data of the SME structure to the C library
+
+        The atmosphere needs to be set in sme.atmo already, see get_atmosphere.
+        Only the data that changed since the last call is passed to the library,
+        and only the stages that depend on it (e.g. Ionization) are run again.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with all necessary parameters for the calculation
+        passLineList : bool, optional
+            wether to pass the linelist to the c library (default: True)
+        passAtmosphere : bool, optional
+            wether to pass the atmosphere to the c library (default: True)
+        passNLTE : bool, optional
+            wether to pass NLTE departure coefficients to the c library (default: True)
+        updateLineList : bool, optional
+            wether to update the atomic data of the linelist in the c library (default: False)
+        lines : array(int), optional
+            indices of the lines in sme.linelist to pass to the library,
+            by default all lines are passed
+        state : dict, optional
+            fingerprints of the model data for all lines, see get_library_state.
+            By default they are calculated from sme.
+        """
+        self.dll.SetLibraryPath()
+        # The line opacities need to be calculated again for the new model
+        self._lineop_ready = False
+
+        # Only pass the data that changed since the last call
+        # The library object keeps track of what has been passed to it
+        linelist = sme.linelist if lines is None else sme.linelist[lines]
+        state = self.get_library_state(sme, lines, state)
+        passed = self.dll.input_state
+        self._library_key = fingerprint(state)
+
+        def changed(stage):
+            return passed.get(stage) != state[stage]
+
+        if passLineList and changed("linelist"):
+            self.dll.InputLineList(linelist)
+            passed["linelist"] = state["linelist"]
+        if updateLineList:
+            # TODO Currently Updates the whole linelist, could be improved to only change affected lines
+            self.dll.UpdateLineList(
+                linelist.atomic, linelist.species, np.arange(len(linelist))
+            )
+            passed["linelist"] = state["linelist"]
+        if passAtmosphere:
+            if changed("model"):
+                self.dll.InputModel(sme.teff, sme.logg, sme.vmic, sme.atmo)
+                passed["model"] = state["model"]
+            if changed("abund"):
+                self.dll.InputAbund(sme.abund)
+                passed["abund"] = state["abund"]
+            if changed("ionization"):
+                self.dll.Ionization(0)
+                passed["ionization"] = state["ionization"]
+            if changed("vw_scale"):
+                self.dll.SetVWscale(sme.gam6)
+                passed["vw_scale"] = state["vw_scale"]
+            if changed("h2broad"):
+                self.dll.SetH2broad(sme.h2broad)
+                passed["h2broad"] = state["h2broad"]
+        if passNLTE and changed("nlte"):
+            sme.nlte.update_coefficients(sme, self.dll, self.lfs_nlte, lines=lines)
+            passed["nlte"] = state["nlte"]
+
+    @staticmethod
+    def get_library_state(sme, lines=None, state=None):
+        """
+        Fingerprints of the model data that is passed to the library
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the atmosphere already set
+        lines : array(int), optional
+            indices of the lines passed to the library, by default all lines
+        state : dict, optional
+            the fingerprints of sme for all lines, as returned by this function.
+            Then only the stages that depend on the selected lines are updated.
+
+        Returns
+        -------
+        state : dict
+            fingerprint of the data of each input stage of the library
+        """
+        if state is None:
+            nlte = sme.nlte
+            state = {
+                "linelist": fingerprint(sme.linelist),
+                "model": fingerprint(sme.teff, sme.logg, sme.vmic, sme.atmo),
+                "abund": fingerprint(sme.abund),
+                "vw_scale": fingerprint(sme.gam6),
+                "h2broad": fingerprint(sme.h2broad),
+                "nlte_settings": fingerprint(
+                    sme.monh,
+                    nlte.elements,
+                    nlte.grids,
+                    nlte.subgrid_size,
+                    nlte.solar,
+                    nlte.abund_format,
+                    nlte.selection,
+                    nlte.min_energy_diff,
+                ),
+            }
+        state = dict(state)
+        if lines is not None:
+            state["linelist"] = fingerprint(state["linelist"], lines)
+        # The ionization equilibrium is calculated for the species in the linelist
+        state["ionization"] = fingerprint(
+            state["linelist"], state["model"], state["abund"]
+        )
+        # The departure coefficients depend on the model, the abundances,
+        # and the linelist, as well as the NLTE settings
+        state["nlte"] = fingerprint(
+            state["linelist"], state["model"], state["abund"], state["nlte_settings"],
+        )
+        return state
+
+    def get_spectrum_base_key(self, sme):
+        """
+        Fingerprint of the parameters that determine the synthetic spectrum
+        of all segments, see get_spectrum_key
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with all necessary parameters for the calculation
+
+        Returns
+        -------
+        key : str
+            fingerprint of the parameters
+        """
+        atmo = sme.atmo
+        if atmo.method == "grid":
+            # The interpolated atmosphere is determined by these
+            atmo = (atmo.method, atmo.source, atmo.depth, atmo.interp, atmo.geom)
+        nlte = sme.nlte
+        nlte = (
+            nlte.elements,
+            nlte.grids,
+            nlte.subgrid_size,
+            nlte.solar,
+            nlte.abund_format,
+            nlte.selection,
+            nlte.min_energy_diff,
+        )
+        return fingerprint(
+            __version__,
+            self.linelist_mode,
+            sme.teff,
+            sme.logg,
+            sme.monh,
+            sme.vmic,
+            sme.vmac,
+            sme.vsini,
+            sme.abund,
+            sme.linelist,
+            sme.mu,
+            sme.accrt,
+            sme.accwi,
+            sme.gam6,
+            sme.h2broad,
+            sme.normalize_by_continuum,
+            sme.iptype,
+            sme.ip_x,
+            sme.ip_y,
+            atmo,
+            nlte,
+        )
+
+    def get_spectrum_key(self, sme, segment, reuse_wavelength_grid=False, base=None):
+        """
+        Fingerprint of all parameters that determine the synthetic spectrum of a segment
+
+        This is the key of the spectrum cache. It does not require
+        the atmosphere to be interpolated, or the library to be called.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with all necessary parameters for the calculation
+        segment : int
+            the segment to synthesize
+        reuse_wavelength_grid : bool, optional
+            wether the existing adaptive wavelength grid is reused (default: False)
+        base : str, optional
+            fingerprint of the parameters of all segments, see get_spectrum_base_key.
+            By default it is calculated from sme.
+
+        Returns
+        -------
+        key : str
+            fingerprint of the parameters
+        """
+        if base is None:
+            base = self.get_spectrum_base_key(sme)
+        wint = None
+        if reuse_wavelength_grid:
+            wint = self.wint.get(segment)
+        ipres = sme.ipres if np.size(sme.ipres) == 1 else sme.ipres[segment]
+        vrad = sme.vrad[segment] if sme.vrad[segment] is not None else 0
+        windows = self.get_mask_windows(sme, segment) if self.mask_windows else None
+        return fingerprint(base, sme.wran[segment], vrad, ipres, wint, windows)
+
+    def get_linelist_range(self, sme, segment):
+        """
+        Wavelength range of the lines that affect a segment
+
+        This is the range of get_wavelengthrange,
+        with an additional padding of LINELIST_PADDING km/s
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure
+        segment : int
+            the segment
+
+        Returns
+        -------
+        wbeg, wend : float
+            beginning and end of the wavelength range
+        """
+        vrad_seg = sme.vrad[segment] if sme.vrad[segment] is not None else 0
+        wbeg, wend = self.get_wavelengthrange(sme.wran[segment], vrad_seg, sme.vsini)
+        wbeg *= 1 - LINELIST_PADDING / clight
+        wend *= 1 + LINELIST_PADDING / clight
+        return wbeg, wend
+
+    def get_mask_windows(self, sme, segment):
+        """
+        Wavelength windows around the good pixels of the mask in a segment
+
+        Each continuous range of good pixels is padded by the range of
+        get_wavelengthrange, the width of the broadening kernels, and
+        MASK_WINDOW_PADDING. Overlapping windows are merged.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with wave and mask
+        segment : int
+            the segment
+
+        Returns
+        -------
+        windows : list(tuple(float, float)) or None
+            beginning and end wavelength of each window, or None
+            if the whole segment needs to be synthesized
+        """
+        if "wave" not in sme or "mask" not in sme:
+            return None
+        wave = sme.wave[segment]
+        good = sme.mask_good[segment]
+        if wave.size == 0 or not np.any(good) or np.all(good):
+            return None
+
+        idx = np.flatnonzero(good)
+        breaks = np.flatnonzero(np.diff(idx) > 1)
+        wbeg = wave[idx[np.r_[0, breaks + 1]]]
+        wend = wave[idx[np.r_[breaks, -1]]]
+
+        # The broadening kernels need the spectrum within their width
+        # get_wavelengthrange only includes half of vsini
+        vpad = 0.5 * sme.vsini + 3 * sme.vmac + MASK_WINDOW_PADDING
+        if "iptype" in sme:
+            ipres = sme.ipres if np.size(sme.ipres) == 1 else sme.ipres[segment]
+            if ipres > 0:
+                vpad += 3 * clight / ipres
+
+        vrad_seg = sme.vrad[segment] if sme.vrad[segment] is not None else 0
+        segbeg, segend = self.get_wavelengthrange(sme.wran[segment], vrad_seg, sme.vsini)
+        windows = []
+        for wb, we in zip(wbeg, wend):
+            wb, we = self.get_wavelengthrange([wb, we], vrad_seg, sme.vsini)
+            wb = max(wb * (1 - vpad / clight), segbeg)
+            we = min(we * (1 + vpad / clight), segend)
+            if len(windows) > 0 and wb <= windows[-1][1]:
+                windows[-1] = (windows[-1][0], we)
+            else:
+                windows += [(wb, we)]
+        return windows
+
+    def get_element_segments(self, sme, element, segments="all"):
+        """
+        Find the segments with lines of the given element, including molecules
+
+        Changing the abundance of the element only affects these segments,
+        apart from the (tiny) effect on the ionization equilibrium and continuum.
+        Hydrogen and helium affect all segments.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the linelist
+        element : str
+            the element, e.g. "Fe"
+        segments : str, list(int), optional
+            the segments to check (default: "all")
+
+        Returns
+        -------
+        segments : list(int)
+            the segments with lines of the element
+        """
+        segments = self.check_segments(sme, segments)
+        if element in ["H", "He"]:
+            return list(segments)
+
+        # The elements of each species, e.g. "Ti" and "O" for "TiO 1"
+        species = np.asarray(sme.linelist.species, "U")
+        unique = np.unique(species)
+        contains = [s for s in unique if element in re.findall("[A-Z][a-z]?", s.split(" ")[0])]
+        lines = np.isin(species, contains)
+        wlcent = sme.linelist.wlcent[lines]
+
+        result = []
+        for il in segments:
+            wbeg, wend = self.get_linelist_range(sme, il)
+            if np.any((wlcent >= wbeg) & (wlcent <= wend)):
+                result += [il]
+        return result
+
+    def get_segment_lines(self, sme, segments):
+        """
+        Find the lines of the linelist that affect the given segments
+
+        These are the lines within the wavelength range of the segments (see
+        get_wavelengthrange), with an additional padding of LINELIST_PADDING km/s,
+        as well as all hydrogen lines, since their wings extend much further.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the linelist
+        segments : list(int)
+            the segments to find the lines for
+
+        Returns
+        -------
+        lines : array(int) or None
+            sorted indices of the lines in sme.linelist,
+            or None if no lines are within the segments
+        """
+        wlcent = sme.linelist.wlcent
+        species = np.asarray(sme.linelist.species, "U")
+        select = np.char.startswith(species, "H ")
+        for il in segments:
+            wbeg, wend = self.get_linelist_range(sme, il)
+            select |= (wlcent >= wbeg) & (wlcent <= wend)
+
+        if not np.any(select):
+            logger.debug("No lines found in segments %s, using all lines", segments)
+            return None
+        return np.where(select)[0]
+
+    def get_intensity_entries(self, sme, segments):
+        """
+        Number of entries in the intensity cache for one set of parameters
+
+        This is one entry for each window of each segment, see get_mask_windows.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure
+        segments : list(int)
+            the segments
+
+        Returns
+        -------
+        nentries : int
+            number of entries
+        """
+        if not self.mask_windows:
+            return len(segments)
+        nentries = 0
+        for il in segments:
+            windows = self.get_mask_windows(sme, il)
+            nentries += 1 if windows is None else len(windows)
+        return nentries
+
+    def reserve_intensity_cache(self, nentries):
+        """
+        Grow the intensity cache, so that it holds the specific intensities
+        of INTENSITY_CACHE_SETS sets of parameters with nentries entries each
+
+        The cache only grows if its size is determined automatically,
+        i.e. if intensity_cache_size is None.
+
+        Parameters
+        ----------
+        nentries : int
+            number of entries for one set of parameters, see get_intensity_entries
+        """
+        if self.intensity_cache_size is None:
+            maxsize = max(self.intensity_cache.maxsize, INTENSITY_CACHE_SETS * nentries)
+            self.intensity_cache.maxsize = maxsize
+
+    def synthesize_segments(
+        self,
+        sme,
+        segments,
+        reuse_wavelength_grid=False,
+        passLineList=True,
+        passAtmosphere=True,
+        passNLTE=True,
+        updateLineList=False,
+        lock=None,
+        show_progress=True,
+    ):
+        """
+        Pass the model data to the library and synthesize the given segments
+
+        Depending on linelist_mode, only a subset of the linelist is passed
+        to the library, for all segments at once or for each segment.
+        In that case all model data is passed to the library again
+        (if it changed), since it depends on the linelist.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the atmosphere already set
+        segments : list(int)
+            the segments to synthesize
+        reuse_wavelength_grid : bool, optional
+            wether to reuse the existing adaptive wavelength grids (default: False)
+        passLineList, passAtmosphere, passNLTE, updateLineList : bool, optional
+            which data to pass to the library, see prepare_library
+        lock : Lock, optional
+            lock to hold while passing the model data to the library
+        show_progress : bool, optional
+            wether to show a progress bar (default: True)
+
+        Returns
+        -------
+        result : dict
+            wmod, smod, cmod for each segment
+        nlte_flags : array
+            flags of the lines (of the whole linelist) that were calculated in NLTE
+        """
+        if lock is None:
+            lock = nullcontext()
+
+        self.reserve_intensity_cache(self.get_intensity_entries(sme, segments))
+
+        if self.linelist_mode == "segment":
+            groups = [[il] for il in segments]
+        else:
+            groups = [list(segments)]
+
+        # The model data is the same for all groups, only the lines differ
+        with lock:
+            state = self.get_library_state(sme)
+
+        result = {}
+        nlte_flags = None
+        progress = tqdm(
+            total=len(segments), desc="Segment", leave=False, disable=not show_progress
+        )
+        for group in groups:
+            lines = None
+            if self.linelist_mode != "all":
+                lines = self.get_segment_lines(sme, group)
+            # A new linelist requires all other data to be passed again
+            subset = lines is not None
+            with lock:
+                self.prepare_library(
+                    sme,
+                    passLineList=passLineList or subset,
+                    passAtmosphere=passAtmosphere or subset,
+                    passNLTE=passNLTE or subset,
+                    updateLineList=updateLineList,
+                    lines=lines,
+                    state=state,
+                )
+
+            for i, il in enumerate(group):
+                result[il] = self.synthesize_segment(
+                    sme, il, reuse_wavelength_grid, i != 0
+                )
+                progress.update()
+
+            # Map the NLTE flags of the lines in the library to the whole linelist
+            flags = self.dll.GetNLTEflags()
+            if subset:
+                subset_flags = flags
+                flags = np.zeros(len(sme.linelist), dtype=bool)
+                flags[lines] = subset_flags
+            nlte_flags = flags if nlte_flags is None else nlte_flags | flags
+        progress.close()
+        return result, nlte_flags
+
+    def synthesize_segments_parallel(self, sme, segments, reuse_wavelength_grid=False):
+        """
+        Synthesize the segments in the worker processes or threads
+
+        The segments are split into n_jobs chunks of consecutive segments,
+        so that the line opacities can be reused within each chunk.
+        Each worker passes all model data to its own library instance.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the atmosphere already set
+        segments : list(int)
+            the segments to synthesize
+        reuse_wavelength_grid : bool, optional
+            wether to reuse the existing adaptive wavelength grids (default: False)
+
+        Returns
+        -------
+        result : dict
+            wmod, smod, cmod for each segment
+        nlte_flags : array
+            flags of the lines that were calculated in NLTE
+        """
+        executor = self.get_executor()
+        if self.executor == "thread":
+            func = self._synthesize_segments_thread
+        else:
+            func = _synthesize_segments_worker
+
+        nchunks = min(self.n_jobs, len(segments))
+        chunks = np.array_split(np.asarray(segments, dtype=int), nchunks)
+        linelist = fingerprint(sme.linelist)
+
+        futures = []
+        for chunk in chunks:
+            chunk = [int(c) for c in chunk]
+            if reuse_wavelength_grid:
+                wint = {il: self.wint[il] for il in chunk if il in self.wint}
+            else:
+                wint = {}
+            futures += [
+                executor.submit(
+                    func, sme, chunk, reuse_wavelength_grid, wint, linelist
+                )
+            ]
+
+        result = {}
+        nlte_flags = None
+        for future in tqdm(
+            as_completed(futures), total=len(futures), desc="Segment", leave=False
+        ):
+            res, wint, flags = future.result()
+            result.update(res)
+            self.wint.update(wint)
+            # Each worker only knows which lines were NLTE in its own segments
+            nlte_flags = flags if nlte_flags is None else nlte_flags | flags
+        return result, nlte_flags
+
+    def _synthesize_segments_thread(
+        self, sme, segments, reuse_wavelength_grid, wint, linelist
+    ):
+        """
+        Synthesize a chunk of segments in a worker thread,
+        see synthesize_chunk for details
+        """
+        synthesizer = self.get_thread_synthesizer()
+        return synthesizer.synthesize_chunk(
+            sme,
+            segments,
+            reuse_wavelength_grid,
+            wint,
+            linelist,
+            lock=self._prepare_lock,
+        )
+
+    def get_thread_synthesizer(self):
+        """ Return the synthesizer of the current worker thread, creating it if necessary """
+        synthesizer = getattr(self._thread_local, "synthesizer", None)
+        if synthesizer is None:
+            # Each thread needs its own copy of the library, as otherwise
+            # they would overwrite each others global variables
+            dll = SME_DLL(private_instance=True)
+            synthesizer = Synthesizer(
+                self.config,
+                self.lfs_atmo,
+                self.lfs_nlte,
+                dll=dll,
+                linelist_mode=self.linelist_mode,
+                mask_windows=self.mask_windows,
+            )
+            self._thread_local.synthesizer = synthesizer
+        return synthesizer
+
+    def _synthesize_grid_thread(self, sme, names, values, indices, segments):
+        """
+        Synthesize a chunk of grid points in a worker thread,
+        see synthesize_grid_points for details
+        """
+        synthesizer = self.get_thread_synthesizer()
+        return list(synthesizer.synthesize_grid_points(sme, names, values, indices, segments))
+
+    def synthesize_chunk(
+        self, sme, segments, reuse_wavelength_grid, wint, linelist, lock=None
+    ):
+        """
+        Synthesize a chunk of segments, as part of the parallel synthesis
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            sme structure, with the atmosphere already set
+        segments : list(int)
+            the segments to synthesize in this worker
+        reuse_wavelength_grid : bool
+            whether to reuse the adaptive wavelength grid in wint
+        wint : dict
+            adaptive wavelength grids of the segments, from the main synthesizer
+        linelist : str
+            fingerprint of the linelist
+        lock : Lock, optional
+            lock to hold while passing the model data to the library
+
+        Returns
+        -------
+        result : dict
+            wmod, smod, cmod for each segment
+        wint : dict
+            adaptive wavelength grids of the segments
+        nlte_flags : array
+            flags of the lines that were calculated in NLTE
+        """
+        self.wint.update(wint)
+
+        # Only the data that changed is passed to the library, see prepare_library
+        result, nlte_flags = self.synthesize_segments(
+            sme, segments, reuse_wavelength_grid, lock=lock, show_progress=False
+        )
+        self._library_linelist = linelist
+
+        wint = {il: self.wint[il] for il in segments}
+        return result, wint, nlte_flags
+
     def synthesize_segment(
         self, sme, segment, reuse_wavelength_grid=False, keep_line_opacity=False
     ):
@@ -629,8 +1673,12 @@ class Synthesizer:
         vrad_seg = sme.vrad[segment] if sme.vrad[segment] is not None else 0
         wbeg, wend = self.get_wavelengthrange(sme.wran[segment], vrad_seg, sme.vsini)
 
-        self.dll.InputWaveRange(wbeg, wend)
-        self.dll.Opacity()
+        # Only synthesize the windows around the good pixels of the mask
+        windows = None
+        if self.mask_windows:
+            windows = self.get_mask_windows(sme, segment)
+        if windows is None:
+            windows = [(wbeg, wend)]
 
         # Reuse adaptive wavelength grid in the jacobians
         if reuse_wavelength_grid and segment in self.wint.keys():
@@ -638,20 +1686,155 @@ class Synthesizer:
         else:
             wint_seg = None
 
+        wint, sint, cint = [], [], []
+        for iw, (wbeg, wend) in enumerate(windows):
+            wint_win = wint_seg
+            if wint_seg is not None and len(windows) > 1:
+                wint_win = wint_seg[(wint_seg >= wbeg) & (wint_seg <= wend)]
+            w, s, c = self.get_specific_intensities(
+                sme,
+                segment,
+                iw,
+                wbeg,
+                wend,
+                wint_win,
+                keep_line_opacity or iw > 0,
+            )
+            wint += [w]
+            sint += [s]
+            cint += [c]
+
+        # Store the adaptive wavelength grid for the future
+        # if it was newly created
+        if wint_seg is None:
+            self.wint[segment] = wint[0] if len(wint) == 1 else np.concatenate(wint)
+
+        for iw in range(len(windows)):
+            wint[iw], sint[iw], cint[iw] = self.integrate_segment(
+                sme, segment, wint[iw], sint[iw], cint[iw]
+            )
+
+        # Stitch the windows back together
+        # The spectrum between windows is not valid
+        if len(windows) == 1:
+            return wint[0], sint[0], cint[0]
+        return (
+            np.concatenate(wint),
+            np.concatenate(sint, axis=-1),
+            np.concatenate(cint, axis=-1),
+        )
+
+    def get_specific_intensities(
+        self, sme, segment, window, wbeg, wend, wint=None, keep_line_opacity=False
+    ):
+        """
+        Calculate the specific intensities in a wavelength range of a segment
+
+        The results are stored in the intensity cache, and reused if possible.
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            The SME strcuture containing all relevant parameters
+        segment : int
+            the segment to synthesize
+        window : int
+            index of the mask window in the segment, see get_mask_windows
+        wbeg, wend : float
+            the wavelength range to synthesize
+        wint : array, optional
+            the wavelength grid to use, by default the adaptive grid is created
+        keep_line_opacity : bool
+            Whether to reuse existing line opacities or not
+
+        Returns
+        -------
+        wint : array of shape (npoints,)
+            wavelength grid
+        sint : array of shape (nmu, npoints)
+            specific intensities
+        cint : array of shape (nmu, npoints)
+            continuum specific intensities
+        """
+        wint_seg = wint
+
+        # The specific intensities only depend on the data in the library
+        # So we can reuse them if only e.g. vsini or vmac changed
+        key = (
+            self._library_key,
+            segment,
+            window,
+            fingerprint(sme.mu),
+            quantize(sme.accrt),
+            quantize(sme.accwi),
+        )
+        cached = None
+        if self._library_key is not None:
+            cached = self.intensity_cache.get(key)
+        if cached is not None:
+            tolerance = INTENSITY_RANGE_TOLERANCE / clight
+            cbeg, cend, wint, sint, cint = cached
+            if (
+                cbeg > wbeg * (1 + tolerance)
+                or cend < wend * (1 - tolerance)
+                or (
+                    wint_seg is not None
+                    and wint_seg is not wint
+                    and not np.array_equal(wint_seg, wint)
+                )
+            ):
+                cached = None
+
+        if cached is not None:
+            logger.debug("Reuse specific intensities")
+            return wint, sint, cint
+
+        self.dll.InputWaveRange(wbeg, wend)
+        self.dll.Opacity()
+
         # Only calculate line opacities in the first segment
         #   Calculate spectral synthesis for each
         _, wint, sint, cint = self.dll.Transf(
             sme.mu,
             sme.accrt,  # threshold line opacity / cont opacity
             sme.accwi,
-            keep_lineop=keep_line_opacity,
+            keep_lineop=keep_line_opacity and self._lineop_ready,
             wave=wint_seg,
         )
-        # Store the adaptive wavelength grid for the future
-        # if it was newly created
-        if wint_seg is None:
-            self.wint[segment] = wint
+        self._lineop_ready = True
+
+        # The cached arrays are shared, so make sure they are not changed
+        for arr in (wint, sint, cint):
+            arr.flags.writeable = False
+        if self._library_key is not None:
+            self.intensity_cache.put(key, (wbeg, wend, wint, sint, cint))
+        return wint, sint, cint
 
+    def integrate_segment(self, sme, segment, wint, sint, cint):
+        """
+        Integrate the specific intensities over the stellar disk,
+        and apply the broadening
+
+        Parameters
+        ----------
+        sme : SME_Struct
+            The SME strcuture containing all relevant parameters
+        segment : int
+            the segment
+        wint : array of shape (npoints,)
+            wavelength grid of the specific intensities
+        sint, cint : array of shape (nmu, npoints)
+            specific intensities of the spectrum and continuum
+
+        Returns
+        -------
+        wgrid : array
+            Wavelength grid of the synthesized spectrum
+        flux : array
+            The Flux of the synthesized spectrum
+        cont_flux : array
+            The continuum Flux of the synthesized spectrum
+        """
         if not sme.specific_intensities_only:
             # Create new geomspaced wavelength grid, to be used for intermediary steps
             wgrid, vstep = self.new_wavelength_grid(wint)
@@ -683,11 +1866,17 @@ class Synthesizer:
 
         # Divide calculated spectrum by continuum
         if sme.normalize_by_continuum:
-            sint /= cint
+            sint = sint / cint
 
         return wint, sint, cint
 
-
-def synthesize_spectrum(sme, segments="all"):
-    synthesizer = Synthesizer()
-    return synthesizer.synthesize_spectrum(sme, segments)
+def synthesize_spectrum(
+    sme, segments="all", n_jobs=1, executor="process", spectrum_cache=None
+):
+    synthesizer = Synthesizer(
+        n_jobs=n_jobs, executor=executor, spectrum_cache=spectrum_cache
+    )
+    try:
+        return synthesizer.synthesize_spectrum(sme, segments)
+    finally:
+        synthesizer.close()
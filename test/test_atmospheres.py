@@ -1,7 +1,7 @@
 # TODO implement atmosphere tests
 import pytest
 import numpy as np
-from pysme.atmosphere.atmosphere import Atmosphere
+from pysme.atmosphere.atmosphere import Atmosphere, AtmosphereError, AtmosphereGrid
 from pysme.atmosphere.savfile import SavFile
 from pysme.atmosphere.interpolation import AtmosphereInterpolator
 from pysme.large_file_storage import setup_atmo
@@ -58,3 +58,92 @@ def test_grid_point(atmosphere_name, atmosphere_grid, lfs_atmo, interpolator):
     assert np.allclose(atmo_interp.rho, atmo_grid.rho[1:])
     assert np.allclose(atmo_interp.xna, atmo_grid.xna[1:])
     assert np.allclose(atmo_interp.xne, atmo_grid.xne[1:])
+
+
+@skipif_lfs
+@pytest.mark.usefixtures("lfs_atmo")
+def test_native_grid(atmosphere_name, atmosphere_grid, lfs_atmo, tmp_path):
+    fname = str(tmp_path / "grid.native")
+    atmosphere_grid.save_native(fname)
+    native = SavFile.load_native(fname)
+
+    assert native.source == atmosphere_grid.source
+    assert native.geom == atmosphere_grid.geom
+    assert not native.flags.writeable
+    for name in atmosphere_grid.dtype.names:
+        assert np.all(native[name] == atmosphere_grid[name])
+
+    # Loading the grid again uses the (read-only) native file
+    name = lfs_atmo.get(atmosphere_name)
+    assert not SavFile(name).flags.writeable
+
+
+def test_corner_models():
+    teff, logg, monh = np.meshgrid([4000, 5000, 6000], [3, 4, 5], [-1, 0])
+    grid = AtmosphereGrid(teff.size, 10)
+    grid.teff, grid.logg, grid.monh = teff.ravel(), logg.ravel(), monh.ravel()
+
+    interpolator = AtmosphereInterpolator()
+    icor = interpolator.find_corner_models(5500, 4.2, -0.5, grid)
+    assert icor.shape == (2, 2, 2)
+    assert np.all(grid.teff[icor[..., 0]] == 5000)
+    assert np.all(grid.teff[icor[..., 1]] == 6000)
+    assert np.all(grid.logg[icor[:, 0]] == 4)
+    assert np.all(grid.logg[icor[:, 1]] == 5)
+    assert np.all(grid.monh[icor[0]] == -1)
+    assert np.all(grid.monh[icor[1]] == 0)
+
+    # The index is kept with the grid
+    index = interpolator.get_grid_index(grid)
+    assert interpolator.get_grid_index(grid) is index
+
+
+@skipif_lfs
+@pytest.mark.usefixtures("lfs_atmo")
+def test_pair_cache(atmosphere_name, interpolator):
+    atmo = interpolator.interp_atmo_grid(atmosphere_name, 5750, 4.3, -0.1)
+    assert interpolator.pair_cache.misses == 7
+
+    # Within the same grid cell, all shifts are already known
+    atmo2 = interpolator.interp_atmo_grid(atmosphere_name, 5760, 4.3, -0.1)
+    assert interpolator.pair_cache.hits == 7
+
+    interpolator.pair_cache.clear()
+    atmo3 = interpolator.interp_atmo_grid(atmosphere_name, 5760, 4.3, -0.1)
+    assert interpolator.pair_cache.hits == 0
+    assert np.allclose(atmo2.temp, atmo3.temp)
+    assert not np.allclose(atmo.temp, atmo2.temp)
+
+
+@skipif_lfs
+@pytest.mark.usefixtures("lfs_atmo")
+def test_interp_batch(atmosphere_name, interpolator):
+    teff = [5750, 5760, 5000]
+    logg = [4.3, 4.3, 4.0]
+    monh = -0.1
+    atmos = interpolator.interp_atmo_grid_batch(atmosphere_name, teff, logg, monh)
+    assert isinstance(atmos, AtmosphereGrid)
+    assert atmos.shape == (3,)
+
+    for k in range(3):
+        atmo = interpolator.interp_atmo_grid(atmosphere_name, teff[k], logg[k], monh)
+        assert np.allclose(atmos.temp[k], atmo.temp, rtol=1e-5)
+        assert np.allclose(atmos.rhox[k], atmo.rhox, rtol=1e-5)
+        assert np.isclose(atmos.teff[k], atmo.teff)
+        assert atmos.geom == atmo.geom
+
+
+@skipif_lfs
+@pytest.mark.usefixtures("lfs_atmo")
+def test_interp_batch_mixed_geometry(atmosphere_name, interpolator, monkeypatch):
+    correction = interpolator.spherical_model_correction
+
+    def mixed(atmo_grid, icor, logg):
+        _, radius = correction(atmo_grid, icor, logg)
+        return ("SPH" if logg < 4.1 else "PP"), radius
+
+    monkeypatch.setattr(interpolator, "spherical_model_correction", mixed)
+    with pytest.raises(AtmosphereError):
+        interpolator.interp_atmo_grid_batch(
+            atmosphere_name, [5750, 5000], [4.3, 4.0], -0.1
+        )
@@ -0,0 +1,50 @@
+import pytest
+import numpy as np
+from scipy.ndimage import convolve
+
+from pysme.broadening import convolve_rows, gaussbroad, gauss_kernel, kernel_cache
+
+
+@pytest.fixture
+def rows():
+    rng = np.random.default_rng(0)
+    return rng.random((5, 500))
+
+
+@pytest.mark.parametrize("method", ["auto", "direct", "fft"])
+def test_convolve_rows(rows, method):
+    rng = np.random.default_rng(1)
+    # Different (and asymmetric) kernels for each row
+    kernels = [rng.random(2 * n + 1) for n in [0, 2, 10, 40, 300]]
+
+    result = convolve_rows(rows, kernels, method=method)
+    expected = [convolve(r, k, mode="nearest") for r, k in zip(rows, kernels)]
+
+    assert result.shape == rows.shape
+    assert np.allclose(result, expected)
+
+
+def test_convolve_rows_input(rows):
+    with pytest.raises(ValueError):
+        convolve_rows(rows, [np.ones(3)])
+    with pytest.raises(ValueError):
+        convolve_rows(rows, [np.ones(4)] * 5)
+    with pytest.raises(ValueError):
+        convolve_rows(rows, [np.ones(3)] * 5, method="spline")
+
+
+def test_kernel_cache():
+    kernel_cache.clear()
+    w = np.linspace(6000, 6010, 1001)
+    s = np.random.default_rng(0).random(1001)
+
+    s1 = gaussbroad(w, s, 0.1)
+    s2 = gaussbroad(w, s, 0.1)
+    assert np.all(s1 == s2)
+    assert kernel_cache.misses == 1
+    assert kernel_cache.hits == 1
+
+    # Cached kernels must not be changed by accident
+    kernel = gauss_kernel(0.1, w[1] - w[0])
+    with pytest.raises(ValueError):
+        kernel[0] = 1
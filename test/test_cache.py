@@ -0,0 +1,101 @@
+from os.path import dirname
+
+import numpy as np
+import pytest
+
+from pysme.cache import (
+    LRUCache,
+    SpectrumCache,
+    fingerprint,
+    linelist_fingerprint,
+    quantize,
+)
+from pysme.linelist.vald import ValdFile
+from pysme.sme import SME_Structure as SME_Struct
+
+
+def test_lru_cache():
+    cache = LRUCache(maxsize=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    # "b" is now the least recently used entry
+    cache.put("c", 3)
+    assert "b" not in cache
+    assert cache.get("b") is None
+    assert len(cache) == 2
+
+    assert cache.hits == 1
+    assert cache.misses == 1
+    assert cache.hit_ratio == 0.5
+
+    cache.clear()
+    assert len(cache) == 0
+    assert cache.hits == 0
+
+
+def test_quantize():
+    assert quantize(0) == 0
+    assert quantize(1.00000000001) == 1
+    assert quantize(1.0001) != 1
+    assert quantize(1e-20 + 1e-32) == 1e-20
+
+
+def test_fingerprint():
+    a = np.linspace(0, 1, 10)
+    assert fingerprint(a, 1, "x") == fingerprint(a.copy(), 1, "x")
+    assert fingerprint(a) != fingerprint(a[::-1])
+    assert fingerprint({"a": 1, "b": 2}) == fingerprint({"b": 2, "a": 1})
+
+
+def test_linelist_fingerprint():
+    sme = SME_Struct()
+    sme.linelist = ValdFile(f"{dirname(__file__)}/testcase1.lin")
+    linelist = sme.linelist
+    key = linelist_fingerprint(linelist)
+    assert fingerprint(linelist) == fingerprint(linelist)
+    assert linelist._fingerprint == (linelist._version, key)
+
+    # Changes through the sme structure are noticed
+    sme["linelist 0 gflog"] = sme["linelist 0 gflog"] + 1
+    assert linelist_fingerprint(linelist) != key
+
+    # And so are changes through the linelist
+    key = linelist_fingerprint(linelist)
+    linelist["gflog", 1] = linelist["gflog"][1] + 1
+    assert linelist_fingerprint(linelist) != key
+
+    # While changes in place are rejected
+    key = linelist_fingerprint(linelist)
+    with pytest.raises(ValueError):
+        linelist["gflog"][1] += 1
+    with pytest.raises(ValueError):
+        linelist.gflog[1] += 1
+    assert linelist_fingerprint(linelist) == key
+
+
+def test_spectrum_cache(tmp_path):
+    entry = {"wave": np.linspace(5000, 5010, 10), "synth": np.ones(10)}
+    cache = SpectrumCache(maxsize=1, directory=str(tmp_path))
+    assert cache.get("a") is None
+    cache.put("a", entry)
+    cache.put("b", entry)
+    assert len(cache) == 1
+
+    # The returned arrays are copies
+    value = cache.get("b")
+    value["synth"] *= 2
+    assert np.all(cache.get("b")["synth"] == 1)
+
+    # "a" was removed from memory, but is still on disk
+    assert np.all(cache.get("a")["wave"] == entry["wave"])
+    assert cache.disk_hits == 1
+    assert cache.hits == 3
+    assert cache.misses == 1
+
+    # A new cache in the same directory can use the stored entries
+    cache = SpectrumCache(directory=str(tmp_path))
+    assert cache.get("b") is not None
+    cache.clear(disk=True)
+    assert cache.get("b") is None
+    assert cache.stats()["hit_ratio"] == 0
@@ -1,12 +1,20 @@
 # TODO implement continuum and radial velocity tests
 
 from os.path import dirname
+from types import SimpleNamespace
 
 import pytest
 import numpy as np
+import pandas as pd
 
 from pysme.sme import SME_Structure as SME_Struct
-from pysme.continuum_and_radial_velocity import determine_rv_and_cont
+from pysme.continuum_and_radial_velocity import (
+    cross_correlate_rv,
+    determine_rv_and_cont,
+    get_continuum_mask,
+    determine_rv_and_cont_profile,
+    match_rv_continuum,
+)
 
 
 def test_match_both(testcase1):
@@ -57,6 +65,163 @@ def test_match_both(testcase1):
                 assert np.allclose(cscale[:, :-1], 0, atol=1e-1)
 
 
+@pytest.mark.parametrize("voption", ["none", "each", "whole"])
+@pytest.mark.parametrize("coption", ["none", "constant", "linear"])
+def test_match_both_profile(testcase1, voption, coption):
+    sme, x_syn, y_syn, rv = testcase1
+    sme.vrad_flag = voption
+    sme.cscale_flag = coption
+    segment = range(sme.nseg)
+
+    vrad, vunc, cscale, cunc = determine_rv_and_cont_profile(
+        sme, segment, x_syn, y_syn
+    )
+
+    assert vrad.shape == (sme.nseg,)
+    assert vunc.shape == (sme.nseg, 2)
+    assert cscale.shape == (sme.nseg, sme.cscale_degree + 1)
+    assert cunc.shape == (sme.nseg, sme.cscale_degree + 1, 2)
+
+    if voption == "none":
+        assert np.all(vrad == 0)
+    else:
+        assert np.allclose(vrad, rv, atol=1)
+        assert np.all(vunc > 0)
+
+    assert np.allclose(cscale[:, -1], 1, atol=1e-1)
+    assert np.allclose(cscale[:, :-1], 0, atol=1e-1)
+
+    # The result is deterministic
+    vrad2, _, cscale2, _ = determine_rv_and_cont_profile(sme, segment, x_syn, y_syn)
+    assert np.all(vrad == vrad2)
+    assert np.all(cscale == cscale2)
+
+
+def test_mcmc_warm_start(testcase1):
+    sme, x_syn, y_syn, rv = testcase1
+    sme.vrad_flag = "each"
+    sme.cscale_flag = "constant"
+    sme.mcmc_steps = 2000
+    sme.mcmc_burnin = 100
+    sme.mcmc_tolerance = 10
+    np.random.seed(0)
+
+    vrad, _, _, _ = determine_rv_and_cont(sme, 0, x_syn[0], y_syn[0])
+    assert len(sme.mcmc_walkers) == 1
+    walkers = np.copy(list(sme.mcmc_walkers.values())[0])
+
+    # The next fit resumes from the stored walkers
+    vrad2, _, _, _ = determine_rv_and_cont(sme, 0, x_syn[0], y_syn[0])
+    assert len(sme.mcmc_walkers) == 1
+    assert not np.all(list(sme.mcmc_walkers.values())[0] == walkers)
+    assert np.allclose(vrad2, vrad, atol=1)
+
+    # But not for a different observation
+    sme.spec = [sme.spec[0] * 1.01, sme.spec[1]]
+    determine_rv_and_cont(sme, 0, x_syn[0], y_syn[0])
+    assert len(sme.mcmc_walkers) == 2
+
+    # Walkers that did not converge are not stored
+    sme.mcmc_walkers = {}
+    sme.mcmc_tolerance = 1e6
+    determine_rv_and_cont(sme, 0, x_syn[0], y_syn[0])
+    assert len(sme.mcmc_walkers) == 0
+
+
+def test_mcmc_warm_start_parallel(testcase1):
+    sme, x_syn, y_syn, rv = testcase1
+    sme.cscale_type = "whole"
+    sme.vrad_flag = "each"
+    sme.cscale_flag = "constant"
+    sme.mcmc_steps = 2000
+    sme.mcmc_burnin = 100
+    sme.mcmc_tolerance = 10
+    segments = range(sme.nseg)
+    np.random.seed(0)
+
+    # The walkers of the worker processes are stored in sme
+    match_rv_continuum(sme, segments, x_syn, y_syn, n_jobs=2, executor="process")
+    assert len(sme.mcmc_walkers) == sme.nseg
+
+    # Without the walkers the burn in would discard all samples,
+    # with them only a fraction of it is used
+    sme.mcmc_burnin = sme.mcmc_steps
+    _, _, vrad, _ = match_rv_continuum(
+        sme, segments, x_syn, y_syn, n_jobs=2, executor="process"
+    )
+    assert np.allclose(vrad, rv, atol=1)
+
+
+@pytest.mark.parametrize("combine", [False, True])
+def test_cross_correlate_rv(testcase1, combine):
+    sme, x_syn, y_syn, rv = testcase1
+    x_obs = [sme.wave[i] for i in range(sme.nseg)]
+    y_obs = [sme.spec[i] for i in range(sme.nseg)]
+
+    vrad = cross_correlate_rv(x_obs, y_obs, x_syn, y_syn, combine=combine)
+    assert vrad.shape == (sme.nseg,)
+    assert np.allclose(vrad, rv, atol=1)
+
+
+def test_cross_correlate_rv_continuum_segment(testcase1):
+    sme, x_syn, y_syn, rv = testcase1
+    # The first segment has no line points left
+    x_obs = [sme.wave[0][:1], sme.wave[1]]
+    y_obs = [sme.spec[0][:1], sme.spec[1]]
+
+    vrad = cross_correlate_rv(x_obs, y_obs, x_syn, y_syn)
+    assert np.isnan(vrad[0])
+    assert np.isclose(vrad[1], rv, atol=1)
+
+    vrad = cross_correlate_rv(x_obs, y_obs, x_syn, y_syn, combine=True)
+    assert np.allclose(vrad, rv, atol=1)
+
+    # The same for the radial velocity of all segments
+    sme.mask = [np.full(sme.wave[0].size, sme.mask_values["continuum"]), sme.mask[1]]
+    sme.vrad_flag = "whole"
+    sme.cscale_flag = "none"
+    sme.vrad = None
+    sme.cscale = None
+    segments = range(sme.nseg)
+    vrad, _, _, _ = determine_rv_and_cont(sme, segments, x_syn, y_syn)
+    assert np.allclose(vrad, rv, atol=1)
+
+
+@pytest.mark.parametrize("executor", ["thread", "process"])
+def test_match_rv_continuum_parallel(testcase1, executor):
+    sme, x_syn, y_syn, rv = testcase1
+    sme.cscale_type = "mask"
+    sme.vrad_flag = "each"
+    sme.cscale_flag = "linear"
+    segments = range(sme.nseg)
+
+    cscale, _, vrad, _ = match_rv_continuum(sme, segments, x_syn, y_syn)
+    cscale2, _, vrad2, _ = match_rv_continuum(
+        sme, segments, x_syn, y_syn, n_jobs=2, executor=executor
+    )
+
+    assert np.allclose(vrad2, vrad)
+    assert np.allclose(cscale2, cscale)
+
+
+def test_continuum_mask():
+    wave = np.linspace(5000, 5010, 1000)
+    linelist = pd.DataFrame({"depth": [0.05, 0.5, 0.9]})
+    ranges = np.array([[4990, 5020], [5000, 5006], [5005, 5008]])
+    dll = SimpleNamespace(linelist=linelist, GetLineRange=lambda: ranges)
+
+    # The first line is too weak, but the others cover 80% of the points
+    mask = get_continuum_mask(wave, None, linelist, dll=dll)
+    cont = mask == 2
+    assert np.all(cont == (wave > 5008))
+
+    # If most points are masked, the threshold is raised until enough remain
+    mask = np.zeros(wave.size, int)
+    mask[:150] = 1
+    mask = get_continuum_mask(wave, None, linelist, mask=mask, dll=dll)
+    assert np.count_nonzero(mask == 2) == 150
+
+
 def test_nomask(testcase1):
     sme, x_syn, y_syn, rv = testcase1
     sme.cscale_flag = "constant"
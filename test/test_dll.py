@@ -102,6 +102,13 @@ def test_basic(libsme, wfirst, wlast, vw_scale):
     assert libsme.h2broad
 
 
+def test_private_instance(libsme):
+    """ Test that private instances load their own copy of the library """
+    private = SME_DLL(private_instance=True)
+    assert private.lib.lib._name != libsme.lib.lib._name
+    assert private.SMELibraryVersion() == libsme.SMELibraryVersion()
+
+
 def test_linelist(libsme, linelist):
     """ Test linelist behaviour """
     libsme.InputLineList(linelist)
@@ -209,3 +216,24 @@ def test_transf(
     for switch in range(-3, 13):
         if switch != 8:
             libsme.GetOpacity(switch)
+
+
+def test_transf_buffers(
+    libsme, linelist, teff, grav, vturb, atmo, abund, wfirst, wlast, mu, accrt, accwt,
+):
+    """ Test that the reused buffers of Transf do not change previous results """
+    libsme.InputLineList(linelist)
+    libsme.InputModel(teff, grav, vturb, atmo)
+    libsme.InputAbund(abund)
+    libsme.Ionization(0)
+    libsme.InputWaveRange(wfirst, wlast)
+    libsme.Opacity()
+
+    nw1, wave1, synth1, cont1 = libsme.Transf(mu, accrt, accwt)
+    orig = np.copy(synth1)
+    nw2, wave2, synth2, cont2 = libsme.Transf(mu, accrt, accwt)
+
+    assert nw1 == nw2
+    assert np.all(synth1 == orig)
+    assert np.allclose(synth1, synth2)
+    assert synth2.flags.c_contiguous
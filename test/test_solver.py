@@ -3,7 +3,7 @@ from os.path import dirname
 
 import numpy as np
 
-from pysme.solve import solve
+from pysme.solve import SME_Solver, solve
 from pysme.sme import SME_Structure as SME_Struct
 
 cwd = dirname(__file__)
@@ -30,3 +30,53 @@ def test_simple():
 
     assert sme2.fitresults.chisq is not None
     assert sme2.fitresults.chisq != 0
+
+
+def test_parallel_jacobian():
+    sme = SME_Struct.load(filename)
+    sme2 = solve(sme, ["teff", "logg"], n_jobs=2)
+
+    assert sme2.fitresults.parameters == ["teff", "logg"]
+    assert np.all(np.isfinite(sme2.fitresults.uncertainties))
+    assert np.all(sme2.fitresults.uncertainties != 0)
+
+
+@pytest.mark.parametrize("jacobian_method", ["2-point", "broyden"])
+def test_jacobian_method(jacobian_method):
+    sme = SME_Struct.load(filename)
+    solver = SME_Solver(jacobian_method=jacobian_method, jacobian_step="default")
+    assert np.all(solver.get_jacobian_step() == [])
+    sme2 = solver.solve(sme, ["teff", "abund Fe"])
+
+    assert np.all(solver.get_jacobian_step() == [10, 0.01])
+    assert solver.jacobian_syntheses_saved > 0
+    assert np.all(np.isfinite(sme2.fitresults.uncertainties))
+
+
+def test_jacobian_method_invalid():
+    with pytest.raises(ValueError):
+        SME_Solver(jacobian_method="5-point")
+
+
+def test_hybrid_jacobian():
+    sme = SME_Struct.load(filename)
+    solver = SME_Solver()
+    sme2 = solver.solve(sme, ["teff", "vsini"])
+    assert np.all(solver.get_broadening_parameters() == [1])
+    # Only the vsini columns reuse the specific intensities
+    assert solver.jacobian_syntheses_broadening > 0
+    assert solver.jacobian_syntheses_broadening * 2 == solver.jacobian_syntheses
+    assert np.all(np.isfinite(sme2.fitresults.uncertainties))
+
+    solver = SME_Solver(jacobian_hybrid=False)
+    solver.parameter_names = ["teff", "vsini"]
+    assert solver.get_broadening_parameters().size == 0
+
+
+def test_abundance_segments():
+    sme = SME_Struct.load(filename)
+    solver = SME_Solver(abundance_segments=True)
+    sme2 = solver.solve(sme, ["abund Fe"])
+
+    assert 0 in solver._parameter_segments
+    assert np.all(np.isfinite(sme2.fitresults.uncertainties))
@@ -1,9 +1,11 @@
 # TODO implement synthesis tests
 import pytest
 import numpy as np
+import pandas as pd
 
-from pysme.synthesize import synthesize_spectrum
+from pysme.synthesize import Synthesizer, synthesize_spectrum
 from pysme.iliffe_vector import Iliffe_vector
+from pysme.sme_synth import SME_DLL
 
 
 def test_synthesis_simple(sme_2segments):
@@ -49,3 +51,247 @@ def test_synthesis_segment(sme_2segments):
     assert sme2.wave.shape[1][1] != 0
 
     assert np.all(sme2.synth[0] == orig)
+
+
+def test_synthesis_parallel(sme_2segments):
+    sme = sme_2segments
+    sme = synthesize_spectrum(sme)
+    synth = np.copy(sme.synth.ravel())
+
+    sme = synthesize_spectrum(sme, n_jobs=2)
+
+    assert np.allclose(sme.synth.ravel(), synth)
+
+
+def test_synthesis_threads(sme_2segments):
+    sme = sme_2segments
+    sme = synthesize_spectrum(sme)
+    synth = np.copy(sme.synth.ravel())
+
+    sme = synthesize_spectrum(sme, n_jobs=2, executor="thread")
+
+    assert np.allclose(sme.synth.ravel(), synth)
+
+
+def test_synthesis_intensity_cache(sme_2segments):
+    sme = sme_2segments
+    synthesizer = Synthesizer()
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.intensity_cache.misses == 2
+
+    # Changing vsini only requires new broadening, not radiative transfer
+    sme.vsini = 3
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.intensity_cache.hits == 2
+    synth = np.copy(sme.synth.ravel())
+
+    sme.synth = None
+    sme = synthesize_spectrum(sme)
+    assert np.allclose(sme.synth.ravel(), synth)
+
+    # But changing teff does
+    sme.teff = 5100
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.intensity_cache.hits == 2
+    assert synthesizer.intensity_cache.misses == 4
+
+
+def test_synthesis_intensity_cache_size(sme_2segments):
+    sme = sme_2segments
+    # More segments than the minimum size of the cache
+    nseg = 40
+    edges = np.linspace(6550, 6574, nseg + 1)
+    sme.wran = np.stack([edges[:-1], edges[1:]], axis=1)
+
+    synthesizer = Synthesizer()
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.intensity_cache.misses == nseg
+    assert synthesizer.intensity_cache.maxsize >= nseg
+
+    # The intensities of the first segments are still there
+    sme.vsini = 3
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.intensity_cache.hits == nseg
+    assert synthesizer.intensity_cache.misses == nseg
+
+
+def test_synthesis_input_tracking(sme_2segments):
+    sme = sme_2segments
+    synthesizer = Synthesizer()
+    sme = synthesizer.synthesize_spectrum(sme)
+
+    calls = []
+    dll = synthesizer.dll
+    for name in ["InputModel", "InputAbund", "Ionization", "InputLineList"]:
+        func = getattr(dll, name)
+        setattr(
+            dll,
+            name,
+            lambda *args, _func=func, _name=name, **kwargs: calls.append(_name)
+            or _func(*args, **kwargs),
+        )
+
+    # Nothing that reaches the library changed
+    sme.vsini = 2
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert calls == []
+
+    # Only the abundances changed
+    sme.abund["Fe"] += 0.1
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert calls == ["InputAbund", "Ionization"]
+
+
+@pytest.mark.parametrize("linelist_mode", ["range", "segment"])
+def test_synthesis_linelist_subset(sme_2segments, linelist_mode):
+    sme = sme_2segments
+    sme = synthesize_spectrum(sme)
+    synth = np.copy(sme.synth.ravel())
+
+    synthesizer = Synthesizer(linelist_mode=linelist_mode)
+    lines = synthesizer.get_segment_lines(sme, [0])
+    assert np.all(np.diff(lines) > 0)
+    assert len(lines) <= len(sme.linelist)
+
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert np.allclose(sme.synth.ravel(), synth, atol=1e-3)
+    assert sme.nlte.flags.size == len(sme.linelist)
+
+
+def test_synthesis_spectrum_cache(sme_2segments, tmp_path):
+    sme = sme_2segments
+    synthesizer = Synthesizer(spectrum_cache=str(tmp_path))
+    sme = synthesizer.synthesize_spectrum(sme)
+    synth = np.copy(sme.synth.ravel())
+    assert synthesizer.spectrum_cache.misses == 2
+
+    # The same parameters do not need the library
+    synthesizer.dll = None
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.spectrum_cache.hits == 2
+    assert np.allclose(sme.synth.ravel(), synth)
+
+    # Neither in a new session
+    sme = synthesize_spectrum(sme, spectrum_cache=str(tmp_path))
+    assert np.allclose(sme.synth.ravel(), synth)
+
+    # But the atmosphere still matches the parameters
+    teff = sme.teff
+    sme.teff = teff + 100
+    synthesizer.dll = SME_DLL()
+    sme = synthesizer.synthesize_spectrum(sme)
+    sme.teff = teff
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.spectrum_cache.hits == 4
+    assert np.allclose(sme.synth.ravel(), synth)
+    assert np.isclose(sme.atmo.teff, teff)
+
+
+def test_synthesis_grid(sme_2segments):
+    sme = sme_2segments
+    table = {"teff": [5100, 5000, 5000], "logg": [4.4, 4.4, 4.2]}
+    synthesizer = Synthesizer()
+    order = synthesizer.sort_grid(pd.DataFrame(table))
+    assert np.all(order == [2, 1, 0])
+
+    wave, synth = synthesizer.synthesize_grid(sme, table)
+    assert synth.shape == (3, wave.size)
+    assert sme.wave is None
+
+    grid = {i: (w, s) for i, w, s, _ in synthesizer.iter_grid(sme, table)}
+    assert sorted(grid.keys()) == [0, 1, 2]
+
+    sme.teff, sme.logg = 5000, 4.2
+    sme.wave = grid[2][0]
+    sme = synthesize_spectrum(sme)
+    assert np.allclose(grid[2][1].ravel(), sme.synth.ravel())
+    assert np.allclose(synth[2], sme.synth.ravel())
+
+
+def test_element_segments(sme_2segments):
+    sme = sme_2segments
+    synthesizer = Synthesizer()
+    # Hydrogen affects everything
+    assert synthesizer.get_element_segments(sme, "H") == [0, 1]
+
+    species = np.unique(sme.linelist.species)
+    element = species[0].split(" ")[0]
+    segments = synthesizer.get_element_segments(sme, element)
+    assert len(segments) > 0
+    assert synthesizer.get_element_segments(sme, "Xx") == []
+
+
+def test_synthesis_mask_windows(sme_2segments):
+    sme = sme_2segments
+    sme = synthesize_spectrum(sme)
+    synth = np.copy(sme.synth.ravel())
+
+    sme.mask = np.zeros(sme.wave.size, int)
+    sme.mask[0, 100:150] = 1
+    sme.mask[1, 50:60] = 1
+    synthesizer = Synthesizer(mask_windows=True)
+    windows = synthesizer.get_mask_windows(sme, 0)
+    assert len(windows) == 1
+    assert windows[0][1] - windows[0][0] < sme.wran[0][1] - sme.wran[0][0]
+
+    sme = synthesizer.synthesize_spectrum(sme)
+    good = sme.mask_good.ravel()
+    assert np.allclose(sme.synth.ravel()[good], synth[good], atol=1e-3)
+
+
+def test_synthesis_atmosphere_cache(sme_2segments):
+    sme = sme_2segments
+    synthesizer = Synthesizer(atmosphere_digits=4)
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.atmosphere_cache.misses == 1
+
+    # Abundances do not change the atmosphere
+    sme.abund["Fe"] += 0.1
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.atmosphere_cache.hits == 1
+
+    # Neither do changes below the quantization
+    teff = sme.teff
+    sme.teff = teff + 0.01
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.atmosphere_cache.hits == 2
+
+    sme.teff = teff + 100
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.atmosphere_cache.misses == 2
+
+    # The previous atmosphere is still in the cache
+    sme.teff = teff
+    sme = synthesizer.synthesize_spectrum(sme)
+    assert synthesizer.atmosphere_cache.hits == 3
+    temp = np.copy(sme.atmo.temp)
+
+    # Changes of the atmosphere in sme do not change the cache
+    sme.atmo.temp[:] = 0
+    sme = synthesizer.get_atmosphere(sme)
+    assert synthesizer.atmosphere_cache.hits == 4
+    assert np.all(sme.atmo.temp == temp)
+
+
+@pytest.mark.parametrize(
+    "options", [{"n_jobs": 2, "executor": "thread"}, {"linelist_mode": "segment"}]
+)
+def test_synthesis_continuum_mask(sme_2segments, options):
+    sme = sme_2segments
+    sme = synthesize_spectrum(sme)
+    sme.spec = np.copy(sme.synth.ravel())
+    sme.mask = np.full(sme.wave.size, sme.mask_values["line"])
+    sme.cscale_type = "mask"
+    sme.cscale_flag = "linear"
+
+    # The continuum points are found from the line ranges of the whole linelist,
+    # even though the library only holds some of the lines, or none at all
+    synthesizer = Synthesizer(**options)
+    try:
+        sme = synthesizer.synthesize_spectrum(sme)
+    finally:
+        synthesizer.close()
+
+    for seg in range(sme.nseg):
+        assert np.any(sme.mask[seg] == sme.mask_values["continuum"])
+    assert np.allclose(sme.cscale[:, -1], 1, atol=1e-1)